@@ -1,5 +1,9 @@
-from flask import Flask
+import time
+from flask import Flask, g, request
 from flasgger import Swagger
+from werkzeug.middleware.proxy_fix import ProxyFix
+from monitoring import Metrics, start_redis_account, stop_redis_account
+from compression import compress_response
 
 # Create the Flask aoo
 app = Flask(__name__)
@@ -7,6 +11,10 @@ app = Flask(__name__)
 # Load Configurations
 app.config.from_object('config')
 
+# Take the client address from the X-Forwarded-For entries added by our own proxies
+if app.config['PROXY_COUNT']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'], x_proto=0)
+
 # Configure Swagger before initilaizing it
 app.config['SWAGGER'] = {
     "swagger_version": "2.0",
@@ -24,6 +32,44 @@ app.config['SWAGGER'] = {
 # Initialize Swagger after configuring it
 Swagger(app)
 
+# Request metrics served at /metrics, shared by the workers through Redis
+metrics = Metrics(key=app.config['METRICS_KEY'], flush_interval=app.config['METRICS_FLUSH_INTERVAL'])
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.time()
+    metrics.add_gauge('http_requests_in_flight', {}, 1)
+    if app.config['REDIS_CALL_HEADERS']:
+        start_redis_account()
+
+@app.after_request
+def keep_response_status(response):
+    g.metrics_status = response.status_code
+    # a streamed body is read from Redis after this, so only what came before it is counted
+    account = stop_redis_account()
+    if account is not None:
+        response.headers.extend(account.headers())
+    return response
+
+@app.after_request
+def compress(response):
+    if not app.config['COMPRESS_LEVEL']:
+        return response
+    return compress_response(response, request.accept_encodings, app.config['COMPRESS_LEVEL'],
+                             app.config['COMPRESS_MIN_SIZE'], app.config['COMPRESS_MIMETYPES'])
+
+@app.teardown_request
+def record_request_metrics(error=None):
+    # runs once a streamed body has been sent, so streaming time is included
+    if 'metrics_start' not in g:
+        return
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = {'route': route, 'method': request.method, 'status': g.get('metrics_status', 500)}
+    metrics.add_gauge('http_requests_in_flight', {}, -1)
+    metrics.inc('http_requests_total', labels)
+    metrics.observe('http_request_duration_seconds', labels, time.time() - g.metrics_start)
+    metrics.maybe_flush()
+
 import server
 import models
 import custom_exceptions
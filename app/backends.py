@@ -0,0 +1,586 @@
+######################################################################
+# Storage Backends
+#   The Order model keeps its data through one of these engines so the
+#   same model code can run against Redis or entirely in process
+#
+#   Records passed in and out are dicts of Order fields. Ids handed
+#   back by the backends are always ints.
+######################################################################
+
+import threading
+from decimal import Decimal, InvalidOperation
+from bisect import bisect_left, bisect_right, insort
+from scripts import ScriptRegistry, MAX_AMOUNT
+
+######################################################################
+# Interface every storage engine implements
+######################################################################
+class StorageBackend(object):
+    """ The operations the Order model needs from its storage """
+
+    def create(self, fields):
+        """ Stores a new Order and returns the id and version allocated for it """
+        raise NotImplementedError
+
+    def create_many(self, records):
+        """ Stores many new Orders under contiguous blocks of ids and versions
+
+        Returns the first id and the first version
+        """
+        raise NotImplementedError
+
+    def reserve(self, count):
+        """ Allocates count new ids and count new versions, returns the first of each """
+        raise NotImplementedError
+
+    def write_many(self, records):
+        """ Stores new Orders whose id and version were allocated with reserve
+
+        Every record is checked with check_record before anything is
+        written, so a bad one raises ValueError and stores nothing.
+        Orders already stored are skipped, which makes retrying a batch
+        after a failure safe. The generation moves on once the Orders are
+        stored.
+        """
+        raise NotImplementedError
+
+    def update(self, id, fields, channel=''):
+        """ Replaces the Order with this id, creating it if needed, and returns its new version """
+        raise NotImplementedError
+
+    def delete(self, id, channel=''):
+        """ Removes the Order with this id, returns whether it existed """
+        raise NotImplementedError
+
+    def get(self, id):
+        """ Returns the record of the Order with this id or None """
+        raise NotImplementedError
+
+    def get_many(self, ids):
+        """ Returns a list of records lined up with ids, None where missing """
+        raise NotImplementedError
+
+    def version(self, id):
+        """ Returns the version of the Order with this id, None if it does not exist """
+        raise NotImplementedError
+
+    def generation(self):
+        """ Returns the number of the last write made to any Order """
+        raise NotImplementedError
+
+    def get_rows(self, ids):
+        """ Returns (id, customer_name, amount_paid) tuples, skipping missing ids """
+        raise NotImplementedError
+
+    def get_json_rows(self, ids):
+        """ Returns (row, json) pairs of a row tuple and the stored JSON blob, skipping missing ids
+
+        json is None or empty for Orders stored without a blob
+        """
+        raise NotImplementedError
+
+    def page_ids(self, after_id, limit):
+        """ Returns up to limit ids after after_id and the id the next page starts after """
+        raise NotImplementedError
+
+    def page_ids_by_amount(self, min_amount, max_amount, after, limit):
+        """ Returns up to limit ids in amount order and the position the next page starts at """
+        raise NotImplementedError
+
+    def customer_ids(self, customer_name):
+        """ Returns the ids of every Order placed by a customer in id order """
+        raise NotImplementedError
+
+    def stats(self, customer_name=None):
+        """ Returns the (count, total amount_paid) of all Orders or of one customer's """
+        raise NotImplementedError
+
+    def replace_stats(self, count, total, totals, counts):
+        """ Overwrites the stats with freshly computed figures """
+        raise NotImplementedError
+
+    def remove_all(self):
+        """ Deletes every Order and index """
+        raise NotImplementedError
+
+    def migrate_legacy_keys(self, batch_size):
+        """ Moves data left by older versions into the current schema, returns how many Orders moved """
+        return 0
+
+    @staticmethod
+    def _next_position(rows, start, skip, limit):
+        """ Works out where the next page of an amount range starts
+
+        rows are the (id, amount) pairs read for this page plus one to
+        detect the end. The position is the amount the page ended on and
+        how many Orders with that amount were returned so far.
+        """
+        if len(rows) <= limit:
+            return None
+        last_amount = rows[limit - 1][1]
+        seen = len([amount for id, amount in rows[:limit] if amount == last_amount])
+        if last_amount == float(start):
+            seen += skip
+        return (last_amount, seen)
+
+######################################################################
+# Redis
+#
+# Key schema (everything lives under the order: and idx: namespaces)
+#   order:<id>            hash holding a single Order, with its JSON blob
+#                         in the json field when those are stored
+#   order:ids             sorted set of live order ids (score = id)
+#   order:index           counter used to allocate new ids
+#   order:generation      counter bumped by every write, the version of an
+#                         Order is the generation its last write got
+#   idx:customer:<name>   set of order ids placed by a customer
+#   idx:amount            sorted set of order ids scored by amount_paid
+#   order:stats           hash with the count and total amount_paid of all orders
+#   order:stats:customer:total / order:stats:customer:count
+#                         hashes of amount_paid totals and order counts per customer
+######################################################################
+class RedisBackend(StorageBackend):
+
+    ORDER_KEY = 'order:%s'
+    IDS_KEY = 'order:ids'
+    INDEX_KEY = 'order:index'
+    GENERATION_KEY = 'order:generation'
+    CUSTOMER_KEY = 'idx:customer:%s'
+    AMOUNT_KEY = 'idx:amount'
+    STATS_KEY = 'order:stats'
+    CUSTOMER_TOTALS_KEY = 'order:stats:customer:total'
+    CUSTOMER_COUNTS_KEY = 'order:stats:customer:count'
+    STATS_KEYS = [STATS_KEY, CUSTOMER_TOTALS_KEY, CUSTOMER_COUNTS_KEY]
+    NAMESPACES = ('order:*', 'idx:*')
+    FIELDS = ('id', 'customer_name', 'amount_paid')
+
+    # Most writes sent in one pipelined round trip by bulk operations
+    BATCH_SIZE = 500
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.scripts = ScriptRegistry(redis)
+
+    @staticmethod
+    def order_key(id):
+        """ Returns the key of the hash holding the Order with this id """
+        return RedisBackend.ORDER_KEY % id
+
+    @staticmethod
+    def customer_key(customer_name):
+        """ Returns the key of the set indexing order ids by customer name """
+        return RedisBackend.CUSTOMER_KEY % customer_name
+
+    @staticmethod
+    def _pairs(fields):
+        """ Flattens a record into the field, value pairs the scripts write """
+        pairs = []
+        for field, value in fields.items():
+            if field != 'id':
+                pairs.extend([field, value])
+        return pairs
+
+    def create(self, fields):
+        id, version = self.scripts.run('create',
+            keys=[self.INDEX_KEY, self.IDS_KEY, self.customer_key(fields['customer_name']), self.AMOUNT_KEY,
+                  self.GENERATION_KEY] + self.STATS_KEYS,
+            args=[self.order_key('')] + self._pairs(fields))
+        return id, version
+
+    def update(self, id, fields, channel=''):
+        return self.scripts.run('update',
+            keys=[self.order_key(id), self.IDS_KEY, self.customer_key(fields['customer_name']), self.AMOUNT_KEY,
+                  self.GENERATION_KEY] + self.STATS_KEYS,
+            args=[id, self.customer_key(''), channel] + self._pairs(fields))
+
+    def delete(self, id, channel=''):
+        return bool(self.scripts.run('delete',
+            keys=[self.order_key(id), self.IDS_KEY, self.AMOUNT_KEY, self.GENERATION_KEY] + self.STATS_KEYS,
+            args=[id, self.customer_key(''), channel]))
+
+    def create_many(self, records):
+        """ Reserves the ids and versions in one round trip and pipelines the writes
+
+        reserve moves the generation on before anything is written, so it
+        moves on again with the last write: a list tagged in between is
+        never served as current once the batch is stored
+        """
+        first_id, first_version = self.reserve(len(records))
+        pipe = self.redis.pipeline(transaction=False)
+        for offset, fields in enumerate(records):
+            self._write(pipe, first_id + offset, dict(fields, id=first_id + offset), first_version + offset)
+            if (offset + 1) % self.BATCH_SIZE == 0:
+                pipe.execute()
+        pipe.incr(self.GENERATION_KEY)
+        pipe.execute()
+        return first_id, first_version
+
+    def reserve(self, count):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.incrby(self.INDEX_KEY, count)
+        pipe.incrby(self.GENERATION_KEY, count)
+        last_id, last_version = pipe.execute()
+        return last_id - count + 1, last_version - count + 1
+
+    def write_many(self, records):
+        """ Writes the whole batch with one script call """
+        for fields in records:
+            check_record(fields)
+        keys, args = [self.IDS_KEY, self.AMOUNT_KEY, self.GENERATION_KEY], []
+        for fields in records:
+            data = dict(fields)
+            version = data.pop('version')
+            pairs = self._pairs(data)
+            keys.extend([self.order_key(data['id']), self.customer_key(data['customer_name'])])
+            args.extend([data['id'], version, len(pairs) // 2] + pairs)
+        self.scripts.run('write_many', keys=keys + self.STATS_KEYS, args=args)
+
+    def _write(self, pipe, id, data, version):
+        """ Queues a brand new Order and its index entries, as the create script does """
+        pipe.hmset(self.order_key(id), dict(data, version=version))
+        pipe.zadd(self.IDS_KEY, {id: int(id)})
+        pipe.sadd(self.customer_key(data['customer_name']), id)
+        amount = _amount(data.get('amount_paid'))
+        if amount is not None:
+            pipe.zadd(self.AMOUNT_KEY, {id: amount})
+        pipe.hincrby(self.STATS_KEY, 'count', 1)
+        pipe.hincrby(self.STATS_KEY, 'total', amount or 0)
+        pipe.hincrby(self.CUSTOMER_TOTALS_KEY, data['customer_name'], amount or 0)
+        pipe.hincrby(self.CUSTOMER_COUNTS_KEY, data['customer_name'], 1)
+
+    def get(self, id):
+        return self.redis.hgetall(self.order_key(id)) or None
+
+    def get_many(self, ids):
+        if not ids:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for id in ids:
+            pipe.hgetall(self.order_key(id))
+        return [data or None for data in pipe.execute()]
+
+    def version(self, id):
+        version = self.redis.hget(self.order_key(id), 'version')
+        return None if version is None else int(version)
+
+    def generation(self):
+        return int(self.redis.get(self.GENERATION_KEY) or 0)
+
+    def get_rows(self, ids):
+        pipe = self.redis.pipeline(transaction=False)
+        for id in ids:
+            pipe.hmget(self.order_key(id), self.FIELDS)
+        return [(int(id), customer_name, _amount(amount_paid))
+                for id, customer_name, amount_paid in pipe.execute() if id is not None]
+
+    def get_json_rows(self, ids):
+        pipe = self.redis.pipeline(transaction=False)
+        for id in ids:
+            pipe.hmget(self.order_key(id), self.FIELDS + ('json',))
+        return [((int(id), customer_name, _amount(amount_paid)), blob)
+                for id, customer_name, amount_paid, blob in pipe.execute() if id is not None]
+
+    def page_ids(self, after_id, limit):
+        ids = [int(id) for id in self.redis.zrangebyscore(self.IDS_KEY, '(%d' % after_id, '+inf', start=0, num=limit + 1)]
+        if len(ids) > limit:
+            return ids[:limit], ids[limit - 1]
+        return ids, None
+
+    def page_ids_by_amount(self, min_amount, max_amount, after, limit):
+        start, skip = after or (min_amount, 0)
+        rows = self.redis.zrangebyscore(self.AMOUNT_KEY, start, max_amount,
+                                        start=skip, num=limit + 1, withscores=True)
+        return [int(id) for id, amount in rows[:limit]], self._next_position(rows, start, skip, limit)
+
+    def customer_ids(self, customer_name):
+        return sorted(int(id) for id in self.redis.smembers(self.customer_key(customer_name)))
+
+    def stats(self, customer_name=None):
+        if customer_name is None:
+            count, total = self.redis.hmget(self.STATS_KEY, 'count', 'total')
+        else:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hget(self.CUSTOMER_COUNTS_KEY, customer_name)
+            pipe.hget(self.CUSTOMER_TOTALS_KEY, customer_name)
+            count, total = pipe.execute()
+        return int(count or 0), int(total or 0)
+
+    def replace_stats(self, count, total, totals, counts):
+        pipe = self.redis.pipeline()
+        pipe.delete(*self.STATS_KEYS)
+        pipe.hmset(self.STATS_KEY, {'count': count, 'total': total})
+        if counts:
+            pipe.hmset(self.CUSTOMER_TOTALS_KEY, totals)
+            pipe.hmset(self.CUSTOMER_COUNTS_KEY, counts)
+        pipe.execute()
+
+    def remove_all(self):
+        """ Deletes every key in our namespaces, leaving other services' data alone
+
+        The generation carries on from where it was so no version or list
+        ETag handed out before is ever reused
+        """
+        generation = self.generation()
+        for pattern in self.NAMESPACES:
+            keys = []
+            for key in self.redis.scan_iter(match=pattern, count=self.BATCH_SIZE):
+                keys.append(key)
+                if len(keys) == self.BATCH_SIZE:
+                    self.redis.delete(*keys)
+                    keys = []
+            if keys:
+                self.redis.delete(*keys)
+        self.redis.set(self.GENERATION_KEY, generation + 1)
+
+    def migrate_legacy_keys(self, batch_size):
+        """ Rewrites Orders stored under bare integer keys into the order: namespace
+
+        The keyspace is walked with SCAN and every batch is moved in one
+        MULTI/EXEC so the hash and its indexes never disagree. Amounts,
+        which were free text then, are converted with legacy_amount.
+        """
+        migrated = 0
+        keys = []
+        for key in self.redis.scan_iter(count=batch_size):
+            if key.isdigit():
+                keys.append(key)
+            if len(keys) == batch_size:
+                migrated += self._migrate_batch(keys)
+                keys = []
+        migrated += self._migrate_batch(keys)
+        # carry the old id counter over so new ids never collide
+        legacy_index = self.redis.get('index')
+        if legacy_index is not None:
+            current = int(self.redis.get(self.INDEX_KEY) or 0)
+            self.redis.set(self.INDEX_KEY, max(current, int(legacy_index)))
+            self.redis.delete('index')
+        return migrated
+
+    def _migrate_batch(self, keys):
+        if not keys:
+            return 0
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        rows = pipe.execute()
+        version = self.redis.incrby(self.GENERATION_KEY, len(rows)) - len(rows) + 1
+        pipe = self.redis.pipeline()
+        for key, data in zip(keys, rows):
+            if data:
+                self._write(pipe, key, legacy_amount(data), version)
+                pipe.delete(key)
+                version += 1
+        pipe.incr(self.GENERATION_KEY)
+        pipe.execute()
+        return len([data for data in rows if data])
+
+######################################################################
+# In memory
+#   Plain dicts plus the same secondary indexes as the Redis schema,
+#   guarded by one lock. Nothing is shared between processes so it
+#   suits tests, benchmarks and single-node development runs.
+######################################################################
+class MemoryBackend(StorageBackend):
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._generation = 0            # survives remove_all so versions are never reused
+        self.remove_all()
+
+    def remove_all(self):
+        with self._lock:
+            self._generation += 1
+            self._orders = {}           # id -> record
+            self._ids = []              # sorted live ids
+            self._customers = {}        # customer_name -> set of ids
+            self._amounts = []          # sorted (amount_paid, str(id)), ordered like a Redis sorted set
+            self._last_id = 0
+            self._count = 0
+            self._total = 0
+            self._customer_totals = {}
+            self._customer_counts = {}
+
+    def create(self, fields):
+        with self._lock:
+            self._last_id += 1
+            return self._last_id, self._write(self._last_id, fields)
+
+    def create_many(self, records):
+        with self._lock:
+            first_id, first_version = self._last_id + 1, self._generation + 1
+            for id, fields in enumerate(records, first_id):
+                self._write(id, fields)
+            self._last_id += len(records)
+            return first_id, first_version
+
+    def reserve(self, count):
+        with self._lock:
+            self._last_id += count
+            self._generation += count
+            return self._last_id - count + 1, self._generation - count + 1
+
+    def write_many(self, records):
+        for fields in records:
+            check_record(fields)
+        with self._lock:
+            for fields in records:
+                data = dict(fields)
+                if data['id'] not in self._orders:
+                    self._write(data['id'], data, data.pop('version'))
+            self._generation += 1
+
+    def update(self, id, fields, channel=''):
+        with self._lock:
+            self._remove(int(id))
+            return self._write(int(id), fields)
+
+    def delete(self, id, channel=''):
+        with self._lock:
+            if not self._remove(int(id)):
+                return False
+            self._generation += 1
+            return True
+
+    def _write(self, id, fields, version=None):
+        """ Stores a record and its index entries, returns its version
+
+        A new version is allocated unless one was reserved
+        """
+        if version is None:
+            self._generation += 1
+            version = self._generation
+        data = dict(fields, id=id, version=version)
+        self._orders[id] = data
+        insort(self._ids, id)
+        self._customers.setdefault(data['customer_name'], set()).add(id)
+        amount = _amount(data.get('amount_paid'))
+        if amount is not None:
+            insort(self._amounts, (amount, str(id)))
+        self._tally(data['customer_name'], amount or 0, 1)
+        return version
+
+    def _remove(self, id):
+        data = self._orders.pop(id, None)
+        if data is None:
+            return False
+        del self._ids[bisect_left(self._ids, id)]
+        customers = self._customers[data['customer_name']]
+        customers.discard(id)
+        if not customers:
+            del self._customers[data['customer_name']]
+        amount = _amount(data.get('amount_paid'))
+        if amount is not None:
+            del self._amounts[bisect_left(self._amounts, (amount, str(id)))]
+        self._tally(data['customer_name'], amount or 0, -1)
+        return True
+
+    def _tally(self, customer_name, amount, sign):
+        self._count += sign
+        self._total += amount * sign
+        self._customer_totals[customer_name] = self._customer_totals.get(customer_name, 0) + amount * sign
+        self._customer_counts[customer_name] = self._customer_counts.get(customer_name, 0) + sign
+        if self._customer_counts[customer_name] <= 0:
+            del self._customer_counts[customer_name]
+            del self._customer_totals[customer_name]
+
+    def get(self, id):
+        with self._lock:
+            data = self._orders.get(int(id))
+            return dict(data) if data else None
+
+    def get_many(self, ids):
+        with self._lock:
+            return [dict(self._orders[int(id)]) if int(id) in self._orders else None for id in ids]
+
+    def version(self, id):
+        with self._lock:
+            data = self._orders.get(int(id))
+            return data['version'] if data else None
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def get_rows(self, ids):
+        with self._lock:
+            records = [self._orders.get(int(id)) for id in ids]
+            return [(data['id'], data['customer_name'], data['amount_paid']) for data in records if data]
+
+    def get_json_rows(self, ids):
+        with self._lock:
+            records = [self._orders.get(int(id)) for id in ids]
+            return [((data['id'], data['customer_name'], data['amount_paid']), data.get('json'))
+                    for data in records if data]
+
+    def page_ids(self, after_id, limit):
+        with self._lock:
+            start = bisect_right(self._ids, after_id)
+            ids = self._ids[start:start + limit + 1]
+        if len(ids) > limit:
+            return ids[:limit], ids[limit - 1]
+        return ids, None
+
+    def page_ids_by_amount(self, min_amount, max_amount, after, limit):
+        start, skip = after or (min_amount, 0)
+        with self._lock:
+            first = bisect_left(self._amounts, (float(start),)) + skip
+            rows = []
+            for amount, id in self._amounts[first:first + limit + 1]:
+                if amount > float(max_amount):
+                    break
+                rows.append((int(id), amount))
+        return [id for id, amount in rows[:limit]], self._next_position(rows, start, skip, limit)
+
+    def customer_ids(self, customer_name):
+        with self._lock:
+            return sorted(self._customers.get(customer_name, ()))
+
+    def stats(self, customer_name=None):
+        with self._lock:
+            if customer_name is None:
+                return self._count, self._total
+            return self._customer_counts.get(customer_name, 0), self._customer_totals.get(customer_name, 0)
+
+    def replace_stats(self, count, total, totals, counts):
+        with self._lock:
+            self._count, self._total = count, total
+            self._customer_totals, self._customer_counts = dict(totals), dict(counts)
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def legacy_amount(data):
+    """ Returns a record stored before amounts were cents with its amount_paid converted
+
+    Those amounts were free text in dollars, so "200" becomes 20000 and
+    "$12.50" 1250. One that cannot be converted is kept as it was in
+    legacy_amount_paid and amount_paid is left empty.
+    """
+    data = dict(data)
+    value = data.get('amount_paid')
+    try:
+        cents = Decimal(str(value).strip().lstrip('$').replace(',', '')) * 100
+    except (InvalidOperation, UnicodeEncodeError):
+        cents = None
+    if cents is None or not cents.is_finite() or cents != cents.to_integral_value() or not 0 <= cents <= MAX_AMOUNT:
+        if value not in (None, ''):
+            data['legacy_amount_paid'] = value
+        data['amount_paid'] = ''
+    else:
+        data['amount_paid'] = int(cents)
+    return data
+
+def check_record(fields):
+    """ Raises ValueError unless a record can be stored as it is """
+    if fields.get('customer_name') is None:
+        raise ValueError('order {} has no customer_name'.format(fields.get('id')))
+    if fields.get('amount_paid') not in (None, '') and _amount(fields['amount_paid']) is None:
+        raise ValueError('order {} has an invalid amount_paid'.format(fields.get('id')))
+
+def _amount(value):
+    """ Returns an amount_paid as an int for the indexes, None when it is not one """
+    try:
+        amount = int(value)
+    except (TypeError, ValueError):
+        return None
+    return amount if 0 <= amount <= MAX_AMOUNT else None
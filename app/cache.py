@@ -0,0 +1,191 @@
+######################################################################
+# Order Cache
+#   An in-process LRU read-through cache for Order.find. Entries expire
+#   after ttl seconds and are invalidated across worker processes by
+#   publishing the changed order ids on a Redis pub/sub channel
+######################################################################
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Message published to drop every entry instead of a single id
+CLEAR_ALL = '*'
+
+######################################################################
+# LRU cache with a size bound and a time to live
+######################################################################
+class LRUCache(object):
+    """ A read-through cache whose fills cannot undo an invalidation
+
+    A reader takes the epoch before it reads the value and passes it to
+    set. The epoch moves on with every invalidation, so a value read
+    before an invalidation that arrived during the read is not stored.
+    """
+
+    def __init__(self, max_size=1024, ttl=30, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_fills = 0
+
+    def epoch(self):
+        """ Returns a token that changes whenever anything is invalidated """
+        with self._lock:
+            return self._epoch
+
+    def get(self, key):
+        """ Returns the cached value or None, refreshing its recency """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires <= self._clock():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, epoch=None):
+        """ Stores value, unless something was invalidated since epoch was taken """
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                self.stale_fills += 1
+                return
+            self._data.pop(key, None)
+            self._data[key] = (value, self._clock() + self.ttl)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._epoch += 1
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'stale_fills': self.stale_fills
+            }
+
+######################################################################
+# Cross-process invalidation over Redis pub/sub
+######################################################################
+class CacheInvalidator(object):
+    """ Keeps a cache in step with writes made by other worker processes
+
+    healthy is False while the listener is not subscribed, since writes
+    made meanwhile are never heard of: the cache must not be read then.
+    Whenever the subscription is lost the cache is cleared and the
+    listener subscribes again every retry_interval seconds.
+    """
+
+    def __init__(self, redis, cache, channel, retry_interval=1.0):
+        self.redis = redis
+        self.cache = cache
+        self.channel = channel
+        self.retry_interval = retry_interval
+        self.healthy = False
+        self.reconnects = 0
+        self._pubsub = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def publish(self, key):
+        """ Tells every worker to drop key """
+        self.redis.publish(self.channel, key)
+
+    def start(self, poll_interval=1.0):
+        """ Subscribes, then listens in a daemon thread """
+        self._stopping.clear()
+        self._subscribe()
+        self._thread = threading.Thread(target=self._listen, args=(poll_interval,), name='cache-invalidator')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, wait=False):
+        """ Stops listening, waiting for the listener thread to exit if wait is set """
+        self._stopping.set()
+        if self._thread:
+            if wait:
+                self._thread.join()
+            self._thread = None
+        self.healthy = False
+
+    def _subscribe(self):
+        """ Subscribes on a fresh connection, returns whether it worked """
+        try:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._on_message})
+        except RedisError as e:
+            logger.warning('Could not subscribe to %s: %s', self.channel, e)
+            return False
+        self._pubsub = pubsub
+        # writes made while we were not subscribed were missed
+        self.cache.clear()
+        self.healthy = True
+        return True
+
+    def _listen(self, poll_interval):
+        while not self._stopping.is_set():
+            if not self._pubsub:
+                if not self._subscribe():
+                    self._stopping.wait(self.retry_interval)
+                continue
+            try:
+                self._pubsub.get_message(timeout=poll_interval)
+            except RedisError as e:
+                logger.warning('Lost the subscription to %s, resubscribing: %s', self.channel, e)
+                self._drop()
+                self.reconnects += 1
+        self._drop()
+
+    def _drop(self):
+        self.healthy = False
+        self.cache.clear()
+        if self._pubsub:
+            try:
+                self._pubsub.close()
+            except RedisError:
+                pass
+            self._pubsub = None
+
+    def _on_message(self, message):
+        key = message['data']
+        if key == CLEAR_ALL:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(int(key))
@@ -0,0 +1,99 @@
+######################################################################
+# Response Compression
+#   Compresses JSON responses with gzip or deflate when the client's
+#   Accept-Encoding allows it. Streamed lists are compressed chunk by
+#   chunk as they are written, so the body is never held in memory
+######################################################################
+
+import zlib
+from itertools import chain
+
+# Content-Encoding: zlib window bits, in order of preference
+ENCODINGS = [('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS)]
+
+######################################################################
+# Negotiation
+######################################################################
+def negotiate(accept_encodings):
+    """ Returns the encoding to use for a parsed Accept-Encoding, or None """
+    encoding = accept_encodings.best_match([name for name, wbits in ENCODINGS])
+    if encoding and accept_encodings[encoding] > 0:
+        return encoding
+    return None
+
+def is_compressible(response, mimetypes):
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return False
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return False
+    return response.mimetype in mimetypes
+
+######################################################################
+# Compression
+######################################################################
+def compress_response(response, accept_encodings, level=6, min_size=1024, mimetypes=()):
+    """ Compresses the response in place when it is worth it
+
+    A buffered body is compressed when it is at least min_size bytes. A
+    streamed body is read until min_size bytes have arrived: if it ends
+    first it is sent as is, otherwise what was read and the rest of the
+    stream are compressed as they go out
+    """
+    if not is_compressible(response, mimetypes):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        source = response.response
+        chunks = response.iter_encoded()
+        head, size = [], 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= min_size:
+                break
+        else:
+            # the whole body fit under the threshold
+            close(source)
+            response.set_data(b''.join(head))
+            return response
+        response.response = compress_stream(head, chunks, source, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        compressor = compressor_for(encoding, level)
+        response.set_data(compressor.compress(data) + compressor.flush())
+
+    response.headers['Content-Encoding'] = encoding
+    # the compressed bytes differ, so a strong validator no longer holds
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+def compress_stream(head, chunks, source, encoding, level):
+    """ Yields the compressed stream, flushing after every chunk
+
+    A sync flush per chunk lets the client parse each batch of a list
+    as soon as it is sent, at the cost of a few bytes per chunk
+    """
+    compressor = compressor_for(encoding, level)
+    try:
+        for chunk in chain(head, chunks):
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        close(source)
+
+def compressor_for(encoding, level):
+    return zlib.compressobj(level, zlib.DEFLATED, dict(ENCODINGS)[encoding])
+
+def close(iterable):
+    """ Closes the original body so a streamed request is torn down """
+    if hasattr(iterable, 'close'):
+        iterable.close()
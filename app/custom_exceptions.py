@@ -3,3 +3,7 @@
 ######################################################################
 class DataValidationError(ValueError):
     pass
+
+class WriteBehindError(Exception):
+    """ A create queued for write-behind could not be stored """
+    pass
@@ -5,12 +5,16 @@
 from flask import jsonify, make_response
 from flask_api import status    # HTTP Status Codes
 from server import app
-from custom_exceptions import DataValidationError
+from custom_exceptions import DataValidationError, WriteBehindError
 
 @app.errorhandler(DataValidationError)
 def request_validation_error(e):
     return make_response(jsonify(status=400, error='Bad Request', message=e.message), status.HTTP_400_BAD_REQUEST)
 
+@app.errorhandler(WriteBehindError)
+def write_behind_error(e):
+    return make_response(jsonify(status=503, error='Service Unavailable', message=e.message), status.HTTP_503_SERVICE_UNAVAILABLE)
+
 @app.errorhandler(404)
 def not_found(e):
     return make_response(jsonify(status=404, error='Not Found', message=e.description), status.HTTP_404_NOT_FOUND)
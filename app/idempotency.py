@@ -0,0 +1,63 @@
+######################################################################
+# Idempotency Keys
+#   Remembers the response to a request sent with an Idempotency-Key
+#   header so that a client retrying it gets the same response replayed
+#   instead of having the request carried out again.
+#
+#   idempotency:<scope>:<key> holds a JSON record: the fingerprint of the
+#   request that claimed the key and, once it has been answered, the
+#   response. A claim without a response expires after lock_ttl seconds
+#   so a worker dying mid request does not block the key for good.
+######################################################################
+
+import json
+import hashlib
+
+# Response headers worth replaying, the others are recomputed
+REPLAYED_HEADERS = ('Location', 'ETag', 'Content-Type')
+
+def fingerprint(method, path, body):
+    """ Identifies a request so a key reused for another one can be told apart """
+    return hashlib.sha1('{} {}\n{}'.format(method, path, body)).hexdigest()
+
+######################################################################
+# Records of idempotent requests kept in Redis
+######################################################################
+class IdempotencyStore(object):
+
+    KEY = 'idempotency:%s:%s'
+
+    def __init__(self, redis, ttl=86400, lock_ttl=60):
+        self.redis = redis
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+
+    def claim(self, scope, key, request_fingerprint):
+        """ Claims a key for a request, returns None if it was free or the record holding it
+
+        The claim and the read of the current record are one MULTI/EXEC
+        round trip
+        """
+        name = self.KEY % (scope, key)
+        pipe = self.redis.pipeline()
+        pipe.set(name, json.dumps({'fingerprint': request_fingerprint}), nx=True, ex=self.lock_ttl)
+        pipe.get(name)
+        claimed, record = pipe.execute()
+        if claimed:
+            return None
+        return json.loads(record)
+
+    def save(self, scope, key, request_fingerprint, response):
+        """ Stores the response to replay for the next ttl seconds """
+        headers = dict((name, response.headers[name]) for name in REPLAYED_HEADERS if name in response.headers)
+        record = {
+            'fingerprint': request_fingerprint,
+            'status': response.status_code,
+            'headers': headers,
+            'body': response.get_data().decode('utf-8')
+        }
+        self.redis.set(self.KEY % (scope, key), json.dumps(record), ex=self.ttl)
+
+    def release(self, scope, key):
+        """ Frees a key whose request failed so a retry carries it out """
+        self.redis.delete(self.KEY % (scope, key))
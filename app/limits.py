@@ -0,0 +1,108 @@
+######################################################################
+# Rate Limits and Load Shedding
+#   TokenBucketLimiter gives every client a token bucket per route,
+#   kept in Redis so all the workers share it. Each request takes a
+#   token in one atomic script call; a client whose bucket is empty is
+#   told how long to wait for the next one.
+#
+#   LoadShedder refuses requests outright while the worker is already
+#   serving too many at once or Redis answers too slowly, so the
+#   service degrades instead of queueing work it cannot finish.
+#
+#   Limits are written rate/burst: 20/40 refills 20 tokens a second
+#   into a bucket holding at most 40. A limit of 0 means unlimited.
+######################################################################
+
+import time
+import logging
+import threading
+from redis.exceptions import RedisError
+from scripts import ScriptRegistry
+
+logger = logging.getLogger(__name__)
+
+def parse_limit(limit):
+    """ Returns the (rate, burst) of a rate/burst limit, or None when unlimited
+
+    A limit without a burst gets a burst equal to its rate
+    """
+    rate, _, burst = str(limit).partition('/')
+    rate = float(rate)
+    burst = float(burst) if burst else rate
+    if rate < 0 or burst < 0:
+        raise ValueError('Invalid rate limit {}: rate and burst must not be negative'.format(limit))
+    if rate == 0:
+        return None
+    return rate, max(burst, 1)
+
+######################################################################
+# Token buckets per client and route, kept in Redis
+######################################################################
+class TokenBucketLimiter(object):
+
+    KEY = 'ratelimit:%s:%s'
+
+    def __init__(self, redis, default, limits=None, clock=time.time):
+        self.redis = redis
+        self.default = parse_limit(default)
+        self.limits = dict((route, parse_limit(limit)) for route, limit in (limits or {}).items())
+        self._clock = clock
+        self.scripts = ScriptRegistry(redis)
+
+    def limit_for(self, route):
+        return self.limits.get(route, self.default)
+
+    def take(self, route, client, cost=1):
+        """ Takes cost tokens from the client's bucket for route
+
+        Returns (allowed, remaining, retry_after) with retry_after in
+        whole seconds. If Redis cannot be reached the request is allowed:
+        the limiter should not turn a Redis outage into a full one.
+        """
+        limit = self.limit_for(route)
+        if limit is None:
+            return True, None, 0
+        rate, burst = limit
+        now = int(self._clock() * 1000)
+        try:
+            allowed, remaining, retry_ms = self.scripts.run('rate_limit', [self.KEY % (route, client)],
+                                                            [rate, burst, now, cost])
+        except RedisError as e:
+            logger.warning('Rate limit of %s not checked: %s', route, e)
+            return True, None, 0
+        return bool(allowed), remaining, int(-(-retry_ms // 1000))
+
+######################################################################
+# Load shedding on concurrency and Redis latency
+######################################################################
+class LoadShedder(object):
+    """ Counts the requests in flight and refuses new ones over the thresholds
+
+    max_in_flight is the most requests served at once by this worker,
+    max_latency the highest recent average Redis round trip in seconds
+    read from latency, a LatencyTracker. Either set to 0 is not checked.
+    """
+
+    def __init__(self, max_in_flight=0, max_latency=0, latency=None):
+        self.max_in_flight = max_in_flight
+        self.max_latency = max_latency
+        self.latency = latency
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """ Admits a request, returns None or the reason it is shed
+
+        An admitted request must call leave once it is done
+        """
+        if self.max_latency and self.latency and self.latency.average() > self.max_latency:
+            return 'redis_latency'
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return 'in_flight'
+            self.in_flight += 1
+        return None
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
@@ -14,22 +14,61 @@
 # limitations under the License.
 ######################################################################
 
+import re
 from flask import url_for
 from werkzeug.exceptions import NotFound
 from custom_exceptions import DataValidationError
+from cache import CLEAR_ALL
+from backends import StorageBackend, RedisBackend, MAX_AMOUNT, legacy_amount
+from encoders import stdlib
+
+# An amount sent as a string: ASCII digits only, since unicode digits such
+# as u'\xb2' pass isdigit() but not int()
+DIGITS = re.compile(r'[0-9]+\Z')
 
 ######################################################################
 # Order Model for database
-#   This class must be initialized with use_db(redis) before using
-#   where redis is a value connection to a Redis database
+#   This class must be initialized with use_db(db) before using where
+#   db is a valid connection to a Redis database or a StorageBackend
+#   such as MemoryBackend (see backends.py for the storage engines)
 ######################################################################
 class Order(object):
-    __redis = None
+    """ A customer's Order
+
+    amount_paid is a whole number of cents: 1999 means $19.99. It is sent
+    and returned as a JSON integer; strings of digits such as "1999" are
+    also accepted on input. It is stored in Redis as its decimal string.
+
+    version changes on every save and is never reused, even by another
+    Order, so it makes a strong ETag. It is 0 until the Order is saved.
+
+    With use_encoder(encoder, store_json=True) every save also stores the
+    Order's JSON without its id, as {"amount_paid":..,"customer_name":..}.
+    Reads splice the id onto it and send it as it is (see find_json and
+    iter_json); an empty blob means a later save did not store one.
+    """
+    __slots__ = ('id', 'customer_name', 'amount_paid', 'version')
+    __db = None
+    __cache = None
+    __invalidator = None
+    __encoder = staticmethod(stdlib)
+    __store_json = False
+    __write_behind = None
+
+    # Default number of orders fetched per round trip when listing
+    BATCH_SIZE = 500
+
+    # Largest amount_paid accepted, in cents
+    MAX_AMOUNT = MAX_AMOUNT
+
+    # Fields of an Order in the order they appear in a row tuple
+    FIELDS = ('id', 'customer_name', 'amount_paid')
 
     def __init__(self, id=0, customer_name=None, amount_paid=None):
         self.id = int(id)
         self.customer_name = customer_name
-        self.amount_paid = amount_paid
+        self.amount_paid = None if amount_paid is None else Order.parse_amount(amount_paid)
+        self.version = 0
 
     def self_url(self):
         return url_for('get_orders', id=self.id, _external=True)
@@ -37,61 +76,364 @@ class Order(object):
     def save(self):
         if self.customer_name == None:
             raise AttributeError('customer_name attribute is not set')
-        if self.id == 0:
-            self.id = self.__next_index()
-        Order.__redis.hmset(self.id, self.serialize())
+        if self.id == 0 and Order.__write_behind:
+            self.id, self.version = Order.__write_behind.submit(self.__record())
+        elif self.id == 0:
+            self.id, self.version = Order.__db.create(self.__record())
+        else:
+            fields = self.__record()
+            # drop a blob stored before, it no longer matches
+            fields.setdefault('json', '')
+            self.version = Order.__db.update(self.id, fields, Order.__channel())
+            Order.__invalidate(self.id)
 
     def delete(self):
-        Order.__redis.delete(self.id)
+        Order.__db.delete(self.id, Order.__channel())
+        Order.__invalidate(self.id)
+
+    @staticmethod
+    def save_many(orders):
+        """ Creates many new Orders at once
 
-    def __next_index(self):
-        return Order.__redis.incr('index')
+        A contiguous block of ids is reserved up front and the writes are
+        batched, BATCH_SIZE orders per round trip on Redis
+        """
+        for order in orders:
+            if order.customer_name == None:
+                raise AttributeError('customer_name attribute is not set')
+            if order.id != 0:
+                raise AttributeError('save_many only creates new orders')
+        if not orders:
+            return orders
+        first_id, first_version = Order.__db.create_many([order.__record() for order in orders])
+        for offset, order in enumerate(orders):
+            order.id = first_id + offset
+            order.version = first_version + offset
+        return orders
 
     def serialize(self):
         return { "id": self.id, "customer_name": self.customer_name, "amount_paid": self.amount_paid }
 
+    def to_json(self):
+        """ Returns the serialized Order as JSON, written by the encoder in use """
+        return Order.__encoder(self.serialize())
+
+    def __record(self):
+        """ Returns the fields to store, with the JSON blob when blobs are stored """
+        fields = self.serialize()
+        if Order.__store_json:
+            fields['json'] = Order.__encoder({"customer_name": self.customer_name, "amount_paid": self.amount_paid})
+        return fields
+
     def deserialize(self, data):
         try:
             self.customer_name = data['customer_name']
-            self.amount_paid = data['amount_paid']
+            if not isinstance(self.customer_name, basestring) or not self.customer_name:
+                raise DataValidationError('Invalid order: customer_name must be a non-empty string')
+            self.amount_paid = Order.parse_amount(data['amount_paid'])
         except KeyError as e:
             raise DataValidationError('Invalid order: missing ' + e.args[0])
         except TypeError as e:
             raise DataValidationError('Invalid order: body of request contained bad or no data')
         return self
 
+    @staticmethod
+    def __from_data(data):
+        """ Builds a stored Order, version included, from its record """
+        order = Order(data['id'], data['customer_name'])
+        # amounts stored by older versions may not be cents yet, see normalize_amounts
+        order.amount_paid = Order.amount_score(data.get('amount_paid'))
+        order.version = int(data.get('version') or 0)
+        return order
+
 ######################################################################
 #  S T A T I C   D A T A B S E   M E T H O D S
 ######################################################################
 
     @staticmethod
-    def use_db(redis):
-        Order.__redis = redis
+    def stats(customer_name=None):
+        """ Returns the count and total amount_paid of all Orders, or of one customer's
+
+        The figures are kept up to date by every write so this is O(1)
+        """
+        count, total = Order.__db.stats(customer_name)
+        return {'count': count, 'total_amount_paid': total}
+
+    @staticmethod
+    def rebuild_stats(batch_size=None):
+        """ Recomputes the stats from every stored Order in case they drifted
+
+        Writes made while the Orders are being read may be missed, so run
+        it when the service is quiet. Returns the rebuilt totals.
+        """
+        count, total, totals, counts = 0, 0, {}, {}
+        for order in Order.iter_all(batch_size):
+            amount = order.amount_paid or 0
+            count += 1
+            total += amount
+            totals[order.customer_name] = totals.get(order.customer_name, 0) + amount
+            counts[order.customer_name] = counts.get(order.customer_name, 0) + 1
+        Order.__db.replace_stats(count, total, totals, counts)
+        return Order.stats()
+
+    @staticmethod
+    def parse_amount(value):
+        """ Returns amount_paid as an int number of cents
+
+        Accepts ints, whole floats and strings of digits and raises a
+        DataValidationError for anything else, including negative amounts
+        and amounts over MAX_AMOUNT
+        """
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+            amount = value
+        elif isinstance(value, float) and value.is_integer():
+            amount = int(value)
+        elif isinstance(value, basestring) and DIGITS.match(value.strip()):
+            amount = int(value)
+        else:
+            raise DataValidationError('Invalid order: amount_paid must be a whole number of cents')
+        if amount < 0:
+            raise DataValidationError('Invalid order: amount_paid must not be negative')
+        if amount > Order.MAX_AMOUNT:
+            raise DataValidationError('Invalid order: amount_paid must be at most {}'.format(Order.MAX_AMOUNT))
+        return amount
+
+    @staticmethod
+    def amount_score(amount_paid):
+        """ Returns amount_paid as the score of the amount index, None if it is not valid
+
+        Also reads stored amounts, which older versions did not validate
+        """
+        try:
+            return Order.parse_amount(amount_paid)
+        except DataValidationError:
+            return None
+
+    @staticmethod
+    def use_db(db):
+        """ Selects where Orders are stored
+
+        db is either a StorageBackend or a Redis client, which is wrapped
+        in a RedisBackend
+        """
+        if db is not None and not isinstance(db, StorageBackend):
+            db = RedisBackend(db)
+        Order.__db = db
+
+    @staticmethod
+    def db():
+        """ Returns the StorageBackend in use """
+        return Order.__db
+
+    @staticmethod
+    def use_encoder(encoder, store_json=False):
+        """ Selects the function writing Orders as JSON on the hot paths
+
+        encoder takes a dict and returns compact JSON with sorted keys (see
+        encoders.py). With store_json every save also stores the JSON so
+        reads can send it without building an Order.
+        """
+        Order.__encoder = staticmethod(encoder)
+        Order.__store_json = store_json
+
+    @staticmethod
+    def use_write_behind(queue):
+        """ Queues new Orders on a WriteBehindQueue rather than writing each one
+
+        save() still returns with the id set, but the Order may only be
+        readable once its batch is flushed. None writes every create at once.
+        """
+        Order.__write_behind = queue
+
+    @staticmethod
+    def use_cache(cache, invalidator=None):
+        """ Puts a cache in front of find(), None turns caching off
+
+        The invalidator, when given, publishes every write so the caches
+        of the other worker processes drop their copies too
+        """
+        Order.__cache = cache
+        Order.__invalidator = invalidator
+
+    @staticmethod
+    def __invalidate(id):
+        """ Drops our cached copy, the write script told the other workers """
+        if Order.__cache:
+            Order.__cache.invalidate(int(id))
+
+    @staticmethod
+    def __channel():
+        return Order.__invalidator.channel if Order.__invalidator else ''
 
     @staticmethod
     def remove_all():
-        Order.__redis.flushall()
+        """ Deletes every Order, leaving other services' data alone """
+        Order.__db.remove_all()
+        if Order.__write_behind:
+            Order.__write_behind.forget_reserved()
+        Order.__invalidate_all()
+
+    @staticmethod
+    def __invalidate_all():
+        if Order.__cache:
+            Order.__cache.clear()
+        if Order.__invalidator:
+            Order.__invalidator.publish(CLEAR_ALL)
 
     @staticmethod
     def all():
-        # results = [Order.from_dict(redis.hgetall(key)) for key in redis.keys() if key != 'index']
-        results = []
-        for key in Order.__redis.keys():
-            if key != 'index':  # filer out our id index
-                data = Order.__redis.hgetall(key)
-                order = Order(data['id']).deserialize(data)
-                results.append(order)
-        return results
+        return list(Order.iter_all())
+
+    @staticmethod
+    def iter_all(batch_size=None):
+        """ Streams every Order by walking the ids in order
+
+        Each batch of ids is fetched with a single pipelined round trip
+        of HGETALLs and the Orders are yielded as they arrive
+        """
+        batch_size = batch_size or Order.BATCH_SIZE
+        after_id = 0
+        while after_id is not None:
+            ids, after_id = Order.page_ids(after_id, batch_size)
+            for order in Order.__fetch_all(ids):
+                yield order
+
+    @staticmethod
+    def page_ids(after_id=0, limit=None):
+        """ Returns the ids of the next page of up to limit Orders after after_id
+
+        The id to resume the next page from is returned alongside the ids,
+        or None when this is the last page. Only the ids of the page (plus
+        one to detect the end) are read so a page costs O(limit).
+        """
+        return Order.__db.page_ids(after_id, limit or Order.BATCH_SIZE)
+
+    @staticmethod
+    def page_ids_by_amount(min_amount='-inf', max_amount='+inf', after=None, limit=None):
+        """ Returns the ids of the next page of Orders with amount_paid in a range
+
+        Orders come in amount order and after is the position returned
+        with the previous page: the amount it ended on and how many Orders
+        with that amount were already returned. Each page costs
+        O(log N + limit) however large the table is.
+        """
+        return Order.__db.page_ids_by_amount(min_amount, max_amount, after, limit or Order.BATCH_SIZE)
+
+    @staticmethod
+    def iter_rows(ids, batch_size=None):
+        """ Yields the Orders with these ids as lists of up to batch_size row tuples
+
+        Rows are (id, customer_name, amount_paid) tuples read with HMGET,
+        a lighter path than building an Order per row when all the
+        caller does is write them out. Every list costs one pipelined
+        round trip so large result sets can be streamed.
+        """
+        batch_size = batch_size or Order.BATCH_SIZE
+        for start in range(0, len(ids), batch_size):
+            yield Order.__db.get_rows(ids[start:start + batch_size])
+
+    @staticmethod
+    def row_dict(row):
+        """ Returns the serialized form of a row tuple """
+        return dict(zip(Order.FIELDS, row))
+
+    @staticmethod
+    def iter_json(ids, batch_size=None):
+        """ Yields the Orders with these ids as lists of up to batch_size JSON strings
+
+        Stored JSON blobs are spliced as they are and only Orders without
+        one are encoded, so no Order is built. Every list costs one
+        pipelined round trip.
+        """
+        batch_size = batch_size or Order.BATCH_SIZE
+        for start in range(0, len(ids), batch_size):
+            yield [Order.__json(blob, row) for row, blob in Order.__db.get_json_rows(ids[start:start + batch_size])]
+
+    @staticmethod
+    def __json(blob, row):
+        """ Returns the JSON of an Order from its stored blob, or from its row when it has none """
+        if blob:
+            return '%s,"id":%d}' % (blob[:-1], row[0])
+        return Order.__encoder(Order.row_dict(row))
+
+    @staticmethod
+    def __fetch_all(ids):
+        """ Fetches the Orders with these ids in one pipelined round trip """
+        return [order for order in Order.find_many(ids) if order]
 
     @staticmethod
     def find(id):
-        if Order.__redis.exists(id):
-            data = Order.__redis.hgetall(id)
-            order = Order(data['id']).deserialize(data)
-            return order
+        data = Order.__find_data(id)
+        if data:
+            return Order.__from_data(data)
         else:
             return None
 
+    @staticmethod
+    def __find_data(id):
+        """ Returns the stored record of an Order, through the cache """
+        cache = Order.__live_cache()
+        if not cache:
+            return Order.__db.get(id)
+        data = cache.get(int(id))
+        if data is None:
+            # taken before the read so an invalidation arriving meanwhile keeps it out of the cache
+            epoch = cache.epoch()
+            data = Order.__db.get(id)
+            if data:
+                cache.set(int(id), data, epoch)
+        return data
+
+    @staticmethod
+    def __live_cache():
+        """ Returns the cache, or None while the invalidations of other workers cannot reach it """
+        if Order.__invalidator and not Order.__invalidator.healthy:
+            return None
+        return Order.__cache
+
+    @staticmethod
+    def find_json(id):
+        """ Returns the JSON of an Order and its version, (None, None) if it does not exist
+
+        The stored blob is sent as it is when there is one, so no Order
+        is built
+        """
+        data = Order.__find_data(id)
+        if not data:
+            return None, None
+        row = (int(data['id']), data['customer_name'], Order.amount_score(data.get('amount_paid')))
+        return Order.__json(data.get('json'), row), int(data.get('version') or 0)
+
+    @staticmethod
+    def find_json_or_404(id):
+        body, version = Order.find_json(id)
+        if body is None:
+            raise NotFound("Order with id '{}' was not found.".format(id))
+        return body, version
+
+    @staticmethod
+    def find_version(id):
+        """ Returns the version of an Order without reading its fields, None if it does not exist """
+        cache = Order.__live_cache()
+        data = cache.get(int(id)) if cache else None
+        if data is not None:
+            return int(data.get('version') or 0)
+        return Order.__db.version(id)
+
+    @staticmethod
+    def generation():
+        """ Returns a number that changes whenever any Order is written """
+        return Order.__db.generation()
+
+    @staticmethod
+    def find_many(ids):
+        """ Finds any number of Orders with a single pipelined round trip
+
+        Returns a list lined up with ids holding None for every id
+        that was not found
+        """
+        return [Order.__from_data(data) if data else None for data in Order.__db.get_many(ids)]
+
     @staticmethod
     def find_or_404(id):
         order = Order.find(id)
@@ -101,11 +443,43 @@ class Order(object):
 
     @staticmethod
     def find_by_customer_name(customer_name):
-        # return [order for order in Order.__data if order.amount_paid == amount_paid]
-        results = []
-        for key in Order.__redis.keys():
-            if key != 'index':  # filer out our id index
-                data = Order.__redis.hgetall(key)
-                if data['customer_name'] == customer_name:
-                    results.append(Order(data['id']).deserialize(data))
-        return results
+        return Order.__fetch_all(Order.customer_ids(customer_name))
+
+    @staticmethod
+    def customer_ids(customer_name):
+        """ Returns the ids of every Order placed by a customer in id order """
+        return Order.__db.customer_ids(customer_name)
+
+    @staticmethod
+    def migrate_legacy_keys(batch_size=None):
+        """ Rewrites Orders stored under bare integer keys into the order: namespace
+
+        Only Redis has legacy data to move, other backends migrate nothing.
+        Returns the number of Orders migrated.
+        """
+        return Order.__db.migrate_legacy_keys(batch_size or Order.BATCH_SIZE)
+
+    @staticmethod
+    def normalize_amounts(batch_size=None):
+        """ Converts the amounts of stored Orders that are not whole cents yet
+
+        Amounts were free text in dollars before they became cents, so
+        "12.50" is rewritten as 1250 (see legacy_amount). Amounts that are
+        already whole numbers cannot be told apart from cents and are left
+        alone. Returns the number of Orders rewritten.
+        """
+        normalized = 0
+        batch_size = batch_size or Order.BATCH_SIZE
+        after_id = 0
+        while after_id is not None:
+            ids, after_id = Order.page_ids(after_id, batch_size)
+            for data in Order.__db.get_many(ids):
+                if not data or data.get('amount_paid') == '' or Order.amount_score(data.get('amount_paid')) is not None:
+                    continue
+                fields = legacy_amount(data)
+                fields.pop('version', None)
+                fields['json'] = ''
+                Order.__db.update(int(data['id']), fields, Order.__channel())
+                Order.__invalidate(int(data['id']))
+                normalized += 1
+        return normalized
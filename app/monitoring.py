@@ -0,0 +1,386 @@
+######################################################################
+# Monitoring
+#   Request and Redis metrics exposed at /metrics in the Prometheus
+#   text format.
+#
+#   Each worker process adds up its samples in memory, which costs a
+#   few dict updates per request. Every flush_interval seconds the
+#   deltas are added to one Redis hash with HINCRBYFLOAT, so the hash
+#   holds the totals of every worker and any of them can serve
+#   /metrics. Without Redis the totals stay in the process.
+#
+#   Gauges cannot be added up that way: the deltas of a worker killed
+#   mid-request would stay in the hash forever. Each worker writes its
+#   gauges to a hash of its own instead, which expires unless the next
+#   flush comes soon enough, and /metrics adds up the live ones.
+#
+#   Separately, the Redis traffic of a single request can be accounted
+#   for (commands, round trips and bytes) so it can be reported back in
+#   response headers.
+######################################################################
+
+import os
+import re
+import math
+import time
+import socket
+import threading
+from redis import Redis
+from redis.client import Pipeline
+from redis.connection import Connection
+from redis.exceptions import RedisError
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: (type, help) of every metric family that is reported
+FAMILIES = {
+    'http_requests_total': ('counter', 'HTTP requests handled, by route, method and status'),
+    'http_request_duration_seconds': ('histogram', 'Time spent handling HTTP requests'),
+    'http_requests_in_flight': ('gauge', 'HTTP requests being handled right now'),
+    'idempotent_requests_total': ('counter', 'Requests sent with an Idempotency-Key, by route and outcome'),
+    'http_requests_rate_limited_total': ('counter', 'Requests refused with 429 by the token bucket of their route'),
+    'http_requests_shed_total': ('counter', 'Requests refused with 503 to shed load, by reason'),
+    'redis_commands_total': ('counter', 'Redis commands sent, pipelined commands included'),
+    'redis_command_duration_seconds': ('histogram', 'Redis round trip time, a pipeline counts as one PIPELINE call')
+}
+
+LE_PATTERN = re.compile(r',?le="([^"]*)"')
+
+######################################################################
+# Registry of samples
+######################################################################
+class Metrics(object):
+    """ Counters and histograms shared by every worker, and gauges kept per worker
+
+    The gauges of a worker expire gauge_ttl seconds after its last flush,
+    three flush intervals by default.
+    """
+
+    def __init__(self, redis=None, key='metrics:samples', flush_interval=5.0, clock=time.time, gauge_ttl=None):
+        self.redis = redis
+        self.key = key
+        self.flush_interval = flush_interval
+        self.gauge_ttl = gauge_ttl or flush_interval * 3
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._deltas = {}
+        self._gauges = {}
+        self._totals = {}
+        self._names = {}
+        self._histograms = {}
+        self._last_flush = clock()
+
+    def use_redis(self, redis):
+        """ Starts sharing totals through redis, None keeps them in this process """
+        self.flush()
+        self.redis = redis
+
+    def inc(self, name, labels, value=1):
+        field = self._field(name, labels)
+        with self._lock:
+            self._deltas[field] = self._deltas.get(field, 0) + value
+
+    def add_gauge(self, name, labels, value):
+        """ Moves a gauge of this worker by value """
+        field = self._field(name, labels)
+        with self._lock:
+            self._gauges[field] = self._gauges.get(field, 0) + value
+
+    def gauge_key(self):
+        """ Returns the Redis hash holding the gauges of this worker process """
+        return '%s:worker:%s:%d:%x' % (self.key, socket.gethostname(), os.getpid(), id(self))
+
+    def observe(self, name, labels, seconds):
+        """ Records one histogram observation with cumulative buckets """
+        buckets, total, count = self._histogram_fields(name, labels)
+        with self._lock:
+            deltas = self._deltas
+            # every bucket is written, even with 0, so none is missing from /metrics
+            for bound, field in buckets:
+                deltas[field] = deltas.get(field, 0) + (seconds <= bound)
+            deltas[total] = deltas.get(total, 0) + seconds
+            deltas[count] = deltas.get(count, 0) + 1
+
+    def _field(self, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        field = self._names.get(key)
+        if field is None:
+            field = self._names[key] = name + format_labels(labels)
+        return field
+
+    def _histogram_fields(self, name, labels):
+        """ Returns the sample names of a histogram, built once per label set """
+        key = (name, tuple(sorted(labels.items())))
+        fields = self._histograms.get(key)
+        if fields is None:
+            buckets = [(bound, name + '_bucket' + format_labels(labels, le=repr(bound))) for bound in BUCKETS]
+            buckets.append((float('inf'), name + '_bucket' + format_labels(labels, le='+Inf')))
+            fields = self._histograms[key] = (buckets, name + '_sum' + format_labels(labels),
+                                              name + '_count' + format_labels(labels))
+        return fields
+
+    def maybe_flush(self):
+        """ Flushes when flush_interval has passed since the last flush """
+        if self._clock() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+            gauges = dict(self._gauges)
+            self._last_flush = self._clock()
+            if not self.redis:
+                for field, value in deltas.items():
+                    self._totals[field] = self._totals.get(field, 0) + value
+                return
+        if deltas or gauges:
+            # plain Pipeline so flushing is not counted as a Redis command
+            pipe = Pipeline(self.redis.connection_pool, self.redis.response_callbacks, False, None)
+            for field, value in deltas.items():
+                pipe.hincrbyfloat(self.key, field, value)
+            if gauges:
+                pipe.hset(self.gauge_key(), mapping=gauges)
+                pipe.expire(self.gauge_key(), int(math.ceil(self.gauge_ttl)))
+            try:
+                pipe.execute()
+            except RedisError:
+                # keep the deltas for the next flush rather than fail the request
+                with self._lock:
+                    for field, value in deltas.items():
+                        self._deltas[field] = self._deltas.get(field, 0) + value
+
+    def samples(self):
+        """ Returns the totals of every worker as a dict of sample: value
+
+        Gauges are summed over the workers whose gauges have not expired
+        """
+        self.flush()
+        if not self.redis:
+            with self._lock:
+                samples = dict(self._totals)
+                samples.update(self._gauges)
+                return samples
+        samples = dict((field, float(value)) for field, value in self.redis.hgetall(self.key).items())
+        workers = list(self.redis.scan_iter(match=self.key + ':worker:*'))
+        if workers:
+            pipe = Pipeline(self.redis.connection_pool, self.redis.response_callbacks, False, None)
+            for worker in workers:
+                pipe.hgetall(worker)
+            for gauges in pipe.execute():
+                for field, value in gauges.items():
+                    samples[field] = samples.get(field, 0) + float(value)
+        return samples
+
+    def render(self):
+        """ Returns every sample in the Prometheus text exposition format """
+        families = {}
+        for field, value in self.samples().items():
+            families.setdefault(family_of(field), []).append((sort_key(field), field, value))
+        lines = []
+        for family in sorted(families):
+            if family in FAMILIES:
+                kind, text = FAMILIES[family]
+                lines.append('# HELP %s %s' % (family, text))
+                lines.append('# TYPE %s %s' % (family, kind))
+            for key, field, value in sorted(families[family]):
+                lines.append('%s %s' % (field, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._deltas = {}
+            self._totals = {}
+            self._gauges = {}
+        if self.redis:
+            self.redis.delete(self.key, *self.redis.scan_iter(match=self.key + ':worker:*'))
+
+######################################################################
+# Redis client that times every command
+######################################################################
+class MeteredRedis(Redis):
+    """ A Redis client reporting its command counts and latency to a Metrics
+
+    and, when given one, every round trip time to a LatencyTracker
+    """
+
+    def __init__(self, metrics=None, latency=None, **kwargs):
+        super(MeteredRedis, self).__init__(**kwargs)
+        self.metrics = metrics
+        self.latency = latency
+
+    def execute_command(self, *args, **options):
+        account = current_redis_account()
+        if account is not None:
+            account.commands += 1
+            account.round_trips += 1
+        start = time.time()
+        try:
+            return super(MeteredRedis, self).execute_command(*args, **options)
+        finally:
+            if self.latency:
+                self.latency.observe(time.time() - start)
+            if self.metrics:
+                labels = {'command': args[0]}
+                self.metrics.inc('redis_commands_total', labels)
+                self.metrics.observe('redis_command_duration_seconds', labels, time.time() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = MeteredPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.metrics = self.metrics
+        pipe.latency = self.latency
+        return pipe
+
+
+class MeteredPipeline(Pipeline):
+
+    metrics = None
+    latency = None
+
+    def execute(self, raise_on_error=True):
+        commands = [args[0] for args, options in self.command_stack]
+        account = current_redis_account()
+        if account is not None and commands:
+            account.commands += len(commands)
+            account.round_trips += 1
+        start = time.time()
+        try:
+            return super(MeteredPipeline, self).execute(raise_on_error)
+        finally:
+            if self.latency and commands:
+                self.latency.observe(time.time() - start)
+            if self.metrics and commands:
+                for command in commands:
+                    self.metrics.inc('redis_commands_total', {'command': command})
+                self.metrics.observe('redis_command_duration_seconds', {'command': 'PIPELINE'}, time.time() - start)
+
+######################################################################
+# Recent Redis latency
+######################################################################
+class LatencyTracker(object):
+    """ An exponentially weighted average of recent round trip times
+
+    Older samples fade with a time constant of tau seconds. The average
+    also fades while no samples come in, so a worker that stopped
+    calling Redis because it was slow tries again after a while.
+    """
+
+    def __init__(self, tau=1.0, clock=time.time):
+        self.tau = tau
+        self._clock = clock
+        self._average = 0.0
+        self._updated = clock()
+
+    def observe(self, seconds):
+        now = self._clock()
+        weight = math.exp(-max(0.0, now - self._updated) / self.tau)
+        self._average = self._average * weight + seconds * (1 - weight)
+        self._updated = now
+
+    def average(self):
+        """ Returns the average round trip in seconds, faded by the time since the last one """
+        return self._average * math.exp(-max(0.0, self._clock() - self._updated) / self.tau)
+
+######################################################################
+# Per request accounting of Redis traffic
+######################################################################
+class RedisAccount(object):
+    """ The Redis traffic of one request, bytes are counted by CountingConnection """
+    __slots__ = ('commands', 'round_trips', 'bytes_sent', 'bytes_received')
+
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def headers(self):
+        return {
+            'X-Redis-Calls': str(self.commands),
+            'X-Redis-Round-Trips': str(self.round_trips),
+            'X-Redis-Bytes-Sent': str(self.bytes_sent),
+            'X-Redis-Bytes-Received': str(self.bytes_received)
+        }
+
+_accounts = threading.local()
+
+def start_redis_account():
+    """ Starts counting the Redis traffic of the current thread """
+    _accounts.current = RedisAccount()
+    return _accounts.current
+
+def stop_redis_account():
+    """ Stops counting and returns what was counted, None if nothing was """
+    account = current_redis_account()
+    _accounts.current = None
+    return account
+
+def current_redis_account():
+    return getattr(_accounts, 'current', None)
+
+
+class CountingConnection(Connection):
+    """ A connection adding the bytes it moves to the current RedisAccount
+
+    Sent bytes are the exact RESP bytes written. Received bytes are the
+    size of the reply payload (strings, numbers and array elements)
+    without the protocol framing, as the parser does not expose it.
+    """
+
+    def send_packed_command(self, command, check_health=True):
+        account = current_redis_account()
+        if account is not None:
+            if isinstance(command, basestring):
+                account.bytes_sent += len(command)
+            else:
+                account.bytes_sent += sum(len(chunk) for chunk in command)
+        return super(CountingConnection, self).send_packed_command(command, check_health)
+
+    def read_response(self):
+        response = super(CountingConnection, self).read_response()
+        account = current_redis_account()
+        if account is not None:
+            account.bytes_received += payload_size(response)
+        return response
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def format_labels(labels, **extra):
+    """ Returns labels as {a="1",b="2"} with the values escaped """
+    items = sorted(labels.items()) + extra.items()
+    if not items:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, escape(value)) for name, value in items) + '}'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def family_of(field):
+    name = field.split('{', 1)[0]
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in FAMILIES:
+            return name[:-len(suffix)]
+    return name
+
+def sort_key(field):
+    """ Orders histogram buckets by their bound instead of as text """
+    match = LE_PATTERN.search(field)
+    if not match:
+        return (field, 0)
+    return (LE_PATTERN.sub('', field), float(match.group(1)))
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+def payload_size(response):
+    """ Returns the bytes of data in a parsed Redis reply """
+    if isinstance(response, basestring):
+        return len(response)
+    if isinstance(response, (list, tuple)):
+        return sum(payload_size(item) for item in response)
+    if isinstance(response, (int, long)):
+        return len(str(response))
+    return 0
@@ -0,0 +1,97 @@
+######################################################################
+# Redis Connection Pools
+#   Thin subclasses of the redis-py pools that keep live usage stats
+#   so the pool can be sized for many threaded workers sharing one
+#   Redis instance
+######################################################################
+
+import threading
+import time
+from redis import ConnectionPool, BlockingConnectionPool, Connection
+from redis.exceptions import ConnectionError
+
+######################################################################
+# Pool that raises as soon as max_connections are checked out
+######################################################################
+class InstrumentedConnectionPool(ConnectionPool):
+    """ Callers never wait here, so instead of waits it counts the refusals """
+
+    def reset(self):
+        super(InstrumentedConnectionPool, self).reset()
+        self._stats_lock = threading.Lock()
+        self.exhausted = 0
+
+    def make_connection(self):
+        try:
+            return super(InstrumentedConnectionPool, self).make_connection()
+        except ConnectionError:
+            # Too many connections: every one of them is checked out
+            with self._stats_lock:
+                self.exhausted += 1
+            raise
+
+    def stats(self):
+        return {
+            'blocking': False,
+            'max_connections': self.max_connections,
+            'created': self._created_connections,
+            'in_use': len(self._in_use_connections),
+            'idle': len(self._available_connections),
+            'exhausted': self.exhausted
+        }
+
+######################################################################
+# Pool that waits up to timeout seconds for a connection to be freed
+######################################################################
+class InstrumentedBlockingConnectionPool(BlockingConnectionPool):
+
+    def reset(self):
+        super(InstrumentedBlockingConnectionPool, self).reset()
+        self._stats_lock = threading.Lock()
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        # the queue only runs dry once every connection is checked out
+        if not self.pool.empty():
+            return super(InstrumentedBlockingConnectionPool, self).get_connection(command_name, *keys, **options)
+        start = time.time()
+        try:
+            return super(InstrumentedBlockingConnectionPool, self).get_connection(command_name, *keys, **options)
+        except ConnectionError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self.waits += 1
+                self.wait_seconds += time.time() - start
+
+    def stats(self):
+        idle = len([connection for connection in list(self.pool.queue) if connection is not None])
+        return {
+            'blocking': True,
+            'max_connections': self.max_connections,
+            'created': len(self._connections),
+            'in_use': len(self._connections) - idle,
+            'idle': idle,
+            'waits': self.waits,
+            'wait_seconds': self.wait_seconds,
+            'timeouts': self.timeouts
+        }
+
+######################################################################
+# Factory used by the server to build the configured pool
+######################################################################
+def create_pool(host, port, password, max_connections=50, blocking=True, timeout=None,
+                socket_keepalive=False, health_check_interval=0, connection_class=Connection):
+    """ Returns a connection pool configured from the service settings """
+    options = dict(host=host, port=port, password=password,
+                   connection_class=connection_class,
+                   max_connections=max_connections,
+                   socket_keepalive=socket_keepalive,
+                   health_check_interval=health_check_interval)
+    if blocking:
+        return InstrumentedBlockingConnectionPool(timeout=timeout, **options)
+    return InstrumentedConnectionPool(**options)
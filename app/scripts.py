@@ -0,0 +1,232 @@
+######################################################################
+# Lua Scripts
+#   Server-side scripts that make each Order write a single atomic
+#   round trip: the id allocation, the hash and every index change
+#   happen together or not at all
+#
+#   Single-node Redis only. CREATE, UPDATE and DELETE build some keys
+#   inside the script: the hash of the id CREATE allocates
+#   (ARGV[1] .. id) and the index of the customer an Order is moved
+#   away from (ARGV[2] .. old[1]). Those keys are only known once the
+#   script has read Redis, so they cannot be declared in KEYS. Redis
+#   Cluster would also need every key in one hash slot. WRITE_MANY and
+#   RATE_LIMIT do declare every key they touch.
+######################################################################
+
+from redis.exceptions import NoScriptError
+
+# Largest amount_paid in cents, just under $10 billion. Every amount up to
+# it is exact as a sorted set score, and the HINCRBY totals have room for
+# millions of Orders that large
+MAX_AMOUNT = 10 ** 12 - 1
+
+######################################################################
+# HELPERS shared by every write script
+#   The last three KEYS of a write are always the order stats hash,
+#   the per customer totals hash and the per customer counts hash
+######################################################################
+HELPERS = """
+local function amount_of(value)
+    local amount = tonumber(value)
+    if amount and amount >= 0 and amount <= %d and math.floor(amount) == amount then
+        return amount
+    end
+end
+
+local function tally(name, amount, sign)
+    local stats, totals, counts = KEYS[#KEYS - 2], KEYS[#KEYS - 1], KEYS[#KEYS]
+    -- 0 * -1 is -0, which HINCRBY rejects as not an integer
+    amount = (amount or 0) * sign
+    if amount == 0 then amount = 0 end
+    redis.call('HINCRBY', stats, 'count', sign)
+    redis.call('HINCRBY', stats, 'total', amount)
+    redis.call('HINCRBY', totals, name, amount)
+    if redis.call('HINCRBY', counts, name, sign) <= 0 then
+        redis.call('HDEL', counts, name)
+        redis.call('HDEL', totals, name)
+    end
+end
+""" % MAX_AMOUNT
+
+######################################################################
+# CREATE
+#   KEYS[1] id counter   KEYS[2] id registry   KEYS[3] customer index
+#   KEYS[4] amount index   KEYS[5] generation   KEYS[6..8] stats
+#   ARGV[1] order key prefix   ARGV[2..] field, value pairs of the
+#   Order without its id, which is allocated here
+#   Returns the id and the version of the new Order
+######################################################################
+CREATE = HELPERS + """
+local id = redis.call('INCR', KEYS[1])
+local version = redis.call('INCR', KEYS[5])
+local key = ARGV[1] .. id
+local fields = {}
+for i = 2, #ARGV, 2 do fields[ARGV[i]] = ARGV[i + 1] end
+redis.call('HMSET', key, 'id', id, 'version', version)
+redis.call('HMSET', key, unpack(ARGV, 2))
+redis.call('ZADD', KEYS[2], id, id)
+redis.call('SADD', KEYS[3], id)
+local amount = amount_of(fields['amount_paid'])
+if amount then redis.call('ZADD', KEYS[4], amount, id) end
+tally(fields['customer_name'], amount, 1)
+return {id, version}
+"""
+
+######################################################################
+# UPDATE
+#   KEYS[1] order hash   KEYS[2] id registry   KEYS[3] customer index
+#   KEYS[4] amount index   KEYS[5] generation   KEYS[6..8] stats
+#   ARGV[1] order id   ARGV[2] customer index prefix
+#   ARGV[3] invalidation channel   ARGV[4..] field, value pairs
+#   Returns the new version of the Order
+######################################################################
+UPDATE = HELPERS + """
+local id = ARGV[1]
+local fields = {}
+for i = 4, #ARGV, 2 do fields[ARGV[i]] = ARGV[i + 1] end
+local old = redis.call('HMGET', KEYS[1], 'customer_name', 'amount_paid')
+if old[1] then
+    if old[1] ~= fields['customer_name'] then
+        redis.call('SREM', ARGV[2] .. old[1], id)
+    end
+    tally(old[1], amount_of(old[2]), -1)
+end
+local version = redis.call('INCR', KEYS[5])
+redis.call('HMSET', KEYS[1], 'version', version, unpack(ARGV, 4))
+redis.call('ZADD', KEYS[2], id, id)
+redis.call('SADD', KEYS[3], id)
+local amount = amount_of(fields['amount_paid'])
+if amount then
+    redis.call('ZADD', KEYS[4], amount, id)
+else
+    redis.call('ZREM', KEYS[4], id)
+end
+tally(fields['customer_name'], amount, 1)
+if ARGV[3] ~= '' then redis.call('PUBLISH', ARGV[3], id) end
+return version
+"""
+
+######################################################################
+# DELETE
+#   KEYS[1] order hash   KEYS[2] id registry   KEYS[3] amount index
+#   KEYS[4] generation   KEYS[5..7] stats
+#   ARGV[1] order id   ARGV[2] customer index prefix
+#   ARGV[3] invalidation channel
+######################################################################
+DELETE = HELPERS + """
+local id = ARGV[1]
+local old = redis.call('HMGET', KEYS[1], 'customer_name', 'amount_paid')
+if not old[1] then return 0 end
+redis.call('SREM', ARGV[2] .. old[1], id)
+redis.call('ZREM', KEYS[2], id)
+redis.call('ZREM', KEYS[3], id)
+redis.call('DEL', KEYS[1])
+redis.call('INCR', KEYS[4])
+tally(old[1], amount_of(old[2]), -1)
+if ARGV[3] ~= '' then redis.call('PUBLISH', ARGV[3], id) end
+return 1
+"""
+
+######################################################################
+# WRITE MANY
+#   Stores a batch of new Orders whose ids and versions were reserved
+#   KEYS[1] id registry   KEYS[2] amount index   KEYS[3] generation
+#   KEYS[4..] the order hash and customer index of every Order in turn
+#   KEYS[#KEYS - 2..] stats
+#   ARGV per Order: id, version, number of field, value pairs, pairs
+#   Every Order is checked before the first write so a bad one fails
+#   the batch without touching anything. An Order whose hash already
+#   exists was written by an earlier attempt and is skipped, so the
+#   batch can be retried. Returns the number of Orders written.
+######################################################################
+WRITE_MANY = HELPERS + """
+local orders = {}
+local i = 1
+while i <= #ARGV do
+    local n = tonumber(ARGV[i + 2])
+    local fields = {}
+    for j = i + 3, i + 2 + n * 2, 2 do fields[ARGV[j]] = ARGV[j + 1] end
+    if not fields['customer_name'] then
+        return redis.error_reply('order ' .. ARGV[i] .. ' has no customer_name')
+    end
+    local amount = fields['amount_paid']
+    if amount and amount ~= '' and not amount_of(amount) then
+        return redis.error_reply('order ' .. ARGV[i] .. ' has an invalid amount_paid')
+    end
+    table.insert(orders, {ARGV[i], ARGV[i + 1], fields, i + 3, i + 2 + n * 2})
+    i = i + 3 + n * 2
+end
+local written = 0
+for k, order in ipairs(orders) do
+    local id, version, fields = order[1], order[2], order[3]
+    local key, customer = KEYS[2 + k * 2], KEYS[3 + k * 2]
+    if redis.call('EXISTS', key) == 0 then
+        redis.call('HMSET', key, 'id', id, 'version', version, unpack(ARGV, order[4], order[5]))
+        redis.call('ZADD', KEYS[1], id, id)
+        redis.call('SADD', customer, id)
+        local amount = amount_of(fields['amount_paid'])
+        if amount then redis.call('ZADD', KEYS[2], amount, id) end
+        tally(fields['customer_name'], amount, 1)
+        written = written + 1
+    end
+end
+redis.call('INCR', KEYS[3])
+return written
+"""
+
+######################################################################
+# RATE LIMIT
+#   A token bucket: tokens refill at ARGV[1] per second up to ARGV[2]
+#   and a request takes ARGV[4] of them
+#   KEYS[1] bucket hash of tokens left and when they were counted
+#   ARGV[3] the caller's clock in milliseconds; a clock behind the
+#   last one counted adds no tokens
+#   Returns 1 or 0 for allowed, the whole tokens left and, when not
+#   allowed, the milliseconds until enough have refilled
+######################################################################
+RATE_LIMIT = """
+local rate, burst, now, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local allowed, retry = 0, 0
+if tokens >= cost then
+    allowed = 1
+    tokens = tokens - cost
+else
+    retry = math.ceil((cost - tokens) * 1000 / rate)
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', math.max(now, ts))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return {allowed, math.floor(tokens), retry}
+"""
+
+######################################################################
+# Registry of preloaded scripts
+######################################################################
+class ScriptRegistry(object):
+    """ Loads every script once and runs them by SHA with EVALSHA
+
+    If Redis has lost a script (a restart or SCRIPT FLUSH) it is loaded
+    again and the call retried transparently
+    """
+
+    SCRIPTS = {'create': CREATE, 'update': UPDATE, 'delete': DELETE, 'write_many': WRITE_MANY,
+               'rate_limit': RATE_LIMIT}
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.shas = {}
+        for name in self.SCRIPTS:
+            self.load(name)
+
+    def load(self, name):
+        self.shas[name] = self.redis.script_load(self.SCRIPTS[name])
+        return self.shas[name]
+
+    def run(self, name, keys=(), args=()):
+        try:
+            return self.redis.evalsha(self.shas[name], len(keys), *(list(keys) + list(args)))
+        except NoScriptError:
+            return self.redis.evalsha(self.load(name), len(keys), *(list(keys) + list(args)))
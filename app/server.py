@@ -15,20 +15,143 @@
 ######################################################################
 
 import os
+import re
+import math
+import base64
+import hashlib
 import logging
+from collections import OrderedDict
+from functools import wraps
 from redis import Redis
 from redis.exceptions import ConnectionError
-from flask import Flask, Response, jsonify, request, json, url_for, make_response
+from flask import Flask, Response, jsonify, request, json, url_for, make_response, stream_with_context, g
 from flask_api import status    # HTTP Status Codes
 from werkzeug.exceptions import NotFound
 from models import Order
-from . import app
+from backends import MemoryBackend
+from encoders import get_encoder
+from writebehind import WriteBehindQueue
+from idempotency import IdempotencyStore, fingerprint
+from limits import TokenBucketLimiter, LoadShedder
+from pool import create_pool
+from cache import LRUCache, CacheInvalidator
+from monitoring import MeteredRedis, CountingConnection, LatencyTracker
+from custom_exceptions import DataValidationError
+from . import app, metrics
 
 # Error handlers reuire app to be initialized so we must import
 # then only after we have initialized the Flask app instance
 import error_handlers
 
 redis = None
+invalidator = None
+write_behind = None
+idempotency = None
+limiter = None
+shedder = None
+
+# Recent average of this worker's Redis round trips, read by the shedder
+redis_latency = LatencyTracker()
+
+# Flask-API has no constants for the WebDAV Multi-Status and Unprocessable Entity codes
+HTTP_207_MULTI_STATUS = 207
+HTTP_422_UNPROCESSABLE_ENTITY = 422
+
+# Flask-API has no constant for Too Many Requests either
+HTTP_429_TOO_MANY_REQUESTS = 429
+
+# Longest Idempotency-Key accepted, made of printable ASCII only
+MAX_IDEMPOTENCY_KEY = 255
+IDEMPOTENCY_KEY = re.compile(r'[\x20-\x7e]+\Z')
+
+# Newline delimited JSON, used to stream lists one Order per line
+NDJSON = 'application/x-ndjson'
+
+######################################################################
+# IDEMPOTENT REQUESTS
+#   A create sent with an Idempotency-Key header is carried out once;
+#   retries with the same key get the first response replayed
+######################################################################
+def idempotent(view):
+    """ Replays the stored response to a request retried with the same Idempotency-Key
+
+    Without the header, or without Redis, the request is just carried out.
+    Responses of 500 and up are not kept so the retry runs again.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key or not idempotency:
+            return view(*args, **kwargs)
+        if len(key) > MAX_IDEMPOTENCY_KEY:
+            raise DataValidationError('Invalid Idempotency-Key: at most {} characters'.format(MAX_IDEMPOTENCY_KEY))
+        if not IDEMPOTENCY_KEY.match(key):
+            raise DataValidationError('Invalid Idempotency-Key: only printable ASCII characters are allowed')
+        request_fingerprint = fingerprint(request.method, request.path, request.get_data())
+        record = idempotency.claim(request.path, key, request_fingerprint)
+        if record is None:
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                idempotency.release(request.path, key)
+                raise
+            if response.status_code < 500:
+                idempotency.save(request.path, key, request_fingerprint, response)
+                count_idempotent('stored')
+            else:
+                idempotency.release(request.path, key)
+            return response
+        if record['fingerprint'] != request_fingerprint:
+            count_idempotent('mismatch')
+            message = 'Idempotency-Key {} was already used for a different request'.format(key)
+            return make_response(jsonify(status=422, error='Unprocessable Entity', message=message),
+                                 HTTP_422_UNPROCESSABLE_ENTITY)
+        if 'status' not in record:
+            count_idempotent('in_progress')
+            message = 'A request with Idempotency-Key {} is still being processed'.format(key)
+            return make_response(jsonify(status=409, error='Conflict', message=message),
+                                 status.HTTP_409_CONFLICT, {'Retry-After': '1'})
+        count_idempotent('replayed')
+        response = Response(record['body'].encode('utf-8'), record['status'], record['headers'])
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    return wrapper
+
+def count_idempotent(outcome):
+    metrics.inc('idempotent_requests_total', {'route': request.url_rule.rule, 'outcome': outcome})
+
+######################################################################
+# RATE LIMITS AND LOAD SHEDDING
+#   Checked before every request but /metrics, which must stay
+#   reachable to see why requests are being refused
+######################################################################
+@app.before_request
+def enforce_limits():
+    if request.endpoint in ('get_metrics', 'static') or request.url_rule is None:
+        return None
+    if shedder:
+        reason = shedder.enter()
+        if reason:
+            metrics.inc('http_requests_shed_total', {'reason': reason})
+            message = 'The service is overloaded, try again later'
+            return make_response(jsonify(status=503, error='Service Unavailable', message=message),
+                                 status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': '1'})
+        g.shed_entered = True
+    if limiter:
+        route = '{} {}'.format(request.method, request.url_rule.rule)
+        # remote_addr, not X-Forwarded-For, which any client can fill with a new address every time
+        allowed, remaining, retry_after = limiter.take(route, request.remote_addr or '-')
+        if not allowed:
+            metrics.inc('http_requests_rate_limited_total', {'route': request.url_rule.rule, 'method': request.method})
+            message = 'Rate limit of {} exceeded, retry in {} seconds'.format(route, retry_after)
+            return make_response(jsonify(status=429, error='Too Many Requests', message=message),
+                                 HTTP_429_TOO_MANY_REQUESTS, {'Retry-After': str(retry_after)})
+    return None
+
+@app.teardown_request
+def leave_shedder(error=None):
+    if g.pop('shed_entered', False) and shedder:
+        shedder.leave()
 
 ######################################################################
 # GET INDEX
@@ -47,10 +170,20 @@ def index():
 def list_orders():
     """
     Retrieve a list of Orders
-    This endpoint will return all Orders unless a query parameter is specificed
+    This endpoint will return all Orders unless a query parameter is specificed.
+    Unfiltered lists and amount ranges are returned one page at a time; the
+    Link header carries the URL of the next page until the last one is reached.
+    Lists are streamed while they are read from Redis, as a JSON array or as
+    newline delimited JSON when application/x-ndjson is accepted.
+    Every list but a lookup by ids carries an ETag that changes whenever any
+    Order is written; sending it back in If-None-Match gets a 304 without the
+    list being read.
     ---
     tags:
       - Orders
+    produces:
+      - application/json
+      - application/x-ndjson
     description: The Orders endpoint allows you to query Orders
     parameters:
       - name: customer_name
@@ -58,9 +191,48 @@ def list_orders():
         description: the name of the customer who placed the Order
         required: false
         type: string
+      - name: ids
+        in: query
+        description: >
+          comma separated list of up to 1000 Order ids to fetch in one call. The
+          response is then an object with the found "orders" and the "missing" ids
+        required: false
+        type: string
+      - name: min_amount
+        in: query
+        description: only Orders with amount_paid at least this much, in amount order
+        required: false
+        type: number
+      - name: max_amount
+        in: query
+        description: only Orders with amount_paid at most this much, in amount order
+        required: false
+        type: number
+      - name: limit
+        in: query
+        description: the most Orders to return in one page
+        required: false
+        type: integer
+      - name: cursor
+        in: query
+        description: opaque position to continue from, taken from the next Link
+        required: false
+        type: string
+      - name: If-None-Match
+        in: header
+        description: ETag of the list the client already has
+        required: false
+        type: string
     responses:
       200:
         description: An array of Orders
+        headers:
+          Link:
+            type: string
+            description: URLs of the first and next pages of the list
+          ETag:
+            type: string
+            description: version of the list, changes with any write
         schema:
           type: array
           items:
@@ -75,17 +247,194 @@ def list_orders():
                   description: the name of the person who placed the order
                 amount_paid:
                   type: integer
-                  description: the amount the order came out to
+                  description: the amount the order came out to, in whole cents
+      304:
+        description: The list has not changed since the ETag in If-None-Match
     """
-    orders = []
+    headers = {}
+    ids = request.args.get('ids')
     customer_name = request.args.get('customer_name')
+    min_amount = request.args.get('min_amount')
+    max_amount = request.args.get('max_amount')
+    if ids:
+        # kept to one round trip, so the lookup is not tagged
+        return find_many_orders(ids)
+    etag = list_etag()
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
     if customer_name:
-        orders = Order.find_by_customer_name(customer_name)
+        ids = Order.customer_ids(customer_name)
+    elif min_amount is not None or max_amount is not None:
+        limit = page_limit()
+        position = decode_cursor(request.args.get('cursor'), 'amount', float, int)
+        ids, position = Order.page_ids_by_amount(amount_arg('min_amount', '-inf'), amount_arg('max_amount', '+inf'), position, limit)
+        next_cursor = encode_cursor('amount', *position) if position else None
+        headers['Link'] = page_links(limit, next_cursor, min_amount=min_amount, max_amount=max_amount)
     else:
-        orders = Order.all()
+        limit = page_limit()
+        position = decode_cursor(request.args.get('cursor'), 'order', int)
+        ids, next_id = Order.page_ids(position[0] if position else 0, limit)
+        next_cursor = encode_cursor('order', next_id) if next_id is not None else None
+        headers['Link'] = page_links(limit, next_cursor)
+
+    batches = Order.iter_json(ids, app.config['ORDERS_STREAM_BATCH_SIZE'])
+    if request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON:
+        body, mimetype = stream_ndjson(batches), NDJSON
+    else:
+        body, mimetype = stream_json_array(batches), 'application/json'
+    response = Response(stream_with_context(body), status.HTTP_200_OK, headers, mimetype=mimetype)
+    response.set_etag(etag)
+    return response
+
+def list_etag():
+    """ Returns the ETag of the list this request asks for
+
+    Lists change whenever any Order is written, so the tag combines the
+    current generation with the URL and the negotiated format
+    """
+    mimetype = request.accept_mimetypes.best_match(['application/json', NDJSON])
+    digest = hashlib.sha1(u'{} {}'.format(request.url, mimetype).encode('utf-8')).hexdigest()[:16]
+    return 'l{}-{}'.format(Order.generation(), digest)
+
+def order_etag(version):
+    """ Returns the strong ETag of an Order saved as this version """
+    return 'o{}'.format(version)
+
+def with_etag(response, order):
+    """ Tags a response carrying an Order with the version it was read at """
+    if order.version:
+        response.set_etag(order_etag(order.version))
+    return response
+
+def not_modified(etag):
+    response = make_response('', status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+def stream_json_array(batches):
+    """ Writes a JSON array one chunk per batch of Orders in JSON """
+    yield '['
+    separator = ''
+    for orders in batches:
+        if orders:
+            yield separator + ','.join(orders)
+            separator = ','
+    yield ']'
+
+def stream_ndjson(batches):
+    """ Writes one JSON document per line, one chunk per batch of Orders in JSON """
+    for orders in batches:
+        if orders:
+            yield '\n'.join(orders) + '\n'
+
+def json_response(body, code, headers=None):
+    """ Sends JSON already written by the Order encoder, in place of jsonify """
+    return Response(body, code, headers, mimetype='application/json')
+
+def page_limit():
+    """ Returns the page size asked for, bounded by ORDERS_MAX_PAGE_SIZE """
+    try:
+        limit = int(request.args.get('limit', app.config['ORDERS_PAGE_SIZE']))
+    except ValueError:
+        raise DataValidationError('Invalid limit: must be an integer')
+    if limit < 1 or limit > app.config['ORDERS_MAX_PAGE_SIZE']:
+        raise DataValidationError('Invalid limit: must be between 1 and {}'.format(app.config['ORDERS_MAX_PAGE_SIZE']))
+    return limit
+
+def amount_arg(name, default):
+    """ Returns an amount range bound from the query string """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    if Order.amount_score(value) is None:
+        raise DataValidationError('Invalid {}: must be a number'.format(name))
+    return Order.amount_score(value)
 
-    results = [order.serialize() for order in orders]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+def encode_cursor(kind, *position):
+    """ Packs the position a list stopped at into an opaque cursor """
+    return base64.urlsafe_b64encode(':'.join([kind] + [repr(value) for value in position]))
+
+def decode_cursor(cursor, kind, *types):
+    """ Returns the position packed in a cursor, None for the first page
+
+    Amounts, ids and counts are never negative, infinite or nan, so a
+    cursor holding one was not made by us
+    """
+    if not cursor:
+        return None
+    try:
+        parts = base64.urlsafe_b64decode(str(cursor)).split(':')
+        if parts[0] != kind or len(parts) != len(types) + 1:
+            raise ValueError(parts[0])
+        position = tuple(convert(value) for convert, value in zip(types, parts[1:]))
+        if any(math.isinf(value) or math.isnan(value) or value < 0 for value in position):
+            raise ValueError(position)
+        return position
+    except (TypeError, ValueError):
+        raise DataValidationError('Invalid cursor: {}'.format(cursor))
+
+def page_links(limit, next_cursor, **args):
+    """ Builds the Link header pointing at the first and next pages """
+    links = ['<{}>; rel="first"'.format(url_for('list_orders', limit=limit, _external=True, **args))]
+    if next_cursor:
+        next_url = url_for('list_orders', limit=limit, cursor=next_cursor, _external=True, **args)
+        links.append('<{}>; rel="next"'.format(next_url))
+    return ', '.join(links)
+
+def find_many_orders(ids):
+    """ Fetches every Order in a comma separated id list in one round trip """
+    ids = [id for id in ids.split(',') if id.strip()]
+    if len(ids) > app.config['LOOKUP_MAX_IDS']:
+        raise DataValidationError('Invalid ids: at most {} ids may be looked up at once'.format(app.config['LOOKUP_MAX_IDS']))
+    try:
+        ids = [int(id) for id in ids]
+    except ValueError:
+        raise DataValidationError('Invalid ids: must be a comma separated list of integers')
+    ids = list(OrderedDict.fromkeys(ids))   # drop duplicates but keep the order
+    orders = Order.find_many(ids)
+    results = [order.serialize() for order in orders if order]
+    missing = [id for id, order in zip(ids, orders) if not order]
+    return make_response(jsonify(orders=results, missing=missing), status.HTTP_200_OK)
+
+######################################################################
+# ORDER STATISTICS
+######################################################################
+@app.route('/orders/stats', methods=['GET'])
+def get_order_stats():
+    """
+    Retrieve Order statistics
+    This endpoint returns the number of Orders and their total amount paid,
+    overall or for one customer. The figures are maintained on every write so
+    reading them does not depend on the number of Orders.
+    ---
+    tags:
+      - Orders
+    produces:
+      - application/json
+    parameters:
+      - name: customer_name
+        in: query
+        description: only count the Orders placed by this customer
+        required: false
+        type: string
+    responses:
+      200:
+        description: Order statistics
+        schema:
+          id: OrderStats
+          properties:
+            count:
+              type: integer
+              description: the number of Orders
+            total_amount_paid:
+              type: number
+              description: the sum of amount_paid over those Orders
+    """
+    customer_name = request.args.get('customer_name')
+    stats = Order.stats(customer_name)
+    if customer_name:
+        stats['customer_name'] = customer_name
+    return make_response(jsonify(stats), status.HTTP_200_OK)
 
 ######################################################################
 # RETRIEVE A ORDER
@@ -106,9 +455,18 @@ def get_orders(id):
         description: ID of order to retrieve
         type: integer
         required: true
+      - name: If-None-Match
+        in: header
+        description: ETag of the Order the client already has
+        required: false
+        type: string
     responses:
       200:
         description: Order returned
+        headers:
+          ETag:
+            type: string
+            description: version of the Order, changes with every save
         schema:
           id: Order
           properties:
@@ -120,17 +478,28 @@ def get_orders(id):
               description: the name of the person who placed the order
             amount_paid:
               type: integer
-              description: the amount the order came out to
+              description: the amount the order came out to, in whole cents
+      304:
+        description: The Order has not changed since the ETag in If-None-Match
       404:
         description: Order not found
     """
-    order = Order.find_or_404(id)
-    return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+    if request.if_none_match:
+        # only the version is read, the Order itself is not fetched
+        version = Order.find_version(id)
+        if version and request.if_none_match.contains_weak(order_etag(version)):
+            return not_modified(order_etag(version))
+    body, version = Order.find_json_or_404(id)
+    response = json_response(body, status.HTTP_200_OK)
+    if version:
+        response.set_etag(order_etag(version))
+    return response
 
 ######################################################################
 # ADD A NEW ORDER
 ######################################################################
 @app.route('/orders', methods=['POST'])
+@idempotent
 def create_orders():
     """
     Creates a Order
@@ -157,7 +526,12 @@ def create_orders():
               description: the name of the person who placed the order
             amount_paid:
               type: integer
-              description: the amount the order came out to
+              description: the amount the order came out to, in whole cents
+      - name: Idempotency-Key
+        in: header
+        description: unique key of this request; a retry with the same key gets the first response replayed
+        required: false
+        type: string
     responses:
       201:
         description: Order created
@@ -172,9 +546,13 @@ def create_orders():
               description: the name of the person who placed the order
             amount_paid:
               type: integer
-              description: the amount the order came out to
+              description: the amount the order came out to, in whole cents
       400:
         description: Bad Request (the posted data was not valid)
+      409:
+        description: A request with the same Idempotency-Key is still being processed
+      422:
+        description: The Idempotency-Key was already used for a different request
     """
     # Check for form submission data
     print 'Headers: {}'.format(request.headers.get('Content-Type'))
@@ -186,8 +564,79 @@ def create_orders():
     order = Order()
     order.deserialize(data)
     order.save()
-    message = order.serialize()
-    return make_response(jsonify(message), status.HTTP_201_CREATED, {'Location': order.self_url() })
+    return with_etag(json_response(order.to_json(), status.HTTP_201_CREATED, {'Location': order.self_url() }), order)
+
+######################################################################
+# ADD MANY NEW ORDERS
+######################################################################
+@app.route('/orders/bulk', methods=['POST'])
+def create_orders_in_bulk():
+    """
+    Creates many Orders at once
+    This endpoint will create an Order for every item of the JSON array that is posted
+    ---
+    tags:
+      - Orders
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            schema:
+              id: data
+    responses:
+      201:
+        description: Every Order was created
+        schema:
+          type: array
+          items:
+            schema:
+              id: BulkResult
+              properties:
+                status:
+                  type: integer
+                  description: 201 when the item was created or 400 when it was not valid
+                location:
+                  type: string
+                  description: URL of the created Order
+                order:
+                  schema:
+                    id: Order
+                message:
+                  type: string
+                  description: why the item was rejected
+      207:
+        description: Some items were rejected, see the status of each item
+      400:
+        description: Bad Request (the posted data was not an array or was too large)
+    """
+    data = request.get_json()
+    if not isinstance(data, list):
+        raise DataValidationError('Invalid request: body must be a JSON array of orders')
+    if len(data) > app.config['BULK_MAX_ORDERS']:
+        raise DataValidationError('Invalid request: at most {} orders may be created at once'.format(app.config['BULK_MAX_ORDERS']))
+    orders = []
+    results = []
+    for item in data:
+        try:
+            orders.append(Order().deserialize(item))
+            results.append(None)
+        except DataValidationError as e:
+            results.append({'status': status.HTTP_400_BAD_REQUEST, 'message': e.message})
+    Order.save_many(orders)
+    created = iter(orders)
+    for i, result in enumerate(results):
+        if result is None:
+            order = next(created)
+            results[i] = {'status': status.HTTP_201_CREATED, 'location': order.self_url(), 'order': order.serialize()}
+    code = status.HTTP_201_CREATED if len(orders) == len(results) else HTTP_207_MULTI_STATUS
+    return make_response(jsonify(results), code)
 
 ######################################################################
 # UPDATE AN EXISTING ORDER
@@ -223,7 +672,7 @@ def update_orders(id):
               description: the name of the person who placed the order
             amount_paid:
               type: integer
-              description: the amount the order came out to
+              description: the amount the order came out to, in whole cents
     responses:
       200:
         description: Order Updated
@@ -238,14 +687,14 @@ def update_orders(id):
               description: the name of the person who placed the order
             amount_paid:
               type: integer
-              description: the amount the order came out to
+              description: the amount the order came out to, in whole cents
       400:
         description: Bad Request (the posted data was not valid)
     """
     order = Order.find_or_404(id)
     order.deserialize(request.get_json())
     order.save()
-    return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+    return with_etag(json_response(order.to_json(), status.HTTP_200_OK), order)
 
 ######################################################################
 # DELETE A ORDER
@@ -278,6 +727,7 @@ def delete_orders(id):
 # DUPLICATE A Order
 ######################################################################
 @app.route('/orders/<int:id>/duplicate', methods=['PUT'])
+@idempotent
 def duplicate_order(id):
     """
     Duplicates a Order
@@ -295,6 +745,11 @@ def duplicate_order(id):
         description: ID of order to retrieve
         type: integer
         required: true
+      - name: Idempotency-Key
+        in: header
+        description: unique key of this request; a retry with the same key gets the first response replayed
+        required: false
+        type: string
     responses:
       201:
         description: Order created
@@ -309,9 +764,13 @@ def duplicate_order(id):
               description: the name of the person who placed the order
             amount_paid:
               type: integer
-              description: the amount the order came out to
+              description: the amount the order came out to, in whole cents
       404:
         description: Order not found
+      409:
+        description: A request with the same Idempotency-Key is still being processed
+      422:
+        description: The Idempotency-Key was already used for a different request
     """
     order = Order.find(id)
     if order:
@@ -328,6 +787,144 @@ def duplicate_order(id):
         return make_response(jsonify(message), status.HTTP_400_BAD_REQUEST)
 
 
+######################################################################
+# REDIS CONNECTION POOL STATS
+######################################################################
+@app.route('/redis/pool', methods=['GET'])
+def get_pool_stats():
+    """
+    Retrieve Redis connection pool stats
+    This endpoint reports how the connections of this worker's pool are used
+    ---
+    tags:
+      - Operations
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Live pool usage
+        schema:
+          id: PoolStats
+          properties:
+            blocking:
+              type: boolean
+              description: whether callers wait for a free connection instead of failing
+            max_connections:
+              type: integer
+              description: the most connections the pool will open
+            created:
+              type: integer
+              description: connections opened so far
+            in_use:
+              type: integer
+              description: connections currently checked out
+            idle:
+              type: integer
+              description: open connections waiting in the pool
+            waits:
+              type: integer
+              description: times a caller had to wait for a connection (blocking pool only)
+            wait_seconds:
+              type: number
+              description: total time spent waiting for connections (blocking pool only)
+            timeouts:
+              type: integer
+              description: waits that gave up without a connection (blocking pool only)
+            exhausted:
+              type: integer
+              description: callers refused because every connection was in use (non-blocking pool only)
+      404:
+        description: Orders are not stored in Redis
+    """
+    if not redis:
+        raise NotFound('Orders are not stored in Redis so there is no connection pool.')
+    return make_response(jsonify(redis.connection_pool.stats()), status.HTTP_200_OK)
+
+######################################################################
+# ORDER CACHE STATS
+######################################################################
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """
+    Retrieve Order cache stats
+    This endpoint reports how well this worker's Order cache is doing
+    ---
+    tags:
+      - Operations
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Cache counters, or enabled false when caching is off
+        schema:
+          id: CacheStats
+          properties:
+            enabled:
+              type: boolean
+              description: whether Order.find is cached
+            size:
+              type: integer
+              description: Orders currently cached
+            max_size:
+              type: integer
+              description: the most Orders kept before the least recently used is evicted
+            ttl:
+              type: number
+              description: seconds an Order stays cached
+            hits:
+              type: integer
+              description: reads answered from the cache
+            misses:
+              type: integer
+              description: reads that went to Redis
+            evictions:
+              type: integer
+              description: Orders dropped to make room
+            expirations:
+              type: integer
+              description: Orders dropped because they were too old
+            invalidations:
+              type: integer
+              description: Orders dropped because they were written
+            stale_fills:
+              type: integer
+              description: reads not cached because an Order was written while they ran
+            listening:
+              type: boolean
+              description: >
+                whether this worker hears the writes of the others; the cache
+                is bypassed while it does not
+            reconnects:
+              type: integer
+              description: times the invalidation listener lost Redis and subscribed again
+    """
+    if not invalidator:
+        return make_response(jsonify(enabled=False), status.HTTP_200_OK)
+    stats = invalidator.cache.stats()
+    stats['enabled'] = True
+    stats['listening'] = invalidator.healthy
+    stats['reconnects'] = invalidator.reconnects
+    return make_response(jsonify(stats), status.HTTP_200_OK)
+
+######################################################################
+# METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Retrieve service metrics
+    This endpoint returns request and Redis metrics of every worker in the Prometheus text format
+    ---
+    tags:
+      - Operations
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Request counts, latency histograms and in-flight requests per route and status, and Redis command counts and latency
+    """
+    return Response(metrics.render(), status=status.HTTP_200_OK, mimetype='text/plain; version=0.0.4')
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
@@ -337,7 +934,7 @@ def data_load(data):
 
 # empty the database
 def data_reset():
-    redis.flushall()
+    Order.remove_all()
 
 @app.before_first_request
 def setup_logging():
@@ -354,14 +951,27 @@ def setup_logging():
 ######################################################################
 # Connect to Redis and catch connection exceptions
 ######################################################################
-def connect_to_redis(hostname, port, password):
-    redis = Redis(host=hostname, port=port, password=password)
+def connect_to_redis(hostname, port, password, settings=None):
+    settings = settings or pool_settings()
+    pool = create_pool(hostname, port, password, connection_class=CountingConnection, **settings)
+    redis = MeteredRedis(metrics=metrics, latency=redis_latency, connection_pool=pool)
     try:
         redis.ping()
     except ConnectionError: # pragma: no cover
         redis = None
     return redis
 
+def pool_settings(creds=None):
+    """ Connection pool settings from the config, overridden by any VCAP credentials """
+    creds = creds or {}
+    return {
+        'max_connections': int(creds.get('max_connections', app.config['REDIS_MAX_CONNECTIONS'])),
+        'blocking': creds.get('pool_blocking', app.config['REDIS_POOL_BLOCKING']) in (True, 'True', 'true'),
+        'timeout': float(creds.get('pool_timeout', app.config['REDIS_POOL_TIMEOUT'])),
+        'socket_keepalive': creds.get('socket_keepalive', app.config['REDIS_SOCKET_KEEPALIVE']) in (True, 'True', 'true'),
+        'health_check_interval': int(creds.get('health_check_interval', app.config['REDIS_HEALTH_CHECK_INTERVAL']))
+    }
+
 
 ######################################################################
 # INITIALIZE Redis
@@ -369,10 +979,22 @@ def connect_to_redis(hostname, port, password):
 #   1) In Bluemix with Redis bound through VCAP_SERVICES
 #   2) With Redis running on the local server as with Travis CI
 #   3) With Redis --link ed in a Docker container called 'redis'
+# With ORDER_STORAGE=memory Redis is skipped and Orders are kept in this
+# process only
 ######################################################################
 def inititalize_redis(): # pragma: no cover
     global redis
     redis = None
+    if app.config['ORDER_STORAGE'] == 'memory':
+        app.logger.info("ORDER_STORAGE is memory, keeping Orders in process")
+        Order.use_db(MemoryBackend())
+        metrics.use_redis(None)
+        initialize_cache()
+        initialize_encoder()
+        initialize_write_behind()
+        initialize_idempotency()
+        initialize_limits()
+        return
     # Get the crdentials from the Bluemix environment
     if 'VCAP_SERVICES' in os.environ:
         app.logger.info("Using VCAP_SERVICES...")
@@ -380,7 +1002,7 @@ def inititalize_redis(): # pragma: no cover
         services = json.loads(VCAP_SERVICES)
         creds = services['rediscloud'][0]['credentials']
         app.logger.info("Conecting to Redis on host %s port %s" % (creds['hostname'], creds['port']))
-        redis = connect_to_redis(creds['hostname'], creds['port'], creds['password'])
+        redis = connect_to_redis(creds['hostname'], creds['port'], creds['password'], pool_settings(creds))
     else:
         app.logger.info("VCAP_SERVICES not found, checking localhost for Redis")
         redis = connect_to_redis('127.0.0.1', 6379, None)
@@ -392,3 +1014,81 @@ def inititalize_redis(): # pragma: no cover
         app.logger.error('*** FATAL ERROR: Could not connect to the Redis Service')
     # Have the Order model use Redis
     Order.use_db(redis)
+    metrics.use_redis(redis)
+    initialize_cache()
+    initialize_encoder()
+    initialize_write_behind()
+    initialize_idempotency()
+    initialize_limits()
+
+######################################################################
+# INITIALIZE the Order cache
+#   Each worker keeps its own cache and listens for the writes made by
+#   the others so it never serves their stale copies
+######################################################################
+def initialize_cache():
+    global invalidator
+    if invalidator:
+        invalidator.stop()
+        invalidator = None
+    if redis and app.config['ORDER_CACHE_SIZE'] > 0:
+        cache = LRUCache(app.config['ORDER_CACHE_SIZE'], app.config['ORDER_CACHE_TTL'])
+        invalidator = CacheInvalidator(redis, cache, app.config['ORDER_CACHE_CHANNEL']).start()
+        Order.use_cache(cache, invalidator)
+    else:
+        Order.use_cache(None)
+
+######################################################################
+# INITIALIZE the JSON encoder used on the hot paths
+######################################################################
+def initialize_encoder():
+    try:
+        encoder = get_encoder(app.config['JSON_ENCODER'])
+    except ImportError:
+        app.logger.warning('JSON_ENCODER %s is not installed, using json', app.config['JSON_ENCODER'])
+        encoder = get_encoder('json')
+    Order.use_encoder(encoder, app.config['ORDER_JSON_BLOBS'])
+
+######################################################################
+# INITIALIZE write-behind batching of creates
+#   Anything still queued is flushed by stop_write_behind, which the
+#   Gunicorn worker_exit hook calls on shutdown
+######################################################################
+def initialize_write_behind():
+    global write_behind
+    stop_write_behind()
+    if app.config['ORDER_WRITE_BEHIND'] and Order.db():
+        write_behind = WriteBehindQueue(Order.db(),
+                                        batch_size=app.config['ORDER_WRITE_BEHIND_BATCH'],
+                                        interval=app.config['ORDER_WRITE_BEHIND_INTERVAL'] / 1000.0,
+                                        durability=app.config['ORDER_WRITE_BEHIND_DURABILITY']).start()
+    Order.use_write_behind(write_behind)
+
+def stop_write_behind():
+    global write_behind
+    if write_behind:
+        write_behind.stop()
+        write_behind = None
+        Order.use_write_behind(None)
+
+######################################################################
+# INITIALIZE the store of Idempotency-Key responses, which needs Redis
+######################################################################
+def initialize_idempotency():
+    global idempotency
+    idempotency = None
+    if redis:
+        idempotency = IdempotencyStore(redis, app.config['IDEMPOTENCY_TTL'], app.config['IDEMPOTENCY_LOCK_TTL'])
+
+######################################################################
+# INITIALIZE rate limits, which need Redis, and load shedding
+######################################################################
+def initialize_limits():
+    global limiter, shedder
+    limiter = None
+    if redis and app.config['RATE_LIMIT_ENABLED']:
+        limiter = TokenBucketLimiter(redis, app.config['RATE_LIMIT'], app.config['RATE_LIMITS'])
+    shedder = None
+    if app.config['SHED_MAX_IN_FLIGHT'] or app.config['SHED_REDIS_LATENCY_MS']:
+        shedder = LoadShedder(app.config['SHED_MAX_IN_FLIGHT'], app.config['SHED_REDIS_LATENCY_MS'] / 1000.0,
+                              redis_latency)
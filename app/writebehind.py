@@ -0,0 +1,199 @@
+######################################################################
+# Write-behind Queue
+#   Coalesces the creates of one worker process into batches that are
+#   written with a single pipelined round trip every interval seconds or
+#   every batch_size Orders, whichever comes first. Ids and versions are
+#   reserved from the backend in blocks so every Order gets its id the
+#   moment it is queued.
+#
+#   durability decides when a create is acknowledged:
+#     flushed  once the batch holding it is stored (group commit)
+#     queued   as soon as it is queued: a crash loses what was queued in
+#              the last interval, a graceful stop flushes it
+#
+#   Records are checked as they are queued so one bad Order cannot fail
+#   a whole batch. Writes skip Orders that are already stored, so a batch
+#   that failed on the way to Redis is simply written again. An error
+#   reply from Redis is never retried since it would fail the same way.
+######################################################################
+
+import time
+import logging
+import threading
+from redis.exceptions import ResponseError
+from custom_exceptions import WriteBehindError, DataValidationError
+from backends import check_record
+
+FLUSHED = 'flushed'
+QUEUED = 'queued'
+
+# Attempts at writing a queued batch once the queue is stopping
+STOP_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+######################################################################
+# A batch of creates written together
+######################################################################
+class Batch(object):
+
+    def __init__(self, started):
+        self.records = []
+        self.started = started
+        self.attempts = 0
+        self.done = threading.Event()
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error:
+            raise WriteBehindError('Could not store the order: {}'.format(self.error))
+
+######################################################################
+# Queue of creates flushed by a background thread
+######################################################################
+class WriteBehindQueue(object):
+
+    def __init__(self, backend, batch_size=500, interval=0.01, durability=FLUSHED, max_pending=None,
+                 clock=time.time):
+        if durability not in (FLUSHED, QUEUED):
+            raise ValueError('durability must be {} or {}'.format(FLUSHED, QUEUED))
+        self.backend = backend
+        self.batch_size = batch_size
+        self.interval = interval
+        self.durability = durability
+        self.max_pending = max_pending or 10 * batch_size
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._batch = Batch(clock())
+        self._next_id = self._next_version = self._reserved = 0
+        self._stopping = False
+        self._thread = None
+        self.flushed = 0
+        self.batches = 0
+        self.retries = 0
+        self.lost = 0
+
+    def submit(self, fields):
+        """ Queues a new Order and returns the (id, version) reserved for it
+
+        With flushed durability this returns once the Order is stored and
+        raises WriteBehindError if it could not be. A record that cannot
+        be stored raises DataValidationError and is not queued.
+        """
+        try:
+            check_record(fields)
+        except ValueError as e:
+            raise DataValidationError('Invalid order: {}'.format(e))
+        with self._cond:
+            if self._stopping:
+                raise WriteBehindError('The write-behind queue is stopped')
+            while len(self._batch.records) >= self.max_pending:
+                self._cond.wait()
+            id, version = self._allocate()
+            batch = self._batch
+            if not batch.records:
+                batch.started = self._clock()
+            batch.records.append(dict(fields, id=id, version=version))
+            if len(batch.records) == 1 or len(batch.records) >= self.batch_size:
+                self._cond.notify_all()
+        if self.durability == FLUSHED:
+            batch.wait()
+        return id, version
+
+    def _allocate(self):
+        """ Hands out the next reserved id and version, reserving a new block when needed """
+        if self._reserved == 0:
+            self._next_id, self._next_version = self.backend.reserve(self.batch_size)
+            self._reserved = self.batch_size
+        id, version = self._next_id, self._next_version
+        self._next_id += 1
+        self._next_version += 1
+        self._reserved -= 1
+        return id, version
+
+    def forget_reserved(self):
+        """ Drops the reserved block, for when the backend's counters were reset """
+        with self._cond:
+            self._reserved = 0
+
+    def pending(self):
+        with self._cond:
+            return len(self._batch.records)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Flushes whatever is queued and stops the flusher thread """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._flush(batch)
+
+    def _next_batch(self):
+        """ Waits until a batch is full, old enough or the queue is stopping
+
+        Returns None once the queue is stopped and empty
+        """
+        with self._cond:
+            while not self._batch.records and not self._stopping:
+                self._cond.wait()
+            while not self._stopping and len(self._batch.records) < self.batch_size:
+                remaining = self._batch.started + self.interval - self._clock()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if not self._batch.records:
+                return None
+            batch, self._batch = self._batch, Batch(self._clock())
+            # wake anyone held back by max_pending
+            self._cond.notify_all()
+            return batch
+
+    def _flush(self, batch):
+        """ Writes a batch, queueing it again on failure when creates were already acknowledged
+
+        Waiting creates are told of a failure at once. Acknowledged ones
+        are retried until they are stored, or STOP_ATTEMPTS times once
+        the queue is stopping, unless Redis rejected the batch itself.
+        """
+        batch.attempts += 1
+        try:
+            self.backend.write_many(batch.records)
+        except Exception as e:
+            if self.durability == FLUSHED:
+                batch.error = e
+                batch.done.set()
+                return
+            if isinstance(e, (ResponseError, ValueError)):
+                self.lost += len(batch.records)
+                logger.error('Lost %d queued orders, the batch was rejected: %s', len(batch.records), e)
+                return
+            if self._stopping and batch.attempts >= STOP_ATTEMPTS:
+                self.lost += len(batch.records)
+                logger.error('Lost %d queued orders on stop: %s', len(batch.records), e)
+                return
+            # stored Orders are skipped when the batch is written again
+            logger.warning('Write-behind flush of %d orders failed, retrying: %s', len(batch.records), e)
+            self.retries += 1
+            with self._cond:
+                batch.records.extend(self._batch.records)
+                self._batch = batch
+            time.sleep(self.interval)
+            return
+        self.flushed += len(batch.records)
+        self.batches += 1
+        batch.done.set()
@@ -0,0 +1,89 @@
+######################################################################
+# Storage backend benchmark
+#   Runs the same Order model operations against the Redis and the
+#   in-memory backends and reports the throughput of each
+#
+#   python benchmarks/backends.py --orders 10000
+######################################################################
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from redis import Redis
+from app.models import Order
+from app.backends import RedisBackend, MemoryBackend
+
+def save_one_by_one(count):
+    for i in range(count):
+        Order(0, 'customer-%d' % (i % 100), i).save()
+
+def save_many(count):
+    Order.save_many([Order(0, 'customer-%d' % (i % 100), i) for i in range(count)])
+
+def find(count):
+    for id in range(1, count + 1):
+        Order.find(id)
+
+def list_rows(count):
+    after_id = 0
+    while after_id is not None:
+        ids, after_id = Order.page_ids(after_id)
+        for rows in Order.iter_rows(ids):
+            pass
+
+def by_customer(count):
+    for i in range(100):
+        Order.find_by_customer_name('customer-%d' % i)
+
+def by_amount(count):
+    after = None
+    while True:
+        ids, after = Order.page_ids_by_amount(0, count // 2, after)
+        if after is None:
+            break
+
+# name, operation, whether it starts from an empty store
+OPERATIONS = [
+    ('save', save_one_by_one, True),
+    ('save_many', save_many, True),
+    ('find', find, False),
+    ('list rows', list_rows, False),
+    ('by customer', by_customer, False),
+    ('by amount', by_amount, False)
+]
+
+def run(backend, count):
+    Order.use_db(backend)
+    Order.use_cache(None)
+    results = []
+    for name, operation, empty in OPERATIONS:
+        if empty:
+            Order.remove_all()
+        start = time.time()
+        operation(count)
+        results.append((name, time.time() - start))
+    Order.remove_all()
+    return results
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the storage backends on the same model code')
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15, help='scratch database, its orders are replaced')
+    args = parser.parse_args()
+
+    backends = [('redis', RedisBackend(Redis(host=args.host, port=args.port, db=args.db))),
+                ('memory', MemoryBackend())]
+    results = dict((name, run(backend, args.orders)) for name, backend in backends)
+    print '{:<12} {:>12} {:>12} {:>8}'.format('operation', 'redis s', 'memory s', 'speedup')
+    for (name, redis_seconds), (_, memory_seconds) in zip(results['redis'], results['memory']):
+        print '{:<12} {:>12.3f} {:>12.3f} {:>7.0f}x'.format(name, redis_seconds, memory_seconds,
+                                                             redis_seconds / max(memory_seconds, 1e-6))
@@ -0,0 +1,63 @@
+######################################################################
+# Compression benchmark
+#   Measures what gzip at each level saves on a page of GET /orders and
+#   what it costs in server time, then estimates the time to deliver the
+#   page over links of a few bandwidths. Orders are kept in memory so
+#   that only serialization and compression are timed.
+#
+#   python benchmarks/compression.py --orders 1000 --requests 50
+######################################################################
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import app
+from app.models import Order
+from app.backends import MemoryBackend
+from endpoints import percentile
+
+# link name: bytes per second
+LINKS = [('1 Mbit/s', 125000), ('10 Mbit/s', 1250000), ('100 Mbit/s', 12500000)]
+
+def measure(client, path, level, requests):
+    """ Returns the body size and the p50 server time at one level, 0 is off """
+    app.config['COMPRESS_LEVEL'] = level
+    headers = {'Accept-Encoding': 'gzip'}
+    latencies = []
+    for i in range(requests):
+        start = time.time()
+        resp = client.get(path, headers=headers)
+        size = len(resp.get_data())
+        resp.close()
+        latencies.append(time.time() - start)
+    return size, percentile(sorted(latencies), 0.50)
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare response sizes and times at each gzip level')
+    parser.add_argument('--orders', type=int, default=1000, help='orders in the listed page')
+    parser.add_argument('--requests', type=int, default=50, help='timed requests per level')
+    parser.add_argument('--levels', default='0,1,6,9', help='comma separated levels, 0 is uncompressed')
+    args = parser.parse_args()
+
+    Order.use_db(MemoryBackend())
+    Order.use_cache(None)
+    Order.save_many([Order(0, 'customer-%d' % (i % 1000), i * 37 % 100000) for i in range(args.orders)])
+    app.logger.disabled = True
+    client = app.test_client()
+    path = '/orders?limit=%d' % min(args.orders, app.config['ORDERS_MAX_PAGE_SIZE'])
+
+    print '{:<6} {:>10} {:>7} {:>10}'.format('level', 'bytes', 'ratio', 'server ms') + \
+        ''.join(' {:>12}'.format(name) for name, rate in LINKS)
+    plain = None
+    for level in [int(level) for level in args.levels.split(',')]:
+        size, server_time = measure(client, path, level, args.requests)
+        plain = plain or size
+        print '{:<6} {:>10} {:>7.2f} {:>10.2f}'.format(level or 'off', size, float(size) / plain, 1000 * server_time) + \
+            ''.join(' {:>9.1f} ms'.format(1000 * (server_time + float(size) / rate)) for name, rate in LINKS)
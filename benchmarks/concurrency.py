@@ -0,0 +1,222 @@
+######################################################################
+# Concurrency benchmark
+#   Compares how many concurrent clients one worker process can serve
+#   on the read routes with the threaded (gthread) worker and with the
+#   gevent worker, where a request waiting on Redis yields to others.
+#
+#   The service runs under Gunicorn against a redis-server started for
+#   the run. Redis is reached through a proxy that delays every reply
+#   by --redis-rtt-ms, standing in for the network between Bluemix and
+#   a hosted Redis; with 0 the local sub-millisecond round trips make
+#   both paths CPU bound. The clients are greenlets so a single client
+#   process can hold hundreds of connections open.
+#
+#   python benchmarks/concurrency.py --clients 1,10,50,100,200 --redis-rtt-ms 2
+#
+#   With --route create the clients POST new orders instead, and the
+#   batched modes queue them for write-behind (a flash sale burst):
+#   python benchmarks/concurrency.py --route create --modes gevent,gevent-batched
+######################################################################
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import random
+import httplib
+import argparse
+import subprocess
+import gevent
+from gevent.server import StreamServer
+from gevent.socket import create_connection
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from redis import Redis
+from app.models import Order
+from endpoints import free_port, percentile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# name: the Gunicorn settings of one worker process
+MODES = {
+    'threaded': {'GUNICORN_WORKER_CLASS': 'gthread'},
+    'gevent': {'GUNICORN_WORKER_CLASS': 'gevent'},
+    'threaded-batched': {'GUNICORN_WORKER_CLASS': 'gthread', 'ORDER_WRITE_BEHIND': 'True'},
+    'gevent-batched': {'GUNICORN_WORKER_CLASS': 'gevent', 'ORDER_WRITE_BEHIND': 'True'}
+}
+
+######################################################################
+# A TCP proxy that adds latency to every Redis reply
+######################################################################
+def start_delay_proxy(port, upstream_port, delay):
+    def pipe(source, target, pause):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                if pause:
+                    gevent.sleep(pause)
+                target.sendall(data)
+        except Exception:
+            pass
+        finally:
+            target.close()
+
+    def handle(client, address):
+        upstream = create_connection(('127.0.0.1', upstream_port))
+        gevent.spawn(pipe, upstream, client, delay)
+        pipe(client, upstream, 0)
+
+    proxy = StreamServer(('127.0.0.1', port), handle)
+    return proxy
+
+######################################################################
+# Load generation
+######################################################################
+def client_loop(port, ids, deadline, latencies, errors, route='get'):
+    connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+    while time.time() < deadline:
+        if route == 'create':
+            method, path, expected = 'POST', '/orders', 201
+            body = json.dumps({'customer_name': 'customer-%d' % random.randrange(1000), 'amount_paid': random.randrange(100000)})
+        elif random.random() < 0.8:
+            method, path, expected, body = 'GET', '/orders/%d' % random.choice(ids), 200, None
+        else:
+            method, path, expected, body = 'GET', '/orders?limit=20', 200, None
+        start = time.time()
+        try:
+            connection.request(method, path, body, {'Content-Type': 'application/json'} if body else {})
+            resp = connection.getresponse()
+            resp.read()
+            if resp.status != expected:
+                errors.append(resp.status)
+            else:
+                latencies.append(time.time() - start)
+        except Exception as e:
+            errors.append(type(e).__name__)
+            connection.close()
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+    connection.close()
+
+def run_load(port, ids, clients, duration, route='get'):
+    latencies, errors = [], []
+    deadline = time.time() + duration
+    gevent.joinall([gevent.spawn(client_loop, port, ids, deadline, latencies, errors, route) for i in range(clients)])
+    latencies.sort()
+    if not latencies:
+        return {'clients': clients, 'throughput_rps': 0, 'p50_ms': None, 'p99_ms': None, 'errors': len(errors)}
+    return {
+        'clients': clients,
+        'throughput_rps': len(latencies) / float(duration),
+        'p50_ms': 1000.0 * percentile(latencies, 0.50),
+        'p99_ms': 1000.0 * percentile(latencies, 0.99),
+        'errors': len(errors)
+    }
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            create_connection(('127.0.0.1', port)).close()
+            return
+        except Exception:
+            gevent.sleep(0.1)
+    raise SystemExit('nothing is listening on port %d' % port)
+
+######################################################################
+# The service under test
+######################################################################
+def start_service(mode, port, redis_port, args):
+    env = dict(os.environ)
+    env.update(MODES[mode])
+    env.update({
+        'PORT': str(port),
+        'WEB_CONCURRENCY': '1',
+        'GUNICORN_THREADS': str(args.threads),
+        'ORDER_CACHE_SIZE': '0',    # every read goes to Redis
+        'REDIS_MAX_CONNECTIONS': str(args.max_connections),
+        'VCAP_SERVICES': json.dumps({'rediscloud': [{'credentials': {
+            'hostname': '127.0.0.1', 'port': redis_port, 'password': None}}]})
+    })
+    process = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', 'run:app'], cwd=ROOT, env=env,
+                               stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        try:
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=2)
+            connection.request('GET', '/orders/stats')
+            if connection.getresponse().status == 200:
+                return process
+        except Exception:
+            gevent.sleep(0.2)
+    process.terminate()
+    raise SystemExit('the %s service did not start' % mode)
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare concurrent clients served by one threaded or gevent worker')
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--clients', default='1,10,50,100,200', help='comma separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=5, help='seconds of load per level')
+    parser.add_argument('--threads', type=int, default=4, help='threads of the threaded worker')
+    parser.add_argument('--max-connections', type=int, default=200, help='Redis connection pool size')
+    parser.add_argument('--redis-rtt-ms', type=float, default=2, help='latency added to every Redis reply')
+    parser.add_argument('--redis-server', default='redis-server', help='redis-server executable to start')
+    parser.add_argument('--modes', default='threaded,gevent', help='comma separated: ' + ', '.join(sorted(MODES)))
+    parser.add_argument('--route', default='get', choices=['get', 'create'], help='read orders or create them')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--proxy', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--redis-port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.proxy:
+        start_delay_proxy(args.proxy, args.redis_port, args.redis_rtt_ms / 1000.0).serve_forever()
+
+    redis_port = free_port()
+    redis_server = subprocess.Popen([args.redis_server, '--port', str(redis_port), '--save', '', '--appendonly', 'no'],
+                                    stdout=open(os.devnull, 'w'))
+    proxy = None
+    try:
+        wait_for_port(redis_port)
+        Order.use_db(Redis(port=redis_port))
+        orders = Order.save_many([Order(0, 'customer-%d' % (i % 1000), i) for i in range(args.orders)])
+        ids = [order.id for order in orders]
+        service_redis_port = redis_port
+        if args.redis_rtt_ms:
+            # in its own process so it does not compete with the clients for CPU
+            service_redis_port = free_port()
+            proxy = subprocess.Popen([sys.executable, __file__, '--proxy', str(service_redis_port),
+                                      '--redis-port', str(redis_port), '--redis-rtt-ms', str(args.redis_rtt_ms)])
+            wait_for_port(service_redis_port)
+
+        results = {}
+        print '{:<16} {:>8} {:>10} {:>9} {:>9} {:>7}'.format('mode', 'clients', 'req/s', 'p50 ms', 'p99 ms', 'errors')
+        for mode in args.modes.split(','):
+            port = free_port()
+            service = start_service(mode, port, service_redis_port, args)
+            try:
+                results[mode] = []
+                for clients in [int(level) for level in args.clients.split(',')]:
+                    result = run_load(port, ids, clients, args.duration, args.route)
+                    results[mode].append(result)
+                    print '{:<16} {clients:>8} {throughput_rps:>10.0f} {p50_ms:>9.1f} {p99_ms:>9.1f} {errors:>7}'.format(mode, **result)
+            finally:
+                service.terminate()
+                service.wait()
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'orders': args.orders, 'route': args.route, 'redis_rtt_ms': args.redis_rtt_ms, 'results': results},
+                          f, indent=2, sort_keys=True)
+    finally:
+        if proxy:
+            proxy.terminate()
+            proxy.wait()
+        redis_server.terminate()
+        redis_server.wait()
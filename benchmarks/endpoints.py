@@ -0,0 +1,254 @@
+######################################################################
+# Endpoint benchmark
+#   Seeds a dataset and times every route through the Flask test
+#   client, once with the in-memory backend and once against a
+#   redis-server started just for the run. Latency percentiles and
+#   throughput are written as JSON and compared with a stored baseline;
+#   the run exits with status 1 when a route got slower than allowed.
+#
+#   python benchmarks/endpoints.py --orders 10000 --requests 500
+#   python benchmarks/endpoints.py --save-baseline   (after a deliberate change)
+#   JSON_ENCODER=ujson ORDER_JSON_BLOBS=True python benchmarks/endpoints.py
+######################################################################
+
+import os
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import platform
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import app, server
+from app.models import Order
+from app.backends import MemoryBackend
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'baseline.json')
+CUSTOMERS = 1000
+JSON_TYPE = 'application/json'
+
+######################################################################
+# The routes, each a function of (client, dataset) making one request
+######################################################################
+def list_orders(client, data):
+    return client.get('/orders', query_string={'limit': 100})
+
+def get_order(client, data):
+    return client.get('/orders/%d' % random.choice(data['ids']))
+
+def create_order(client, data):
+    body = json.dumps({'customer_name': random_customer(), 'amount_paid': random.randint(0, 100000)})
+    return client.post('/orders', data=body, content_type=JSON_TYPE)
+
+def update_order(client, data):
+    body = json.dumps({'customer_name': random_customer(), 'amount_paid': random.randint(0, 100000)})
+    return client.put('/orders/%d' % random.choice(data['ids']), data=body, content_type=JSON_TYPE)
+
+def delete_order(client, data):
+    return client.delete('/orders/%d' % data['deletable'].pop())
+
+def duplicate_order(client, data):
+    return client.put('/orders/%d/duplicate' % random.choice(data['ids']))
+
+def query_by_customer(client, data):
+    return client.get('/orders', query_string={'customer_name': random_customer()})
+
+ROUTES = [
+    ('list', list_orders, 200),
+    ('get', get_order, 200),
+    ('create', create_order, 201),
+    ('update', update_order, 200),
+    ('delete', delete_order, 204),
+    ('duplicate', duplicate_order, 201),
+    ('query_by_customer', query_by_customer, 200)
+]
+
+def random_customer():
+    return 'customer-%d' % random.randrange(CUSTOMERS)
+
+######################################################################
+# Measuring
+######################################################################
+def percentile(samples, fraction):
+    """ Nearest rank percentile of a sorted list """
+    return samples[max(0, int(round(fraction * len(samples))) - 1)]
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'mean_ms': 1000.0 * sum(latencies) / len(latencies),
+        'p50_ms': 1000.0 * percentile(latencies, 0.50),
+        'p90_ms': 1000.0 * percentile(latencies, 0.90),
+        'p99_ms': 1000.0 * percentile(latencies, 0.99),
+        'max_ms': 1000.0 * latencies[-1],
+        'throughput_rps': len(latencies) / elapsed
+    }
+
+def seed(count, requests):
+    """ Loads count orders plus enough spare ones for the deletes """
+    Order.remove_all()
+    orders = Order.save_many([Order(0, 'customer-%d' % (i % CUSTOMERS), i % 100000) for i in range(count)])
+    spares = Order.save_many([Order(0, 'spare', 0) for i in range(requests)])
+    return {'ids': [order.id for order in orders], 'deletable': [order.id for order in spares]}
+
+def call(route, client, data):
+    """ Makes one request and reads the whole body, streamed or not """
+    resp = route(client, data)
+    resp.get_data()
+    resp.close()
+    return resp
+
+def bench_routes(count, requests, warmup):
+    """ Times every route against whatever storage the Order model uses now """
+    client = app.test_client()
+    data = seed(count, requests + warmup)
+    results = {}
+    for name, route, expected in ROUTES:
+        for i in range(warmup):
+            call(route, client, data)
+        latencies = []
+        started = time.time()
+        for i in range(requests):
+            start = time.time()
+            resp = call(route, client, data)
+            latencies.append(time.time() - start)
+            if resp.status_code != expected:
+                raise SystemExit('%s answered %d instead of %d' % (name, resp.status_code, expected))
+        results[name] = summarize(latencies, time.time() - started)
+    Order.remove_all()
+    return results
+
+######################################################################
+# Targets: the in-memory backend and a throwaway redis-server
+######################################################################
+def run_memory(args):
+    Order.use_db(MemoryBackend())
+    Order.use_cache(None)
+    server.initialize_encoder()
+    return bench_routes(args.orders, args.requests, args.warmup)
+
+def run_redis(args):
+    port = free_port()
+    process = subprocess.Popen([args.redis_server, '--port', str(port), '--save', '', '--appendonly', 'no'],
+                               stdout=open(os.devnull, 'w'))
+    try:
+        redis = wait_for_redis(port)
+        server.redis = redis
+        Order.use_db(redis)
+        server.initialize_cache()
+        server.initialize_encoder()
+        return bench_routes(args.orders, args.requests, args.warmup)
+    finally:
+        if server.invalidator:
+            server.invalidator.stop(wait=True)
+            server.invalidator = None
+        process.terminate()
+        process.wait()
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_for_redis(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        redis = server.connect_to_redis('127.0.0.1', port, None)
+        if redis:
+            return redis
+        time.sleep(0.1)
+    raise SystemExit('redis-server did not start on port %d' % port)
+
+TARGETS = {'memory': run_memory, 'redis': run_redis}
+
+######################################################################
+# Baseline comparison
+######################################################################
+def compare(results, baseline, tolerance):
+    """ Returns a message for every route slower than the baseline allows
+
+    A route regresses when its p50 or p90 latency grows, or its throughput
+    drops, by more than tolerance (0.5 is 50%)
+    """
+    regressions = []
+    for target, routes in results.items():
+        for name, now in routes.items():
+            before = baseline.get(target, {}).get(name)
+            if not before:
+                continue
+            for metric in ['p50_ms', 'p90_ms']:
+                if now[metric] > before[metric] * (1 + tolerance):
+                    regressions.append('%s %s %s %.2f > %.2f baseline' % (target, name, metric, now[metric], before[metric]))
+            if now['throughput_rps'] * (1 + tolerance) < before['throughput_rps']:
+                regressions.append('%s %s throughput_rps %.0f < %.0f baseline' % (target, name, now['throughput_rps'], before['throughput_rps']))
+    return regressions
+
+def print_table(results):
+    print >> sys.stderr, '{:<8} {:<18} {:>9} {:>9} {:>9} {:>10}'.format('target', 'route', 'p50 ms', 'p90 ms', 'p99 ms', 'req/s')
+    for target in sorted(results):
+        for name, route, expected in ROUTES:
+            row = results[target][name]
+            print >> sys.stderr, '{:<8} {:<18} {p50_ms:>9.2f} {p90_ms:>9.2f} {p99_ms:>9.2f} {throughput_rps:>10.0f}'.format(target, name, **row)
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the latency and throughput of every route')
+    parser.add_argument('--orders', type=int, default=10000, help='orders seeded before timing')
+    parser.add_argument('--requests', type=int, default=500, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=50, help='untimed requests per route')
+    parser.add_argument('--targets', default='memory,redis', help='comma separated: memory, redis')
+    parser.add_argument('--redis-server', default='redis-server', help='redis-server executable to start')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed slowdown before failing, 0.5 is 50%%')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    app.logger.disabled = True
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')   # the routes print as they go
+    try:
+        results = dict((target, TARGETS[target](args)) for target in args.targets.split(','))
+    finally:
+        sys.stdout = stdout
+
+    report = {
+        'orders': args.orders,
+        'requests': args.requests,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results
+    }
+    print_table(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print >> sys.stderr, 'Baseline saved to %s' % args.baseline
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print >> sys.stderr, 'No baseline at %s, run with --save-baseline to create one' % args.baseline
+        sys.exit(0)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if (baseline['orders'], baseline['requests']) != (args.orders, args.requests):
+        print >> sys.stderr, 'Warning: the baseline was taken with %d orders and %d requests per route' % (baseline['orders'], baseline['requests'])
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for regression in regressions:
+        print >> sys.stderr, 'REGRESSION ' + regression
+    sys.exit(1 if regressions else 0)
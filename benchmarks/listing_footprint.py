@@ -0,0 +1,119 @@
+######################################################################
+# Listing footprint benchmark
+#   Measures the peak memory and wall time of listing every Order three
+#   ways, each in its own process so peak RSS is not shared:
+#     legacy   dict based Orders with string amounts, a full list of
+#              objects, a full list of dicts and one json.dumps (the
+#              original list_orders)
+#     objects  the same full list built from the compact __slots__ Order
+#     rows     the row tuple path streamed one batch at a time (the
+#              current list_orders)
+#
+#   python benchmarks/listing_footprint.py --orders 1000000
+######################################################################
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from redis import Redis
+from app.models import Order
+from app.backends import RedisBackend
+
+BATCH_SIZE = 1000
+
+class LegacyOrder(object):
+    """ The Order model before __slots__: a plain __dict__ with string amounts """
+
+    def __init__(self, id=0, customer_name=None, amount_paid=None):
+        self.id = int(id)
+        self.customer_name = customer_name
+        self.amount_paid = amount_paid
+
+    def serialize(self):
+        return { "id": self.id, "customer_name": self.customer_name, "amount_paid": self.amount_paid }
+
+    def deserialize(self, data):
+        self.customer_name = data['customer_name']
+        self.amount_paid = data['amount_paid']
+        return self
+
+def all_ids(redis):
+    return redis.zrange(RedisBackend.IDS_KEY, 0, -1)
+
+def list_legacy(redis):
+    orders = []
+    ids = all_ids(redis)
+    for start in range(0, len(ids), BATCH_SIZE):
+        pipe = redis.pipeline(transaction=False)
+        for id in ids[start:start + BATCH_SIZE]:
+            pipe.hgetall(RedisBackend.order_key(id))
+        orders.extend(LegacyOrder(data['id']).deserialize(data) for data in pipe.execute())
+    results = [order.serialize() for order in orders]
+    return len(json.dumps(results))
+
+def list_objects(redis):
+    orders = list(Order.iter_all(BATCH_SIZE))
+    results = [order.serialize() for order in orders]
+    return len(json.dumps(results))
+
+def list_rows(redis):
+    size = 0
+    for rows in Order.iter_rows(all_ids(redis), BATCH_SIZE):
+        size += len(','.join(json.dumps(Order.row_dict(row)) for row in rows))
+    return size
+
+MODES = {'legacy': list_legacy, 'objects': list_objects, 'rows': list_rows}
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run_mode(args):
+    """ Runs one listing mode in this process and prints its measurements as JSON """
+    redis = Redis(host=args.host, port=args.port, db=args.db)
+    Order.use_db(redis)
+    baseline = max_rss_mb()
+    start = time.time()
+    size = MODES[args.mode](redis)
+    elapsed = time.time() - start
+    print json.dumps({'mode': args.mode, 'seconds': elapsed, 'peak_mb': max_rss_mb() - baseline, 'bytes': size})
+
+def seed(redis, count):
+    Order.remove_all()
+    for start in range(0, count, 10000):
+        Order.save_many([Order(0, 'customer-%d' % (i % 5000), i % 100000) for i in range(start, min(count, start + 10000))])
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the memory and time of listing every order')
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15, help='scratch database, its orders are replaced')
+    parser.add_argument('--mode', choices=sorted(MODES), help=argparse.SUPPRESS)
+    parser.add_argument('--no-seed', action='store_true', help='reuse the orders already in the scratch database')
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args)
+        sys.exit(0)
+
+    redis = Redis(host=args.host, port=args.port, db=args.db)
+    Order.use_db(redis)
+    if not args.no_seed:
+        print 'Seeding {} orders...'.format(args.orders)
+        seed(redis, args.orders)
+    print '{:<8} {:>10} {:>12} {:>14}'.format('mode', 'seconds', 'peak MB', 'bytes out')
+    for mode in ['legacy', 'objects', 'rows']:
+        command = [sys.executable, __file__, '--mode', mode, '--host', args.host,
+                   '--port', str(args.port), '--db', str(args.db)]
+        result = json.loads(subprocess.check_output(command))
+        print '{mode:<8} {seconds:>10.2f} {peak_mb:>12.1f} {bytes:>14}'.format(**result)
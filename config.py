@@ -1,3 +1,91 @@
+import os
 import logging
 SECRET_KEY = 'secret-for-dev'
 LOGGING_LEVEL = logging.INFO
+
+# Number of orders returned per page by GET /orders unless limit is given
+ORDERS_PAGE_SIZE = int(os.getenv('ORDERS_PAGE_SIZE', '100'))
+# Largest limit a client may ask for
+ORDERS_MAX_PAGE_SIZE = int(os.getenv('ORDERS_MAX_PAGE_SIZE', '1000'))
+# Number of orders fetched per Redis round trip while a list is streamed
+ORDERS_STREAM_BATCH_SIZE = int(os.getenv('ORDERS_STREAM_BATCH_SIZE', '100'))
+
+# Where Orders are stored: redis, or memory for single process dev runs
+ORDER_STORAGE = os.getenv('ORDER_STORAGE', 'redis')
+
+# Write-behind mode for creates: each worker queues new Orders and writes
+# them in one pipelined round trip every ORDER_WRITE_BEHIND_INTERVAL
+# milliseconds or ORDER_WRITE_BEHIND_BATCH Orders. With durability flushed
+# a create is answered once it is stored; with queued it is answered at
+# once and a crash loses up to one interval of creates
+ORDER_WRITE_BEHIND = (os.getenv('ORDER_WRITE_BEHIND', 'False') == 'True')
+ORDER_WRITE_BEHIND_INTERVAL = float(os.getenv('ORDER_WRITE_BEHIND_INTERVAL', '10'))
+ORDER_WRITE_BEHIND_BATCH = int(os.getenv('ORDER_WRITE_BEHIND_BATCH', '500'))
+ORDER_WRITE_BEHIND_DURABILITY = os.getenv('ORDER_WRITE_BEHIND_DURABILITY', 'flushed')
+
+# Responses to creates sent with an Idempotency-Key header are kept for
+# IDEMPOTENCY_TTL seconds and replayed to retries. A key stays claimed for
+# at most IDEMPOTENCY_LOCK_TTL seconds while its first request runs
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_LOCK_TTL = int(os.getenv('IDEMPOTENCY_LOCK_TTL', '60'))
+
+# Token bucket rate limits per client and route, written rate/burst: tokens
+# refilled per second / most tokens held. RATE_LIMITS overrides the default
+# RATE_LIMIT for the routes it names, a limit of 0 lifts it
+RATE_LIMIT_ENABLED = (os.getenv('RATE_LIMIT_ENABLED', 'False') == 'True')
+RATE_LIMIT = os.getenv('RATE_LIMIT', '100/200')
+RATE_LIMITS = {
+    'GET /orders': os.getenv('RATE_LIMIT_LIST_ORDERS', '20/40')
+}
+
+# Number of trusted proxies in front of the service. Each one appends the
+# address it saw to X-Forwarded-For, and the address added by the outermost
+# of them becomes the client address. With 0, X-Forwarded-For is ignored
+PROXY_COUNT = int(os.getenv('PROXY_COUNT', '0'))
+
+# Shed load with 503 once a worker serves SHED_MAX_IN_FLIGHT requests at
+# once or the recent average Redis round trip exceeds SHED_REDIS_LATENCY_MS
+# (0 turns either check off)
+SHED_MAX_IN_FLIGHT = int(os.getenv('SHED_MAX_IN_FLIGHT', '0'))
+SHED_REDIS_LATENCY_MS = float(os.getenv('SHED_REDIS_LATENCY_MS', '0'))
+
+# Largest JSON array accepted by POST /orders/bulk
+BULK_MAX_ORDERS = 10000
+
+# Most ids accepted by one GET /orders?ids= lookup
+LOOKUP_MAX_IDS = 1000
+
+# Redis connection pool (overridable from the environment or from the
+# VCAP_SERVICES credentials of the bound Redis service)
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '50'))
+REDIS_POOL_BLOCKING = (os.getenv('REDIS_POOL_BLOCKING', 'True') == 'True')
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', '5'))
+REDIS_SOCKET_KEEPALIVE = (os.getenv('REDIS_SOCKET_KEEPALIVE', 'True') == 'True')
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+
+# Encoder writing Orders as JSON on the read paths: json, or ujson when it
+# is installed. With ORDER_JSON_BLOBS every save also stores the Order's
+# JSON so reads send it without building an Order
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'json')
+ORDER_JSON_BLOBS = (os.getenv('ORDER_JSON_BLOBS', 'False') == 'True')
+
+# In-process cache in front of Order.find (ORDER_CACHE_SIZE=0 turns it off)
+ORDER_CACHE_SIZE = int(os.getenv('ORDER_CACHE_SIZE', '1024'))
+ORDER_CACHE_TTL = float(os.getenv('ORDER_CACHE_TTL', '30'))
+ORDER_CACHE_CHANNEL = 'order:invalidate'
+
+# Request and Redis metrics served at /metrics: each worker adds its
+# samples to the METRICS_KEY hash every METRICS_FLUSH_INTERVAL seconds
+METRICS_KEY = 'metrics:samples'
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+# Report the Redis commands, round trips and bytes of every request in
+# X-Redis-* response headers, to spot N+1 access patterns while debugging
+REDIS_CALL_HEADERS = (os.getenv('REDIS_CALL_HEADERS', 'False') == 'True')
+
+# gzip or deflate compression of responses, negotiated with Accept-Encoding.
+# Bodies under COMPRESS_MIN_SIZE bytes are sent as they are; the level runs
+# from 1 (fastest) to 9 (smallest), 0 turns compression off
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_MIMETYPES = ['application/json', 'application/x-ndjson', 'text/plain']
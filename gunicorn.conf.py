@@ -0,0 +1,70 @@
+######################################################################
+# Gunicorn settings for serving the Orders service in production
+#
+#   gunicorn -c gunicorn.conf.py run:app
+#
+# Every setting can be overridden from the environment:
+#   PORT                  port to listen on (5000)
+#   WEB_CONCURRENCY       worker processes (one per core)
+#   GUNICORN_THREADS      request threads per worker (4)
+#   GUNICORN_WORKER_CLASS gevent serves each request in a greenlet so a
+#                         worker is not capped by its thread count while
+#                         requests wait on Redis (gthread)
+#   GUNICORN_WORKER_CONNECTIONS
+#                         most requests a gevent worker serves at once (1000).
+#                         The Redis pool of a gevent worker is sized to
+#                         match unless REDIS_MAX_CONNECTIONS is set
+#   GUNICORN_TIMEOUT      seconds a request may run before its worker is
+#                         killed and replaced (30)
+#   GUNICORN_GRACEFUL_TIMEOUT
+#                         seconds workers get to finish their requests
+#                         on reload or shutdown (30)
+#   GUNICORN_MAX_REQUESTS requests after which a worker is recycled, 0
+#                         never recycles (0)
+#
+# Send HUP to the master for a graceful reload: new workers are started
+# with the current code and the old ones finish their requests first.
+######################################################################
+
+import os
+import multiprocessing
+
+bind = '0.0.0.0:%s' % os.getenv('PORT', '5000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS') or ('gthread' if threads > 1 else 'sync')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+
+# Every greenlet of a gevent worker may hold a Redis connection at once.
+# A smaller pool leaves requests waiting REDIS_POOL_TIMEOUT for one and
+# then failing, so give the workers, which read config.py after the fork,
+# a connection per greenlet
+if worker_class == 'gevent':
+    os.environ.setdefault('REDIS_MAX_CONNECTIONS', str(worker_connections))
+
+# The app is imported by each worker rather than by the master so that
+# a HUP reload picks up new code, and no Redis connection or cache
+# listener thread is ever shared across a fork
+preload_app = False
+
+accesslog = '-'
+errorlog = '-'
+
+def post_worker_init(worker):
+    """ Connects each worker to Redis once it has loaded the app """
+    from app import server
+    server.inititalize_redis()
+    worker.log.info('Worker %s connected to Redis', worker.pid)
+
+def worker_exit(server, worker):
+    """ Writes queued creates, stops the cache listener and hands over any unflushed metrics """
+    from app import server as orders, metrics
+    orders.stop_write_behind()
+    if orders.invalidator:
+        orders.invalidator.stop()
+    metrics.flush()
@@ -0,0 +1,35 @@
+import argparse
+from app import server
+from app.models import Order
+
+######################################################################
+#   M A I N T E N A N C E   C O M M A N D S
+######################################################################
+def migrate(args):
+    """ Moves Orders stored under bare integer keys into the order: namespace, amounts in cents """
+    migrated = Order.migrate_legacy_keys(args.batch_size)
+    print "Migrated {} orders".format(migrated)
+    normalized = Order.normalize_amounts(args.batch_size)
+    print "Converted the amount of {} orders to cents".format(normalized)
+
+def rebuild_stats(args):
+    """ Recomputes the order stats from scratch when drift is suspected """
+    stats = Order.rebuild_stats(args.batch_size)
+    print "Rebuilt stats for {count} orders totalling {total_amount_paid}".format(**stats)
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Orders service maintenance commands')
+    commands = parser.add_subparsers()
+    migrate_parser = commands.add_parser('migrate', help='rewrite legacy bare-integer keys')
+    migrate_parser.add_argument('--batch-size', type=int, default=Order.BATCH_SIZE)
+    migrate_parser.set_defaults(func=migrate)
+    stats_parser = commands.add_parser('rebuild_stats', help='recompute the order stats from every order')
+    stats_parser.add_argument('--batch-size', type=int, default=Order.BATCH_SIZE)
+    stats_parser.set_defaults(func=rebuild_stats)
+    args = parser.parse_args()
+
+    server.inititalize_redis()
+    args.func(args)
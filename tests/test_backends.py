@@ -0,0 +1,189 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest
+import json
+from app.models import Order
+from app.backends import RedisBackend, MemoryBackend
+from app.encoders import stdlib, get_encoder
+from app import server
+
+######################################################################
+#  T E S T   C A S E S
+#    The same model tests run against every storage backend
+######################################################################
+class BackendTests(object):
+
+    def test_create_and_find(self):
+        order = Order(0, "Tom", 200)
+        order.save()
+        self.assertEqual( order.id, 1 )
+        found = Order.find(1)
+        self.assertEqual( found.customer_name, "Tom" )
+        self.assertEqual( found.amount_paid, 200 )
+        self.assertIs( Order.find(2), None )
+
+    def test_update_moves_indexes(self):
+        order = Order(0, "Tom", 200)
+        order.save()
+        order.customer_name = "Bob"
+        order.amount_paid = 700
+        order.save()
+        self.assertEqual( Order.customer_ids("Tom"), [] )
+        self.assertEqual( Order.customer_ids("Bob"), [1] )
+        self.assertEqual( Order.page_ids_by_amount(100, 500)[0], [] )
+        self.assertEqual( Order.page_ids_by_amount(600, 800)[0], [1] )
+        self.assertEqual( Order.stats("Bob"), {'count': 1, 'total_amount_paid': 700} )
+
+    def test_delete(self):
+        order = Order(0, "Tom", 200)
+        order.save()
+        order.delete()
+        self.assertIs( Order.find(1), None )
+        self.assertEqual( Order.page_ids(), ([], None) )
+        self.assertEqual( Order.customer_ids("Tom"), [] )
+        self.assertEqual( Order.stats(), {'count': 0, 'total_amount_paid': 0} )
+
+    def test_save_many_and_paging(self):
+        Order.save_many([Order(0, "Tom", amount) for amount in [50, 200, 200, 200, 300]])
+        ids, next_id = Order.page_ids(0, 2)
+        self.assertEqual( (ids, next_id), ([1, 2], 2) )
+        self.assertEqual( Order.page_ids(next_id, 3), ([3, 4, 5], None) )
+        ids, position = Order.page_ids_by_amount(100, 500, limit=2)
+        self.assertEqual( ids, [2, 3] )
+        ids, position = Order.page_ids_by_amount(100, 500, position, limit=2)
+        self.assertEqual( (ids, position), ([4, 5], None) )
+
+    def test_rows_and_find_many(self):
+        Order.save_many([Order(0, "Tom", 200), Order(0, "Bob", 300)])
+        self.assertEqual( list(Order.iter_rows([2, 9, 1])), [[(2, "Bob", 300), (1, "Tom", 200)]] )
+        orders = Order.find_many([2, 9])
+        self.assertEqual( orders[0].customer_name, "Bob" )
+        self.assertIs( orders[1], None )
+
+    def test_rebuild_stats(self):
+        Order(0, "Tom", 200).save()
+        Order(0, "Bob", 300).save()
+        self.assertEqual( Order.rebuild_stats(), {'count': 2, 'total_amount_paid': 500} )
+        self.assertEqual( Order.stats("Tom"), {'count': 1, 'total_amount_paid': 200} )
+
+    def test_remove_all(self):
+        Order(0, "Tom", 200).save()
+        Order.remove_all()
+        self.assertEqual( Order.all(), [] )
+        self.assertEqual( Order.stats(), {'count': 0, 'total_amount_paid': 0} )
+
+    def test_versions_follow_the_generation(self):
+        order = Order(0, "Tom", 200)
+        order.save()
+        first = order.version
+        self.assertEqual( Order.find_version(1), first )
+        order.amount_paid = 300
+        order.save()
+        self.assertTrue( order.version > first )
+        self.assertEqual( Order.find(1).version, order.version )
+        self.assertEqual( Order.generation(), order.version )
+        orders = Order.save_many([Order(0, "Bob", 100), Order(0, "Kate", 100)])
+        self.assertEqual( [o.version for o in orders], [order.version + 1, order.version + 2] )
+        self.assertIs( Order.find_version(9), None )
+
+    def test_generation_survives_remove_all(self):
+        Order(0, "Tom", 200).save()
+        before = Order.generation()
+        Order.remove_all()
+        self.assertTrue( Order.generation() > before )
+        order = Order(0, "Tom", 200)
+        order.save()
+        self.assertTrue( order.version > before )
+
+    def test_amount_out_of_range_is_not_tallied(self):
+        id, version = Order.db().create({'customer_name': 'Tom', 'amount_paid': str(10**20)})
+        self.assertEqual( Order.db().stats(), (1, 0) )
+        self.assertEqual( Order.page_ids_by_amount()[0], [] )
+
+    def test_json_without_blobs(self):
+        Order.save_many([Order(0, "Tom", 200), Order(0, "Bob", 300)])
+        self.assertEqual( Order.find_json(1), ('{"amount_paid":200,"customer_name":"Tom","id":1}', Order.find(1).version) )
+        self.assertEqual( Order.find_json(9), (None, None) )
+        self.assertEqual( list(Order.iter_json([2, 9, 1])), [['{"amount_paid":300,"customer_name":"Bob","id":2}',
+                                                               '{"amount_paid":200,"customer_name":"Tom","id":1}']] )
+
+    def test_json_blobs(self):
+        self.addCleanup(Order.use_encoder, stdlib)
+        Order.use_encoder(stdlib, store_json=True)
+        order = Order(0, "Tom", 200)
+        order.save()
+        Order.save_many([Order(0, "Bob", 300)])
+        self.assertEqual( Order.db().get(1)['json'], '{"amount_paid":200,"customer_name":"Tom"}' )
+        self.assertEqual( Order.find_json(1)[0], order.to_json() )
+        self.assertEqual( list(Order.iter_json([1, 2])), [[order.to_json(), '{"amount_paid":300,"customer_name":"Bob","id":2}']] )
+
+    def test_save_without_blobs_drops_the_stored_one(self):
+        Order.use_encoder(stdlib, store_json=True)
+        order = Order(0, "Tom", 200)
+        order.save()
+        Order.use_encoder(stdlib)
+        order.amount_paid = 700
+        order.save()
+        self.assertEqual( json.loads(Order.find_json(1)[0])['amount_paid'], 700 )
+        self.assertEqual( json.loads(list(Order.iter_json([1]))[0][0])['amount_paid'], 700 )
+
+    def test_encoders_agree(self):
+        try:
+            encoder = get_encoder('ujson')
+        except ImportError:
+            raise unittest.SkipTest('ujson is not installed')
+        for name in [u"Zo\u00eb \"Z\"", u"A/B Corp", u"del\x7f", u"\U0001f600 \u2028 \x01\t"]:
+            data = {"id": 1, "customer_name": name, "amount_paid": 200}
+            self.assertEqual( encoder(data), stdlib(data) )
+        self.assertEqual( encoder({"b": 1, "a": 2}), '{"a":2,"b":1}' )
+
+
+class TestRedisBackend(BackendTests, unittest.TestCase):
+
+    def setUp(self):
+        server.inititalize_redis()
+        Order.use_db(server.redis)
+        Order.remove_all()
+
+    def tearDown(self):
+        Order.remove_all()
+
+    def test_use_db_wraps_redis(self):
+        self.assertIsInstance( Order.db(), RedisBackend )
+
+    def test_generation_moves_on_after_bulk_writes(self):
+        db = Order.db()
+        reserve = db.reserve
+        seen = []
+        def reserve_then_list(count):
+            first = reserve(count)
+            # a list tagged here sees none of the batch yet
+            seen.append(db.generation())
+            return first
+        db.reserve = reserve_then_list
+        Order.save_many([Order(0, "Tom", 200), Order(0, "Bob", 300)])
+        self.assertTrue( db.generation() > seen[0] )
+
+
+class TestMemoryBackend(BackendTests, unittest.TestCase):
+
+    def setUp(self):
+        Order.use_db(MemoryBackend())
+        Order.use_cache(None)
+
+    def tearDown(self):
+        server.inititalize_redis()
+
+    def test_orders_stay_in_process(self):
+        Order(0, "Tom", 200).save()
+        self.assertIsInstance( Order.db(), MemoryBackend )
+        self.assertEqual( Order.migrate_legacy_keys(), 0 )
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest
+import time
+import json
+from app.cache import LRUCache, CacheInvalidator, CLEAR_ALL
+from app import server
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = LRUCache(max_size=2, ttl=10, clock=lambda: self.now)
+
+    def test_get_and_set(self):
+        self.assertIs( self.cache.get(1), None )
+        self.cache.set(1, 'Tom')
+        self.assertEqual( self.cache.get(1), 'Tom' )
+        stats = self.cache.stats()
+        self.assertEqual( stats['hits'], 1 )
+        self.assertEqual( stats['misses'], 1 )
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set(1, 'Tom')
+        self.cache.set(2, 'Bob')
+        self.cache.get(1)
+        self.cache.set(3, 'Kate')
+        self.assertIs( self.cache.get(2), None )
+        self.assertEqual( self.cache.get(1), 'Tom' )
+        self.assertEqual( self.cache.get(3), 'Kate' )
+        self.assertEqual( self.cache.stats()['evictions'], 1 )
+
+    def test_entries_expire(self):
+        self.cache.set(1, 'Tom')
+        self.now += 11
+        self.assertIs( self.cache.get(1), None )
+        self.assertEqual( self.cache.stats()['expirations'], 1 )
+        self.assertEqual( self.cache.stats()['size'], 0 )
+
+    def test_invalidate_and_clear(self):
+        self.cache.set(1, 'Tom')
+        self.cache.set(2, 'Bob')
+        self.cache.invalidate(1)
+        self.assertIs( self.cache.get(1), None )
+        self.cache.clear()
+        self.assertIs( self.cache.get(2), None )
+        self.assertEqual( self.cache.stats()['invalidations'], 2 )
+
+    def test_fill_racing_an_invalidation_is_dropped(self):
+        epoch = self.cache.epoch()
+        # order 1 is read, then invalidated before the read is cached
+        self.cache.invalidate(1)
+        self.cache.set(1, 'stale Tom', epoch)
+        self.assertIs( self.cache.get(1), None )
+        self.assertEqual( self.cache.stats()['stale_fills'], 1 )
+        self.cache.set(1, 'Tom', self.cache.epoch())
+        self.assertEqual( self.cache.get(1), 'Tom' )
+
+    def test_invalidation_reaches_other_workers(self):
+        server.inititalize_redis()
+        invalidator = CacheInvalidator(server.redis, self.cache, 'order:test-invalidate').start(0.01)
+        try:
+            self.cache.set(1, 'Tom')
+            self.cache.set(2, 'Bob')
+            # another worker writing order 1 publishes its id
+            CacheInvalidator(server.redis, LRUCache(), 'order:test-invalidate').publish(1)
+            self.assertTrue( self.wait_for(lambda: self.cache.stats()['size'] == 1) )
+            self.assertEqual( self.cache.get(2), 'Bob' )
+            server.redis.publish('order:test-invalidate', CLEAR_ALL)
+            self.assertTrue( self.wait_for(lambda: self.cache.stats()['size'] == 0) )
+        finally:
+            invalidator.stop()
+
+    def test_resubscribes_after_losing_redis(self):
+        server.inititalize_redis()
+        invalidator = CacheInvalidator(server.redis, self.cache, 'order:test-invalidate', retry_interval=0.01).start(0.01)
+        try:
+            self.assertTrue( invalidator.healthy )
+            self.cache.set(1, 'Tom')
+            connection = invalidator._pubsub.connection
+            server.redis.client_kill('%s:%d' % connection._sock.getsockname())
+            self.assertTrue( self.wait_for(lambda: invalidator.reconnects == 1 and invalidator.healthy) )
+            # an invalidation could have been missed, so nothing cached survives
+            self.assertIs( self.cache.get(1), None )
+            self.cache.set(2, 'Bob')
+            server.redis.publish('order:test-invalidate', 2)
+            self.assertTrue( self.wait_for(lambda: self.cache.stats()['size'] == 0) )
+        finally:
+            invalidator.stop(wait=True)
+        self.assertFalse( invalidator.healthy )
+
+    def test_cache_is_bypassed_while_not_listening(self):
+        server.inititalize_redis()
+        server.data_reset()
+        server.Order(customer_name='Tom', amount_paid='1').save()
+        self.assertEqual( self.app_get('/orders/1'), 200 )
+        self.assertEqual( self.app_get('/orders/1'), 200 )
+        self.assertEqual( server.invalidator.cache.stats()['hits'], 1 )
+        server.invalidator.healthy = False
+        try:
+            self.assertEqual( self.app_get('/orders/1'), 200 )
+            stats = server.invalidator.cache.stats()
+            self.assertEqual( stats['hits'], 1 )
+            resp = server.app.test_client().get('/cache/stats')
+            self.assertFalse( json.loads(resp.data)['listening'] )
+        finally:
+            server.inititalize_redis()
+            server.data_reset()
+
+######################################################################
+# Utility functions
+######################################################################
+
+    def app_get(self, url):
+        return server.app.test_client().get(url).status_code
+
+    def wait_for(self, condition, timeout=2.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest
+import json
+import zlib
+from werkzeug.http import parse_accept_header
+from app import server
+from app.models import Order
+from app.compression import negotiate, compress_stream
+
+GZIP = 16 + zlib.MAX_WBITS
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestNegotiation(unittest.TestCase):
+
+    def test_prefers_gzip(self):
+        self.assertEqual( negotiate(parse_accept_header('deflate, gzip')), 'gzip' )
+        self.assertEqual( negotiate(parse_accept_header('*')), 'gzip' )
+
+    def test_follows_quality(self):
+        self.assertEqual( negotiate(parse_accept_header('gzip;q=0.1, deflate;q=0.5')), 'deflate' )
+        self.assertEqual( negotiate(parse_accept_header('gzip;q=0, deflate')), 'deflate' )
+
+    def test_nothing_acceptable(self):
+        self.assertIs( negotiate(parse_accept_header('')), None )
+        self.assertIs( negotiate(parse_accept_header('identity')), None )
+        self.assertIs( negotiate(parse_accept_header('gzip;q=0')), None )
+
+    def test_stream_is_readable_chunk_by_chunk(self):
+        chunks = compress_stream(['[1,', '2,'], iter(['3]']), None, 'gzip', 6)
+        reader = zlib.decompressobj(GZIP)
+        self.assertEqual( reader.decompress(next(chunks)), '[1,' )
+        self.assertEqual( reader.decompress(next(chunks)), '2,' )
+        self.assertEqual( reader.decompress(''.join(chunks)), '3]' )
+
+
+class TestCompressedResponses(unittest.TestCase):
+
+    def setUp(self):
+        server.app.debug = True
+        server.inititalize_redis()
+        server.data_reset()
+        Order.save_many([Order(0, 'customer-%d' % i, i) for i in range(100)])
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        server.app.config['COMPRESS_LEVEL'] = 6
+        server.data_reset()
+
+    def test_streamed_list_is_gzipped(self):
+        resp = self.app.get('/orders', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual( resp.status_code, 200 )
+        self.assertEqual( resp.headers['Content-Encoding'], 'gzip' )
+        self.assertEqual( resp.headers['Vary'], 'Accept-Encoding' )
+        self.assertNotIn( 'Content-Length', resp.headers )
+        data = json.loads(zlib.decompress(resp.get_data(), GZIP))
+        self.assertEqual( len(data), 100 )
+
+    def test_deflate(self):
+        resp = self.app.get('/orders', headers={'Accept-Encoding': 'deflate', 'Accept': 'application/x-ndjson'})
+        self.assertEqual( resp.headers['Content-Encoding'], 'deflate' )
+        self.assertEqual( len(zlib.decompress(resp.get_data()).splitlines()), 100 )
+
+    def test_small_responses_are_sent_as_they_are(self):
+        resp = self.app.get('/orders/1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn( 'Content-Encoding', resp.headers )
+        self.assertEqual( resp.headers['Vary'], 'Accept-Encoding' )
+        resp = self.app.get('/orders', query_string='limit=2', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn( 'Content-Encoding', resp.headers )
+        self.assertEqual( len(json.loads(resp.data)), 2 )
+
+    def test_only_when_accepted(self):
+        resp = self.app.get('/orders')
+        self.assertNotIn( 'Content-Encoding', resp.headers )
+        self.assertEqual( len(json.loads(resp.data)), 100 )
+
+    def test_turned_off(self):
+        server.app.config['COMPRESS_LEVEL'] = 0
+        resp = self.app.get('/orders', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn( 'Content-Encoding', resp.headers )
+
+    def test_compressed_etag_is_weak(self):
+        resp = self.app.get('/orders', headers={'Accept-Encoding': 'gzip'})
+        etag = resp.headers['ETag']
+        self.assertTrue( etag.startswith('W/') )
+        resp = self.app.get('/orders', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual( resp.status_code, 304 )
+        self.assertNotIn( 'Content-Encoding', resp.headers )
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest
+import json
+from app import server
+from app.models import Order
+from app.idempotency import fingerprint
+
+TOM = json.dumps({'customer_name': 'Tom', 'amount_paid': 200})
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestIdempotencyKeys(unittest.TestCase):
+
+    def setUp(self):
+        server.app.debug = True
+        server.inititalize_redis()
+        server.data_reset()
+        self.clear_keys()
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        server.data_reset()
+        self.clear_keys()
+
+    def clear_keys(self):
+        keys = list(server.redis.scan_iter(match='idempotency:*'))
+        if keys:
+            server.redis.delete(*keys)
+
+    def post(self, body, key):
+        return self.app.post('/orders', data=body, content_type='application/json', headers={'Idempotency-Key': key})
+
+    def test_retried_create_is_replayed(self):
+        first = self.post(TOM, 'abc')
+        self.assertEqual( first.status_code, 201 )
+        self.assertNotIn( 'Idempotent-Replayed', first.headers )
+        second = self.post(TOM, 'abc')
+        self.assertEqual( second.status_code, 201 )
+        self.assertEqual( second.headers['Idempotent-Replayed'], 'true' )
+        self.assertEqual( second.headers['Location'], first.headers['Location'] )
+        self.assertEqual( second.headers['ETag'], first.headers['ETag'] )
+        self.assertEqual( second.data, first.data )
+        self.assertEqual( Order.stats()['count'], 1 )
+
+    def test_other_keys_create_again(self):
+        self.post(TOM, 'abc')
+        self.post(TOM, 'def')
+        self.app.post('/orders', data=TOM, content_type='application/json')
+        self.assertEqual( Order.stats()['count'], 3 )
+
+    def test_key_reused_for_another_request(self):
+        self.post(TOM, 'abc')
+        resp = self.post(json.dumps({'customer_name': 'Bob', 'amount_paid': 300}), 'abc')
+        self.assertEqual( resp.status_code, 422 )
+        self.assertEqual( Order.stats()['count'], 1 )
+
+    def test_request_still_in_progress(self):
+        server.idempotency.claim('/orders', 'abc', fingerprint('POST', '/orders', TOM))
+        resp = self.post(TOM, 'abc')
+        self.assertEqual( resp.status_code, 409 )
+        self.assertEqual( resp.headers['Retry-After'], '1' )
+        self.assertEqual( Order.stats()['count'], 0 )
+
+    def test_failed_request_frees_the_key(self):
+        resp = self.post(json.dumps({'customer_name': 'Tom'}), 'abc')
+        self.assertEqual( resp.status_code, 400 )
+        self.assertEqual( list(server.redis.scan_iter(match='idempotency:*')), [] )
+
+    def test_keys_expire(self):
+        self.post(TOM, 'abc')
+        ttl = server.redis.ttl('idempotency:/orders:abc')
+        self.assertTrue( 0 < ttl <= server.app.config['IDEMPOTENCY_TTL'] )
+
+    def test_retried_duplicate_is_replayed(self):
+        server.data_load({'customer_name': 'Tom', 'amount_paid': 200})
+        headers = {'Idempotency-Key': 'abc'}
+        first = self.app.put('/orders/1/duplicate', headers=headers)
+        second = self.app.put('/orders/1/duplicate', headers=headers)
+        self.assertEqual( (first.status_code, second.status_code), (201, 201) )
+        self.assertEqual( json.loads(second.data)['id'], 2 )
+        self.assertEqual( Order.stats()['count'], 2 )
+
+    def test_key_too_long(self):
+        resp = self.post(TOM, 'x' * 256)
+        self.assertEqual( resp.status_code, 400 )
+
+    def test_key_not_ascii(self):
+        for key in [u'cl\xe9', 'tab\tkey']:
+            resp = self.post(TOM, key)
+            self.assertEqual( resp.status_code, 400 )
+            self.assertIn( 'printable ASCII', json.loads(resp.data)['message'] )
+        self.assertEqual( Order.stats()['count'], 0 )
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest
+import json
+from redis.exceptions import ConnectionError
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app import server
+from app.limits import parse_limit, TokenBucketLimiter, LoadShedder
+from app.monitoring import LatencyTracker
+
+class Clock(object):
+    """ A clock moved by hand """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class DeadRedis(object):
+    """ A Redis client that cannot reach its server """
+
+    def evalsha(self, *args):
+        raise ConnectionError('Redis went away')
+
+def clear_buckets():
+    keys = list(server.redis.scan_iter(match='ratelimit:*'))
+    if keys:
+        server.redis.delete(*keys)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestTokenBucketLimiter(unittest.TestCase):
+
+    def setUp(self):
+        server.inititalize_redis()
+        clear_buckets()
+        self.clock = Clock()
+        self.limiter = TokenBucketLimiter(server.redis, '2/3', {'GET /orders': '1/1', 'GET /': '0'}, clock=self.clock)
+
+    def tearDown(self):
+        clear_buckets()
+
+    def test_parse_limit(self):
+        self.assertEqual( parse_limit('20/40'), (20, 40) )
+        self.assertEqual( parse_limit('5'), (5, 5) )
+        self.assertEqual( parse_limit('0'), None )
+        self.assertRaises( ValueError, parse_limit, '-1/5' )
+
+    def test_burst_then_refuse(self):
+        results = [self.limiter.take('GET /orders/<int:id>', 'a') for i in range(4)]
+        self.assertEqual( [r[0] for r in results], [True, True, True, False] )
+        self.assertEqual( results[2][1], 0 )
+        self.assertEqual( results[3][2], 1 )
+
+    def test_tokens_refill(self):
+        for i in range(3):
+            self.limiter.take('GET /orders/<int:id>', 'a')
+        self.assertFalse( self.limiter.take('GET /orders/<int:id>', 'a')[0] )
+        self.clock.now += 0.5
+        self.assertTrue( self.limiter.take('GET /orders/<int:id>', 'a')[0] )
+        self.assertFalse( self.limiter.take('GET /orders/<int:id>', 'a')[0] )
+        self.clock.now += 10
+        self.assertEqual( self.limiter.take('GET /orders/<int:id>', 'a')[1], 2 )
+
+    def test_buckets_per_client_and_route(self):
+        self.assertTrue( self.limiter.take('GET /orders', 'a')[0] )
+        self.assertFalse( self.limiter.take('GET /orders', 'a')[0] )
+        self.assertTrue( self.limiter.take('GET /orders', 'b')[0] )
+        self.assertTrue( self.limiter.take('GET /orders/<int:id>', 'a')[0] )
+
+    def test_unlimited_route(self):
+        for i in range(10):
+            self.assertTrue( self.limiter.take('GET /', 'a')[0] )
+        self.assertEqual( list(server.redis.scan_iter(match='ratelimit:*')), [] )
+
+    def test_buckets_expire(self):
+        self.limiter.take('GET /orders', 'a')
+        self.assertTrue( 0 < server.redis.pttl('ratelimit:GET /orders:a') <= 2000 )
+
+    def test_clock_behind_adds_no_tokens(self):
+        self.limiter.take('GET /orders', 'a')
+        self.clock.now -= 5
+        self.assertFalse( self.limiter.take('GET /orders', 'a')[0] )
+
+    def test_fails_open_without_redis(self):
+        self.limiter.scripts.redis = DeadRedis()
+        self.assertEqual( self.limiter.take('GET /orders', 'a'), (True, None, 0) )
+
+
+class TestLoadShedder(unittest.TestCase):
+
+    def test_sheds_over_max_in_flight(self):
+        shedder = LoadShedder(max_in_flight=2)
+        self.assertEqual( (shedder.enter(), shedder.enter()), (None, None) )
+        self.assertEqual( shedder.enter(), 'in_flight' )
+        shedder.leave()
+        self.assertEqual( shedder.enter(), None )
+        self.assertEqual( shedder.in_flight, 2 )
+
+    def test_sheds_on_redis_latency_and_recovers(self):
+        clock = Clock()
+        latency = LatencyTracker(tau=1.0, clock=clock)
+        shedder = LoadShedder(max_latency=0.05, latency=latency)
+        for i in range(20):
+            clock.now += 0.1
+            latency.observe(0.2)
+        self.assertEqual( shedder.enter(), 'redis_latency' )
+        clock.now += 5
+        self.assertEqual( shedder.enter(), None )
+
+
+class TestLimitedRequests(unittest.TestCase):
+
+    def setUp(self):
+        server.app.debug = True
+        server.app.config['RATE_LIMIT_ENABLED'] = True
+        server.app.config['RATE_LIMITS'] = {'GET /orders': '1/2'}
+        server.inititalize_redis()
+        server.data_reset()
+        clear_buckets()
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        server.app.config['RATE_LIMIT_ENABLED'] = False
+        server.app.config['RATE_LIMITS'] = {'GET /orders': '20/40'}
+        server.app.config['SHED_MAX_IN_FLIGHT'] = 0
+        server.inititalize_redis()
+        server.data_reset()
+        clear_buckets()
+
+    def test_too_many_requests(self):
+        codes = [self.app.get('/orders').status_code for i in range(3)]
+        self.assertEqual( codes, [200, 200, 429] )
+        resp = self.app.get('/orders')
+        self.assertEqual( resp.headers['Retry-After'], '1' )
+        self.assertEqual( json.loads(resp.data)['error'], 'Too Many Requests' )
+
+    def test_clients_are_limited_apart(self):
+        for i in range(3):
+            self.app.get('/orders', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        resp = self.app.get('/orders', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual( resp.status_code, 200 )
+
+    def test_forwarded_for_is_not_trusted(self):
+        codes = [self.app.get('/orders', headers={'X-Forwarded-For': '10.9.0.%d' % i}).status_code for i in range(3)]
+        self.assertEqual( codes, [200, 200, 429] )
+
+    def test_forwarded_for_of_trusted_proxies(self):
+        self.addCleanup(setattr, server.app, 'wsgi_app', server.app.wsgi_app)
+        server.app.wsgi_app = ProxyFix(server.app.wsgi_app, x_for=1, x_proto=0)
+        for i in range(3):
+            self.app.get('/orders', headers={'X-Forwarded-For': '6.6.6.%d, 10.0.0.1' % i})
+        resp = self.app.get('/orders', headers={'X-Forwarded-For': '10.0.0.2'})
+        self.assertEqual( resp.status_code, 200 )
+        self.assertEqual( self.app.get('/orders', headers={'X-Forwarded-For': '10.0.0.1'}).status_code, 429 )
+
+    def test_routes_are_limited_apart(self):
+        for i in range(3):
+            self.app.get('/orders')
+        self.assertEqual( self.app.get('/orders/1').status_code, 404 )
+
+    def test_metrics_are_never_limited(self):
+        server.app.config['RATE_LIMITS'] = {'GET /metrics': '1/1'}
+        server.initialize_limits()
+        codes = [self.app.get('/metrics').status_code for i in range(3)]
+        self.assertEqual( codes, [200, 200, 200] )
+
+    def test_shed_when_too_many_in_flight(self):
+        server.app.config['SHED_MAX_IN_FLIGHT'] = 1
+        server.initialize_limits()
+        self.assertEqual( self.app.get('/orders/1').status_code, 404 )
+        self.assertEqual( server.shedder.in_flight, 0 )
+        server.shedder.enter()
+        resp = self.app.get('/orders/1')
+        self.assertEqual( resp.status_code, 503 )
+        self.assertEqual( resp.headers['Retry-After'], '1' )
+        server.shedder.leave()
+        self.assertEqual( self.app.get('/orders/1').status_code, 404 )
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest
+from app import server, metrics
+from app.models import Order
+from app.monitoring import Metrics, format_labels, payload_size
+
+KEY = 'metrics:test'
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        server.inititalize_redis()
+        Metrics(server.redis, KEY).reset()
+
+    def tearDown(self):
+        Metrics(server.redis, KEY).reset()
+
+    def test_counters_and_histograms(self):
+        registry = Metrics()
+        registry.inc('http_requests_total', {'route': '/orders', 'status': 200})
+        registry.inc('http_requests_total', {'route': '/orders', 'status': 200})
+        registry.observe('http_request_duration_seconds', {'route': '/orders'}, 0.003)
+        samples = registry.samples()
+        self.assertEqual( samples['http_requests_total{route="/orders",status="200"}'], 2 )
+        self.assertEqual( samples['http_request_duration_seconds_bucket{route="/orders",le="0.0025"}'], 0 )
+        self.assertEqual( samples['http_request_duration_seconds_bucket{route="/orders",le="0.005"}'], 1 )
+        self.assertEqual( samples['http_request_duration_seconds_bucket{route="/orders",le="+Inf"}'], 1 )
+        self.assertEqual( samples['http_request_duration_seconds_count{route="/orders"}'], 1 )
+
+    def test_workers_add_up_through_redis(self):
+        first = Metrics(server.redis, KEY)
+        second = Metrics(server.redis, KEY)
+        first.inc('http_requests_total', {'status': 200})
+        second.inc('http_requests_total', {'status': 200})
+        first.add_gauge('http_requests_in_flight', {}, 1)
+        second.add_gauge('http_requests_in_flight', {}, 1)
+        second.add_gauge('http_requests_in_flight', {}, -1)
+        second.flush()
+        samples = first.samples()
+        self.assertEqual( samples['http_requests_total{status="200"}'], 2 )
+        self.assertEqual( samples['http_requests_in_flight'], 1 )
+
+    def test_gauges_of_dead_workers_expire(self):
+        alive = Metrics(server.redis, KEY, flush_interval=1)
+        dead = Metrics(server.redis, KEY, flush_interval=1)
+        dead.add_gauge('http_requests_in_flight', {}, 1)
+        dead.flush()
+        self.assertTrue( 0 < server.redis.ttl(dead.gauge_key()) <= 3 )
+        self.assertEqual( alive.samples()['http_requests_in_flight'], 1 )
+        self.assertEqual( server.redis.hgetall(KEY), {} )
+        # the worker was killed mid-request and its gauges ran out
+        server.redis.delete(dead.gauge_key())
+        self.assertNotIn( 'http_requests_in_flight', alive.samples() )
+
+    def test_flushes_only_after_the_interval(self):
+        now = [0]
+        registry = Metrics(server.redis, KEY, flush_interval=5, clock=lambda: now[0])
+        registry.inc('redis_commands_total', {'command': 'GET'})
+        registry.maybe_flush()
+        self.assertEqual( server.redis.hgetall(KEY), {} )
+        now[0] = 5
+        registry.maybe_flush()
+        self.assertEqual( server.redis.hgetall(KEY), {'redis_commands_total{command="GET"}': '1'} )
+
+    def test_render(self):
+        registry = Metrics()
+        registry.observe('redis_command_duration_seconds', {'command': 'GET'}, 20)
+        text = registry.render()
+        self.assertIn( '# TYPE redis_command_duration_seconds histogram\n', text )
+        self.assertIn( 'redis_command_duration_seconds_bucket{command="GET",le="10.0"} 0\n', text )
+        self.assertIn( 'redis_command_duration_seconds_bucket{command="GET",le="+Inf"} 1\n', text )
+        self.assertLess( text.index('le="10.0"'), text.index('le="+Inf"') )
+        self.assertIn( 'redis_command_duration_seconds_sum{command="GET"} 20\n', text )
+
+    def test_label_values_are_escaped(self):
+        self.assertEqual( format_labels({'name': 'a"b\\c\n'}), '{name="a\\"b\\\\c\\n"}' )
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        server.app.debug = True
+        server.inititalize_redis()
+        metrics.reset()
+        self.app = server.app.test_client()
+
+    def test_requests_are_counted(self):
+        self.app.get('/orders/1')
+        resp = self.app.get('/metrics')
+        self.assertEqual( resp.status_code, 200 )
+        self.assertTrue( resp.content_type.startswith('text/plain') )
+        text = resp.get_data()
+        self.assertIn( 'http_requests_total{method="GET",route="/orders/<int:id>",status="404"} 1\n', text )
+        self.assertIn( 'http_request_duration_seconds_count{method="GET",route="/orders/<int:id>",status="404"} 1\n', text )
+        self.assertIn( 'redis_commands_total{command="HGETALL"}', text )
+
+
+class TestRedisCallHeaders(unittest.TestCase):
+
+    def setUp(self):
+        server.app.debug = True
+        server.app.config['REDIS_CALL_HEADERS'] = True
+        server.inititalize_redis()
+        Order.use_cache(None)   # every read goes to Redis
+        server.data_reset()
+        server.data_load({"customer_name": "Tom", "amount_paid": "200"})
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        server.app.config['REDIS_CALL_HEADERS'] = False
+        server.initialize_cache()
+
+    def test_get_is_one_round_trip(self):
+        resp = self.app.get('/orders/1')
+        self.assertEqual( resp.headers['X-Redis-Calls'], '1' )
+        self.assertEqual( resp.headers['X-Redis-Round-Trips'], '1' )
+        self.assertTrue( int(resp.headers['X-Redis-Bytes-Sent']) > len('HGETALL order:1') )
+        self.assertTrue( int(resp.headers['X-Redis-Bytes-Received']) >= len('customer_name' + 'Tom') )
+
+    def test_duplicate_is_two_round_trips(self):
+        resp = self.app.put('/orders/1/duplicate')
+        self.assertEqual( resp.status_code, 201 )
+        self.assertEqual( resp.headers['X-Redis-Round-Trips'], '2' )
+
+    def test_bulk_lookup_is_one_round_trip(self):
+        resp = self.app.get('/orders', query_string='ids=1,2,3')
+        self.assertEqual( resp.headers['X-Redis-Round-Trips'], '1' )
+        self.assertEqual( resp.headers['X-Redis-Calls'], '3' )
+
+    def test_conditional_get_reads_only_the_version(self):
+        etag = self.app.get('/orders/1').headers['ETag']
+        resp = self.app.get('/orders/1', headers={'If-None-Match': etag})
+        self.assertEqual( resp.status_code, 304 )
+        self.assertEqual( resp.headers['X-Redis-Calls'], '1' )
+        self.assertTrue( int(resp.headers['X-Redis-Bytes-Received']) < len('customer_name' + 'Tom') )
+
+    def test_headers_only_when_enabled(self):
+        server.app.config['REDIS_CALL_HEADERS'] = False
+        resp = self.app.get('/orders/1')
+        self.assertNotIn( 'X-Redis-Calls', resp.headers )
+
+    def test_payload_size(self):
+        self.assertEqual( payload_size(['id', '12', ['a', None], 345]), 8 )
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
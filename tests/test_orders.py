@@ -7,6 +7,7 @@ import json
 from redis import Redis
 from werkzeug.exceptions import NotFound
 from app.models import Order
+from app.backends import RedisBackend
 from app.custom_exceptions import DataValidationError
 from app import server
 
@@ -27,7 +28,7 @@ class TestOrders(unittest.TestCase):
         self.assertNotEqual( order, None )
         self.assertEqual( order.id, 0 )
         self.assertEqual( order.customer_name, "Tom" )
-        self.assertEqual( order.amount_paid, '200' )
+        self.assertEqual( order.amount_paid, 200 )
 
     def test_add_a_order(self):
         # Create a order and add it to the database
@@ -43,7 +44,29 @@ class TestOrders(unittest.TestCase):
         self.assertEqual( len(orders), 1)
         self.assertEqual( orders[0].id, 1 )
         self.assertEqual( orders[0].customer_name, "Tom" )
-        self.assertEqual( orders[0].amount_paid, '200' )
+        self.assertEqual( orders[0].amount_paid, 200 )
+
+    def test_save_reloads_flushed_scripts(self):
+        Order(0, "Tom", '200').save()
+        # a Redis restart or SCRIPT FLUSH forgets every preloaded script
+        server.redis.script_flush()
+        order = Order(0, "Bob", '300')
+        order.save()
+        self.assertEqual( order.id, 2 )
+        order.delete()
+        self.assertEqual( len(Order.all()), 1 )
+
+    def test_save_many_orders(self):
+        Order(0, "Tom", '200').save()
+        orders = [Order(0, "Bob", str(i)) for i in range(5)]
+        Order.save_many(orders)
+        self.assertEqual( [order.id for order in orders], [2, 3, 4, 5, 6] )
+        self.assertEqual( len(Order.all()), 6 )
+        self.assertEqual( len(Order.find_by_customer_name("Bob")), 5 )
+        # the id counter moved past the reserved block
+        order = Order(0, "Kate", '400')
+        order.save()
+        self.assertEqual( order.id, 7 )
 
     def test_update_a_order(self):
         order = Order(0, "Tom", '200')
@@ -57,7 +80,7 @@ class TestOrders(unittest.TestCase):
         # but the data did change
         orders = Order.all()
         self.assertEqual( len(orders), 1)
-        self.assertEqual( orders[0].amount_paid, '700')
+        self.assertEqual( orders[0].amount_paid, 700)
         self.assertEqual( orders[0].customer_name, "Tom" )
 
     def test_delete_a_order(self):
@@ -68,6 +91,12 @@ class TestOrders(unittest.TestCase):
         order.delete()
         self.assertEqual( len(Order.all()), 0)
 
+    def test_delete_a_free_order(self):
+        order = Order(0, "Tom", 0)
+        order.save()
+        order.delete()
+        self.assertEqual( Order.stats(), {'count': 0, 'total_amount_paid': 0} )
+
     def test_serialize_a_order(self):
         order = Order(0, "Tom", '200')
         data = order.serialize()
@@ -77,7 +106,7 @@ class TestOrders(unittest.TestCase):
         self.assertIn( 'customer_name', data )
         self.assertEqual( data['customer_name'], "Tom" )
         self.assertIn( 'amount_paid', data )
-        self.assertEqual( data['amount_paid'], '200' )
+        self.assertEqual( data['amount_paid'], 200 )
 
     def test_deserialize_a_order(self):
         data = {"id":1, "customer_name": "Bob", "amount_paid": '300'}
@@ -86,7 +115,7 @@ class TestOrders(unittest.TestCase):
         self.assertNotEqual( order, None )
         self.assertEqual( order.id, 1 )
         self.assertEqual( order.customer_name, "Bob" )
-        self.assertEqual( order.amount_paid, '300' )
+        self.assertEqual( order.amount_paid, 300 )
 
     def test_deserialize_a_order_with_no_name(self):
         data = {"id":0, "amount_paid": '300'}
@@ -101,6 +130,37 @@ class TestOrders(unittest.TestCase):
         order = Order(0)
         self.assertRaises(DataValidationError, order.deserialize, "string data")
 
+    def test_iter_all_in_small_batches(self):
+        for i in range(25):
+            Order(0, "Tom", str(i)).save()
+        # a tiny batch size forces several round trips
+        orders = list(Order.iter_all(batch_size=3))
+        self.assertEqual( len(orders), 25 )
+        self.assertEqual( sorted(order.id for order in orders), range(1, 26) )
+
+    def test_deserialize_a_order_with_bad_amount(self):
+        order = Order(0)
+        for amount in ['12.50', -5, '-5', 'free', None, True, 10**20, 1e300, '99999999999999999999',
+                       u'\xb2', u'\u0661\u0662']:
+            data = {"customer_name": "Bob", "amount_paid": amount}
+            self.assertRaises(DataValidationError, order.deserialize, data)
+
+    def test_deserialize_a_order_with_integer_amount(self):
+        order = Order(0).deserialize({"customer_name": "Bob", "amount_paid": 1999})
+        self.assertEqual( order.amount_paid, 1999 )
+
+    def test_order_is_compact(self):
+        order = Order(0, "Tom", 200)
+        self.assertFalse( hasattr(order, '__dict__') )
+        self.assertRaises(AttributeError, setattr, order, 'color', 'red')
+
+    def test_iter_rows(self):
+        Order(0, "Tom", '200').save()
+        Order(0, "Bob", '300').save()
+        batches = list(Order.iter_rows(['1', '7', '2'], batch_size=2))
+        self.assertEqual( batches, [[(1, "Tom", 200)], [(2, "Bob", 300)]] )
+        self.assertEqual( Order.row_dict(batches[0][0]), {"id": 1, "customer_name": "Tom", "amount_paid": 200} )
+
     def test_find_order(self):
         Order(0, "Tom", '200').save()
         Order(0, "Bob", '300').save()
@@ -109,6 +169,86 @@ class TestOrders(unittest.TestCase):
         self.assertEqual( order.id, 2 )
         self.assertEqual( order.customer_name, "Bob" )
 
+    def test_find_is_cached_until_saved(self):
+        order = Order(0, "Tom", '200')
+        order.save()
+        self.assertEqual( Order.find(order.id).amount_paid, 200 )
+        self.assertEqual( Order.find(order.id).amount_paid, 200 )
+        stats = server.invalidator.cache.stats()
+        self.assertEqual( stats['hits'], 1 )
+        order.amount_paid = '700'
+        order.save()
+        self.assertEqual( Order.find(order.id).amount_paid, 700 )
+        order.delete()
+        self.assertIs( Order.find(order.id), None )
+
+    def test_find_racing_a_write_is_not_cached(self):
+        order = Order(0, "Tom", 200)
+        order.save()
+        db = Order.db()
+        read = db.get
+        def read_then_written_elsewhere(id):
+            data = read(id)
+            # another worker saves the Order and its invalidation lands before ours is cached
+            db.update(id, {'customer_name': 'Tom', 'amount_paid': 700})
+            server.invalidator.cache.invalidate(int(id))
+            return data
+        db.get = read_then_written_elsewhere
+        self.assertEqual( Order.find(order.id).amount_paid, 200 )
+        del db.get
+        self.assertEqual( Order.find(order.id).amount_paid, 700 )
+        self.assertEqual( Order.find_version(order.id), db.version(order.id) )
+
+    def test_page_ids_by_amount(self):
+        for amount in ['50', '200', '200', '200', '300', '900']:
+            Order(0, "Tom", amount).save()
+        ids, position = Order.page_ids_by_amount(100, 500, limit=2)
+        self.assertEqual( ids, [2, 3] )
+        ids, position = Order.page_ids_by_amount(100, 500, position, limit=2)
+        self.assertEqual( ids, [4, 5] )
+        self.assertIs( position, None )
+
+    def test_amount_index_follows_updates(self):
+        order = Order(0, "Tom", '200')
+        order.save()
+        order.amount_paid = '700'
+        order.save()
+        self.assertEqual( Order.page_ids_by_amount(100, 500)[0], [] )
+        self.assertEqual( Order.page_ids_by_amount(600, 800)[0], [1] )
+        order.delete()
+        self.assertEqual( Order.page_ids_by_amount()[0], [] )
+
+    def test_stats_follow_writes(self):
+        tom = Order(0, "Tom", '200')
+        tom.save()
+        Order(0, "Bob", '300').save()
+        Order.save_many([Order(0, "Bob", '50')])
+        self.assertEqual( Order.stats(), {'count': 3, 'total_amount_paid': 550} )
+        tom.customer_name = "Bob"
+        tom.amount_paid = '100'
+        tom.save()
+        self.assertEqual( Order.stats(), {'count': 3, 'total_amount_paid': 450} )
+        self.assertEqual( Order.stats("Tom"), {'count': 0, 'total_amount_paid': 0} )
+        self.assertEqual( Order.stats("Bob"), {'count': 3, 'total_amount_paid': 450} )
+        tom.delete()
+        self.assertEqual( Order.stats("Bob"), {'count': 2, 'total_amount_paid': 350} )
+
+    def test_rebuild_stats(self):
+        Order(0, "Tom", '200').save()
+        Order(0, "Bob", '300').save()
+        server.redis.hset(RedisBackend.STATS_KEY, 'total', 12345)  # drift
+        self.assertEqual( Order.rebuild_stats(), {'count': 2, 'total_amount_paid': 500} )
+        self.assertEqual( Order.stats("Bob"), {'count': 1, 'total_amount_paid': 300} )
+
+    def test_find_many(self):
+        Order(0, "Tom", '200').save()
+        Order(0, "Bob", '300').save()
+        orders = Order.find_many([2, 5, 1])
+        self.assertEqual( len(orders), 3 )
+        self.assertEqual( orders[0].customer_name, "Bob" )
+        self.assertIs( orders[1], None )
+        self.assertEqual( orders[2].customer_name, "Tom" )
+
     def test_find_with_no_orders(self):
         order = Order.find(1)
         self.assertIs( order, None)
@@ -126,9 +266,69 @@ class TestOrders(unittest.TestCase):
         Order(0, "Bob", "300").save()
         orders = Order.find_by_customer_name("Bob")
         self.assertNotEqual( len(orders), 0 )
-        self.assertEqual( orders[0].amount_paid, "300" )
+        self.assertEqual( orders[0].amount_paid, 300 )
         self.assertEqual( orders[0].customer_name, "Bob" )
 
+    def test_find_by_customer_name_after_rename(self):
+        order = Order(0, "Tom", "200")
+        order.save()
+        order.customer_name = "Bob"
+        order.save()
+        self.assertEqual( Order.find_by_customer_name("Tom"), [] )
+        orders = Order.find_by_customer_name("Bob")
+        self.assertEqual( len(orders), 1 )
+        self.assertEqual( orders[0].id, order.id )
+
+    def test_find_by_customer_name_after_delete(self):
+        order = Order(0, "Tom", "200")
+        order.save()
+        Order(0, "Tom", "300").save()
+        order.delete()
+        orders = Order.find_by_customer_name("Tom")
+        self.assertEqual( len(orders), 1 )
+        self.assertEqual( orders[0].amount_paid, 300 )
+
+    def test_remove_all_leaves_other_keys(self):
+        server.redis.set('other-service:key', 'keep me')
+        Order(0, "Tom", "200").save()
+        Order.remove_all()
+        self.assertEqual( Order.all(), [] )
+        self.assertEqual( server.redis.get('other-service:key'), 'keep me' )
+        server.redis.delete('other-service:key')
+
+    def test_migrate_legacy_keys(self):
+        # orders stored the old way under bare integer keys
+        server.redis.hmset('1', {"id": 1, "customer_name": "Tom", "amount_paid": "200"})
+        server.redis.hmset('2', {"id": 2, "customer_name": "Bob", "amount_paid": "12.50"})
+        server.redis.hmset('3', {"id": 3, "customer_name": "Kate", "amount_paid": "free"})
+        server.redis.set('index', 3)
+        self.assertEqual( Order.migrate_legacy_keys(batch_size=1), 3 )
+        self.assertFalse( server.redis.exists('1') )
+        self.assertFalse( server.redis.exists('index') )
+        self.assertEqual( len(Order.all()), 3 )
+        self.assertEqual( Order.find_by_customer_name("Bob")[0].id, 2 )
+        # legacy amounts were dollars
+        self.assertEqual( [order.amount_paid for order in Order.find_many([1, 2, 3])], [20000, 1250, None] )
+        self.assertEqual( server.redis.hget('order:3', 'legacy_amount_paid'), 'free' )
+        self.assertEqual( Order.stats(), {'count': 3, 'total_amount_paid': 21250} )
+        order = Order(0, "Kate", "400")
+        order.save()
+        self.assertEqual( order.id, 4 )
+
+    def test_legacy_amounts_are_read_and_normalized(self):
+        Order(0, "Tom", 200).save()
+        Order(0, "Bob", 300).save()
+        # amounts stored in order: hashes before they had to be cents
+        server.redis.hset('order:1', 'amount_paid', '12.50')
+        server.redis.hset('order:2', 'amount_paid', 'free')
+        Order.use_cache(None)
+        self.assertEqual( Order.find(1).amount_paid, None )
+        self.assertEqual( list(Order.iter_rows([1, 2])), [[(1, "Tom", None), (2, "Bob", None)]] )
+        self.assertEqual( Order.normalize_amounts(), 2 )
+        self.assertEqual( Order.find(1).amount_paid, 1250 )
+        self.assertEqual( server.redis.hget('order:2', 'legacy_amount_paid'), 'free' )
+        self.assertEqual( Order.normalize_amounts(), 0 )
+
 
 ######################################################################
 #   M A I N
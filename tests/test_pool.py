@@ -0,0 +1,56 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest
+from redis import Redis
+from redis.exceptions import ConnectionError
+from app.pool import create_pool, InstrumentedConnectionPool, InstrumentedBlockingConnectionPool
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestPool(unittest.TestCase):
+
+    def test_create_blocking_pool(self):
+        pool = create_pool('127.0.0.1', 6379, None, max_connections=5, timeout=1)
+        self.assertIsInstance( pool, InstrumentedBlockingConnectionPool )
+        self.assertEqual( pool.max_connections, 5 )
+
+    def test_create_non_blocking_pool(self):
+        pool = create_pool('127.0.0.1', 6379, None, blocking=False)
+        self.assertIsInstance( pool, InstrumentedConnectionPool )
+        Redis(connection_pool=pool).ping()
+        stats = pool.stats()
+        self.assertEqual( stats['created'], 1 )
+        self.assertEqual( stats['idle'], 1 )
+        self.assertEqual( stats['in_use'], 0 )
+        self.assertNotIn( 'waits', stats )
+
+    def test_non_blocking_pool_counts_refusals(self):
+        pool = create_pool('127.0.0.1', 6379, None, max_connections=1, blocking=False)
+        connection = pool.get_connection('PING')
+        self.assertRaises(ConnectionError, pool.get_connection, 'PING')
+        self.assertEqual( pool.stats()['exhausted'], 1 )
+        pool.release(connection)
+
+    def test_blocking_pool_stats(self):
+        pool = create_pool('127.0.0.1', 6379, None, max_connections=1, timeout=0.01)
+        connection = pool.get_connection('PING')
+        stats = pool.stats()
+        self.assertEqual( stats['in_use'], 1 )
+        self.assertEqual( stats['idle'], 0 )
+        # the only connection is checked out so the next caller waits and gives up
+        self.assertRaises(ConnectionError, pool.get_connection, 'PING')
+        stats = pool.stats()
+        self.assertEqual( stats['waits'], 1 )
+        self.assertEqual( stats['timeouts'], 1 )
+        pool.release(connection)
+        self.assertEqual( pool.stats()['idle'], 1 )
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
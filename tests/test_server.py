@@ -6,11 +6,13 @@ import unittest
 import logging
 import json
 from app import server
+from app.models import Order
 
 # Status Codes
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
 HTTP_400_BAD_REQUEST = 400
 HTTP_404_NOT_FOUND = 404
 HTTP_409_CONFLICT = 409
@@ -48,6 +50,15 @@ class TestOrderServer(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual (data['customer_name'], 'Bob')
 
+    def test_get_order_with_legacy_amount(self):
+        server.redis.hset('order:2', 'amount_paid', '12.50')
+        Order.use_cache(None)
+        resp = self.app.get('/orders/2')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertEqual( json.loads(resp.data)['amount_paid'], None )
+        resp = self.app.get('/orders')
+        self.assertEqual( [order['amount_paid'] for order in json.loads(resp.data)], [200, None] )
+
     def test_get_order_not_found(self):
         resp = self.app.get('/orders/0')
         self.assertEqual( resp.status_code, HTTP_404_NOT_FOUND )
@@ -74,6 +85,34 @@ class TestOrderServer(unittest.TestCase):
         self.assertEqual( len(data), order_count + 1 )
         self.assertIn( new_json, data )
 
+    def test_create_orders_in_bulk(self):
+        order_count = self.get_order_count()
+        new_orders = [{'customer_name': 'Kate', 'amount_paid': '400'},
+                      {'customer_name': 'Jim', 'amount_paid': '500'}]
+        resp = self.app.post('/orders/bulk', data=json.dumps(new_orders), content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_201_CREATED )
+        data = json.loads(resp.data)
+        self.assertEqual( [item['status'] for item in data], [HTTP_201_CREATED, HTTP_201_CREATED] )
+        self.assertEqual( data[1]['order']['customer_name'], 'Jim' )
+        resp = self.app.get(data[1]['location'])
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertEqual( self.get_order_count(), order_count + 2 )
+
+    def test_create_orders_in_bulk_with_bad_item(self):
+        new_orders = [{'customer_name': 'Kate', 'amount_paid': '400'}, {'amount_paid': '500'},
+                      {'customer_name': None, 'amount_paid': '500'}, {'customer_name': {'name': 'Kate'}, 'amount_paid': '500'},
+                      {'customer_name': '', 'amount_paid': '500'}, {'customer_name': 'Liz', 'amount_paid': '600'}]
+        resp = self.app.post('/orders/bulk', data=json.dumps(new_orders), content_type='application/json')
+        self.assertEqual( resp.status_code, 207 )
+        data = json.loads(resp.data)
+        self.assertEqual( [item['status'] for item in data], [HTTP_201_CREATED] + [HTTP_400_BAD_REQUEST] * 4 + [HTTP_201_CREATED] )
+        resp = self.app.get('/orders?customer_name=Liz')
+        self.assertEqual( len(json.loads(resp.data)), 1 )
+
+    def test_create_orders_in_bulk_with_no_array(self):
+        resp = self.app.post('/orders/bulk', data=json.dumps({'customer_name': 'Kate'}), content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+
     def test_update_order(self):
         new_order = {'customer_name': 'Bob', 'amount_paid': '500'}
         data = json.dumps(new_order)
@@ -82,7 +121,7 @@ class TestOrderServer(unittest.TestCase):
         resp = self.app.get('/orders/2', content_type='application/json')
         self.assertEqual( resp.status_code, HTTP_200_OK )
         new_json = json.loads(resp.data)
-        self.assertEqual (new_json['amount_paid'], '500')
+        self.assertEqual (new_json['amount_paid'], 500)
 
     def test_update_order_with_no_customer_name(self):
         new_order = {'amount_paid': '200'}
@@ -112,6 +151,20 @@ class TestOrderServer(unittest.TestCase):
         resp = self.app.post('/orders', data=data, content_type='application/json')
         self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
 
+    def test_create_order_with_huge_amount(self):
+        stats = Order.stats()
+        data = json.dumps({'customer_name': 'Kate', 'amount_paid': 10**20})
+        resp = self.app.post('/orders', data=data, content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+        self.assertEqual( Order.stats(), stats )
+
+    def test_create_order_with_unicode_digits(self):
+        data = json.dumps({'customer_name': 'Kate', 'amount_paid': u'\xb2'})
+        resp = self.app.post('/orders', data=data, content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+        resp = self.app.put('/orders/1', data=data, content_type='application/json')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+
     def test_create_order_with_no_content_type(self):
         new_order = {'amount_paid': '200'}
         data = json.dumps(new_order)
@@ -132,6 +185,97 @@ class TestOrderServer(unittest.TestCase):
         query_item = data[0]
         self.assertEqual(query_item['customer_name'], 'Tom')
         
+    def test_get_order_list_in_pages(self):
+        server.data_load({"customer_name": "Kate", "amount_paid": "400"})
+        resp = self.app.get('/orders', query_string='limit=2')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertEqual( [order['id'] for order in data], [1, 2] )
+        links = resp.headers.get('Link')
+        self.assertIn( 'rel="next"', links )
+        next_url = links.split(', ')[1].split(';')[0].strip('<>')
+        resp = self.app.get(next_url)
+        data = json.loads(resp.data)
+        self.assertEqual( [order['id'] for order in data], [3] )
+        self.assertNotIn( 'rel="next"', resp.headers.get('Link') )
+
+    def test_get_order_list_as_ndjson(self):
+        resp = self.app.get('/orders', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertEqual( resp.mimetype, 'application/x-ndjson' )
+        lines = resp.data.strip().split('\n')
+        self.assertEqual( [json.loads(line)['customer_name'] for line in lines], ['Tom', 'Bob'] )
+
+    def test_get_order_list_is_streamed(self):
+        resp = self.app.get('/orders')
+        self.assertTrue( resp.is_streamed )
+        self.assertEqual( resp.mimetype, 'application/json' )
+
+    def test_get_order_list_with_bad_paging(self):
+        resp = self.app.get('/orders', query_string='limit=0')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+        resp = self.app.get('/orders', query_string='cursor=not-a-cursor')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+        resp = self.app.get('/orders', query_string={'cursor': server.encode_cursor('order', -1)})
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+
+    def test_query_order_list_by_amount_with_bad_cursor(self):
+        for position in [(float('nan'), 0), (float('inf'), 0), (100.0, -1)]:
+            cursor = server.encode_cursor('amount', *position)
+            resp = self.app.get('/orders', query_string={'min_amount': 0, 'cursor': cursor})
+            self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+            self.assertIn( 'Invalid cursor', json.loads(resp.data)['message'] )
+
+    def test_query_order_list_by_amount(self):
+        server.data_load({"customer_name": "Kate", "amount_paid": "250"})
+        resp = self.app.get('/orders', query_string='min_amount=210&max_amount=400&limit=1')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertEqual( [order['customer_name'] for order in data], ['Kate'] )
+        next_url = resp.headers.get('Link').split(', ')[1].split(';')[0].strip('<>')
+        self.assertIn( 'min_amount=210', next_url )
+        resp = self.app.get(next_url)
+        data = json.loads(resp.data)
+        self.assertEqual( [order['customer_name'] for order in data], ['Bob'] )
+        self.assertNotIn( 'rel="next"', resp.headers.get('Link') )
+
+    def test_query_order_list_by_bad_amount(self):
+        resp = self.app.get('/orders', query_string='min_amount=lots')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+
+    def test_get_order_stats(self):
+        resp = self.app.get('/orders/stats')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertEqual( data['count'], 2 )
+        self.assertEqual( data['total_amount_paid'], 500 )
+        resp = self.app.get('/orders/stats', query_string='customer_name=Bob')
+        data = json.loads(resp.data)
+        self.assertEqual( data['customer_name'], 'Bob' )
+        self.assertEqual( data['total_amount_paid'], 300 )
+
+    def test_query_order_list_by_ids(self):
+        resp = self.app.get('/orders', query_string='ids=2,7,1')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertEqual( [order['customer_name'] for order in data['orders']], ['Bob', 'Tom'] )
+        self.assertEqual( data['missing'], [7] )
+
+    def test_query_order_list_by_duplicate_ids(self):
+        resp = self.app.get('/orders', query_string='ids=2,1,2,7,1,7')
+        data = json.loads(resp.data)
+        self.assertEqual( [order['id'] for order in data['orders']], [2, 1] )
+        self.assertEqual( data['missing'], [7] )
+
+    def test_query_order_list_by_too_many_ids(self):
+        ids = ','.join(str(id) for id in range(server.app.config['LOOKUP_MAX_IDS'] + 1))
+        resp = self.app.get('/orders', query_string='ids=' + ids)
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+
+    def test_query_order_list_by_bad_ids(self):
+        resp = self.app.get('/orders', query_string='ids=1,two')
+        self.assertEqual( resp.status_code, HTTP_400_BAD_REQUEST )
+
     def test_duplicate_nonexisting_order(self):
         resp = self.app.put('/orders/11111/duplicate')
         self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
@@ -143,6 +287,81 @@ class TestOrderServer(unittest.TestCase):
         order_count_new = self.get_order_count()
         self.assertEqual(order_count_new,order_count_old+1)
 
+    def test_get_pool_stats(self):
+        resp = self.app.get('/redis/pool')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertTrue( data['blocking'] )
+        self.assertTrue( data['created'] >= 1 )
+        self.assertIn( 'waits', data )
+
+    def test_get_cache_stats(self):
+        self.app.get('/orders/1')
+        self.app.get('/orders/1')
+        resp = self.app.get('/cache/stats')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertTrue( data['enabled'] )
+        self.assertEqual( data['hits'], 1 )
+
+    def test_get_order_not_modified(self):
+        resp = self.app.get('/orders/1')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/orders/1', headers={'If-None-Match': etag})
+        self.assertEqual( resp.status_code, HTTP_304_NOT_MODIFIED )
+        self.assertEqual( resp.headers['ETag'], etag )
+        self.assertEqual( resp.data, '' )
+
+    def test_get_order_modified_after_update(self):
+        etag = self.app.get('/orders/1').headers['ETag']
+        new_tom = {'customer_name': 'Tom', 'amount_paid': 300}
+        resp = self.app.put('/orders/1', data=json.dumps(new_tom), content_type='application/json')
+        self.assertNotEqual( resp.headers['ETag'], etag )
+        resp = self.app.get('/orders/1', headers={'If-None-Match': etag})
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertEqual( json.loads(resp.data)['amount_paid'], 300 )
+
+    def test_get_order_list_not_modified(self):
+        etag = self.app.get('/orders').headers['ETag']
+        resp = self.app.get('/orders', headers={'If-None-Match': etag})
+        self.assertEqual( resp.status_code, HTTP_304_NOT_MODIFIED )
+        self.assertNotEqual( self.app.get('/orders', query_string='limit=1').headers['ETag'], etag )
+        self.app.post('/orders', data=json.dumps({'customer_name': 'Kate', 'amount_paid': 400}), content_type='application/json')
+        resp = self.app.get('/orders', headers={'If-None-Match': etag})
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertEqual( len(json.loads(resp.data)), 3 )
+
+    def test_get_order_list_by_non_ascii_customer(self):
+        server.data_load({"customer_name": u"Jos\xe9", "amount_paid": "500"})
+        resp = self.app.get('/orders?customer_name=Jos%C3%A9')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertEqual( [order['customer_name'] for order in json.loads(resp.data)], [u"Jos\xe9"] )
+        resp = self.app.get('/orders?customer_name=Jos%C3%A9', headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual( resp.status_code, HTTP_304_NOT_MODIFIED )
+
+    def test_get_order_from_stored_json(self):
+        server.app.config['ORDER_JSON_BLOBS'] = True
+        server.initialize_encoder()
+        self.addCleanup(server.app.config.__setitem__, 'ORDER_JSON_BLOBS', False)
+        self.addCleanup(server.initialize_encoder)
+        resp = self.app.post('/orders', data=json.dumps({'customer_name': 'Kate', 'amount_paid': 400}), content_type='application/json')
+        self.assertEqual( resp.data, '{"amount_paid":400,"customer_name":"Kate","id":3}' )
+        resp = self.app.get('/orders/3')
+        self.assertEqual( resp.status_code, HTTP_200_OK )
+        self.assertEqual( resp.content_type, 'application/json' )
+        self.assertEqual( resp.data, '{"amount_paid":400,"customer_name":"Kate","id":3}' )
+        self.assertIn( 'ETag', resp.headers )
+        data = json.loads(self.app.get('/orders').data)
+        self.assertEqual( [order['customer_name'] for order in data], ['Tom', 'Bob', 'Kate'] )
+
+    def test_get_order_with_another_encoder(self):
+        server.app.config['JSON_ENCODER'] = 'ujson'
+        self.addCleanup(server.app.config.__setitem__, 'JSON_ENCODER', 'json')
+        self.addCleanup(server.initialize_encoder)
+        server.initialize_encoder()
+        resp = self.app.get('/orders/1')
+        self.assertEqual( json.loads(resp.data)['customer_name'], 'Tom' )
+
 
 ######################################################################
 # Utility functions
@@ -0,0 +1,201 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest
+import json
+import threading
+from redis.exceptions import ConnectionError, ResponseError
+from app import server
+from app.models import Order
+from app.backends import MemoryBackend, RedisBackend
+from app.writebehind import WriteBehindQueue, QUEUED
+from app.custom_exceptions import WriteBehindError, DataValidationError
+
+class FailingBackend(MemoryBackend):
+    """ A backend whose writes fail until failures runs out """
+
+    def __init__(self, failures):
+        super(FailingBackend, self).__init__()
+        self.failures = failures
+
+    def write_many(self, records):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('Redis went away')
+        super(FailingBackend, self).write_many(records)
+
+class RejectingBackend(MemoryBackend):
+    """ A backend whose server refuses every batch """
+
+    def write_many(self, records):
+        raise ResponseError('value is not an integer or out of range')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestWriteBehindQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.queue = None
+
+    def tearDown(self):
+        if self.queue:
+            self.queue.stop()
+
+    def test_flushed_creates_are_stored_on_return(self):
+        self.queue = WriteBehindQueue(self.backend, batch_size=10, interval=0.005).start()
+        id, version = self.queue.submit({'customer_name': 'Tom', 'amount_paid': 200})
+        self.assertEqual( self.backend.get(id)['customer_name'], 'Tom' )
+        self.assertEqual( self.backend.get(id)['version'], version )
+        self.assertEqual( self.backend.stats(), (1, 200) )
+        self.assertTrue( self.backend.generation() > version )
+
+    def test_concurrent_creates_share_batches(self):
+        self.queue = WriteBehindQueue(self.backend, batch_size=50, interval=0.05).start()
+        ids = []
+        threads = [threading.Thread(target=lambda: ids.append(self.queue.submit({'customer_name': 'Tom', 'amount_paid': 1})[0]))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual( sorted(ids), range(1, 21) )
+        self.assertEqual( self.queue.flushed, 20 )
+        self.assertTrue( self.queue.batches < 20 )
+        self.assertEqual( self.backend.stats(), (20, 20) )
+
+    def test_full_batches_are_flushed_at_once(self):
+        self.queue = WriteBehindQueue(self.backend, batch_size=3, interval=60, durability=QUEUED).start()
+        for i in range(3):
+            self.queue.submit({'customer_name': 'Tom', 'amount_paid': i})
+        self.queue.stop()
+        self.assertEqual( (self.queue.flushed, self.queue.batches), (3, 1) )
+
+    def test_stop_flushes_queued_creates(self):
+        self.queue = WriteBehindQueue(self.backend, batch_size=100, interval=60, durability=QUEUED).start()
+        id, version = self.queue.submit({'customer_name': 'Tom', 'amount_paid': 200})
+        self.assertIs( self.backend.get(id), None )
+        self.assertEqual( self.queue.pending(), 1 )
+        self.queue.stop()
+        self.assertEqual( self.backend.get(id)['customer_name'], 'Tom' )
+        self.assertRaises( WriteBehindError, self.queue.submit, {'customer_name': 'Bob', 'amount_paid': 1} )
+
+    def test_queued_creates_are_retried(self):
+        self.backend = FailingBackend(failures=2)
+        self.queue = WriteBehindQueue(self.backend, batch_size=100, interval=0.001, durability=QUEUED).start()
+        id, version = self.queue.submit({'customer_name': 'Tom', 'amount_paid': 200})
+        self.queue.stop()
+        self.assertEqual( self.queue.retries, 2 )
+        self.assertEqual( self.backend.get(id)['customer_name'], 'Tom' )
+        self.assertEqual( self.backend.stats(), (1, 200) )
+
+    def test_stop_gives_up_on_a_dead_backend(self):
+        self.backend = FailingBackend(failures=100)
+        self.queue = WriteBehindQueue(self.backend, batch_size=100, interval=0.001, durability=QUEUED).start()
+        self.queue.submit({'customer_name': 'Tom', 'amount_paid': 200})
+        self.queue.stop()
+        self.assertEqual( self.queue.lost, 1 )
+
+    def test_bad_records_are_refused_at_submit(self):
+        self.queue = WriteBehindQueue(self.backend, batch_size=100, interval=0.001, durability=QUEUED).start()
+        self.assertRaises( DataValidationError, self.queue.submit, {'customer_name': 'Tom', 'amount_paid': 10**20} )
+        self.assertRaises( DataValidationError, self.queue.submit, {'amount_paid': 200} )
+        self.assertEqual( self.queue.pending(), 0 )
+
+    def test_rejected_batches_are_not_retried(self):
+        self.backend = RejectingBackend()
+        self.queue = WriteBehindQueue(self.backend, batch_size=100, interval=0.001, durability=QUEUED).start()
+        self.queue.submit({'customer_name': 'Tom', 'amount_paid': 200})
+        self.queue.stop()
+        self.assertEqual( (self.queue.retries, self.queue.lost), (0, 1) )
+
+    def test_flushed_create_failure_is_raised(self):
+        self.backend = FailingBackend(failures=1)
+        self.queue = WriteBehindQueue(self.backend, batch_size=100, interval=0.001).start()
+        self.assertRaises( WriteBehindError, self.queue.submit, {'customer_name': 'Tom', 'amount_paid': 200} )
+
+    def test_ids_are_reserved_in_blocks(self):
+        server.inititalize_redis()
+        backend = RedisBackend(server.redis)
+        backend.remove_all()
+        first = WriteBehindQueue(backend, batch_size=10, interval=0.001).start()
+        second = WriteBehindQueue(backend, batch_size=10, interval=0.001).start()
+        try:
+            self.assertEqual( first.submit({'customer_name': 'Tom', 'amount_paid': 1})[0], 1 )
+            self.assertEqual( second.submit({'customer_name': 'Bob', 'amount_paid': 2})[0], 11 )
+            self.assertEqual( first.submit({'customer_name': 'Kate', 'amount_paid': 3})[0], 2 )
+            self.assertEqual( backend.customer_ids('Bob'), [11] )
+            self.assertEqual( backend.stats(), (3, 6) )
+        finally:
+            first.stop()
+            second.stop()
+            backend.remove_all()
+
+    def test_writes_are_checked_and_idempotent(self):
+        server.inititalize_redis()
+        for backend in (MemoryBackend(), RedisBackend(server.redis)):
+            backend.remove_all()
+            id, version = backend.reserve(2)
+            tom = {'id': id, 'version': version, 'customer_name': 'Tom', 'amount_paid': 200}
+            huge = {'id': id + 1, 'version': version + 1, 'customer_name': 'Bob', 'amount_paid': 10**20}
+            self.assertRaises( ValueError, backend.write_many, [tom, huge] )
+            self.assertEqual( backend.get(id), None )
+            backend.write_many([tom])
+            backend.write_many([tom])
+            self.assertEqual( backend.stats(), (1, 200) )
+            self.assertEqual( backend.stats('Tom'), (1, 200) )
+            backend.remove_all()
+
+    def test_write_script_checks_before_writing(self):
+        server.inititalize_redis()
+        backend = RedisBackend(server.redis)
+        backend.remove_all()
+        keys = [backend.IDS_KEY, backend.AMOUNT_KEY, backend.GENERATION_KEY,
+                backend.order_key(1), backend.customer_key('Tom'), backend.order_key(2), backend.customer_key('Bob')]
+        args = [1, 1, 2, 'customer_name', 'Tom', 'amount_paid', 200, 2, 2, 2, 'customer_name', 'Bob', 'amount_paid', 10**20]
+        try:
+            self.assertRaises( ResponseError, backend.scripts.run, 'write_many', keys + backend.STATS_KEYS, args )
+            self.assertEqual( backend.get(1), None )
+            self.assertEqual( backend.stats(), (0, 0) )
+        finally:
+            backend.remove_all()
+
+
+class TestWriteBehindCreates(unittest.TestCase):
+
+    def setUp(self):
+        server.app.debug = True
+        server.app.config['ORDER_WRITE_BEHIND'] = True
+        server.inititalize_redis()
+        server.data_reset()
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        server.app.config['ORDER_WRITE_BEHIND'] = False
+        server.inititalize_redis()
+        server.data_reset()
+
+    def test_create_order(self):
+        resp = self.app.post('/orders', data=json.dumps({'customer_name': 'Tom', 'amount_paid': 200}),
+                             content_type='application/json')
+        self.assertEqual( resp.status_code, 201 )
+        self.assertTrue( resp.headers['Location'].endswith('/orders/1') )
+        resp = self.app.get('/orders/1')
+        self.assertEqual( json.loads(resp.data)['customer_name'], 'Tom' )
+
+    def test_stop_writes_queued_creates(self):
+        server.write_behind.durability = QUEUED
+        server.write_behind.interval = 60
+        order = Order(0, 'Tom', 200)
+        order.save()
+        server.stop_write_behind()
+        self.assertEqual( Order.find(order.id).customer_name, 'Tom' )
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()